@@ -0,0 +1,78 @@
+"""
+Per-query overhead of looking up a frame's metadata in FrameProcessor: the
+time range check and the dataframe JSON of the prompt, with per-frame pandas
+lookups as before and with the columns as arrays and the JSON rows memoised.
+
+    python benchmarks/bench_frame_metadata.py --frames 100000 --queries 2000
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+from pupil_labs.automate_custom_events.frame_processor import FrameProcessor
+
+
+def make_metadata(num_frames):
+    ts = np.arange(num_frames, dtype=np.uint64) * np.uint64(33_333_333)
+    return pd.DataFrame(
+        {
+            "pts": np.arange(num_frames) * 512,
+            "timestamp [ns]": ts,
+            "timestamp [s]": ts / 1e9,
+        }
+    )
+
+
+def legacy_query(processor, index):
+    """The lookups query_frame did per frame before."""
+    timestamp = processor.frame_metadata.iloc[index]["timestamp [s]"]
+    if not processor.is_within_time_range(timestamp):
+        return None
+    return json.dumps([processor.frame_metadata.iloc[index].to_dict()])
+
+
+def columnar_query(processor, index):
+    if not processor.in_time_range[index]:
+        return None
+    return f"[{processor.frame_row_json(index)}]"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--frames", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=2000)
+    args = parser.parse_args()
+
+    metadata = make_metadata(args.frames)
+    start = time.perf_counter()
+    processor = FrameProcessor(
+        [""] * args.frames,
+        metadata,
+        "openai-key",
+        "cloud-token",
+        "recording",
+        "workspace",
+        "reading a book",
+        "reading_book",
+        100,
+        0,
+        args.frames,
+    )
+    setup = time.perf_counter() - start
+    indices = np.random.default_rng(0).integers(0, args.frames, args.queries)
+
+    for name, query in (("pandas rows", legacy_query), ("columnar", columnar_query)):
+        start = time.perf_counter()
+        for index in indices:
+            query(processor, int(index))
+        elapsed = time.perf_counter() - start
+        print(f"{name:>12}: {1e6 * elapsed / len(indices):8.1f} us per query")
+    print(f"FrameProcessor setup for {args.frames} frames: {setup:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Cost and latency per analysed frame when sending 1, 2, 4 or 8 frames per chat
+request, against a local stand-in for the chat completions endpoint.
+
+The stand-in counts input tokens like the API does for gpt-4o (about 4
+characters per text token, 765 tokens per 768px image) and answers after a
+latency that grows with the input, so the numbers show how the system prompt
+is amortised, not how the model behaves.
+
+    python benchmarks/bench_multi_frame_requests.py --frames 600 --batch-size 60
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import aiohttp
+import pandas as pd
+from aiohttp import web
+
+from pupil_labs.automate_custom_events import frame_processor
+from pupil_labs.automate_custom_events.frame_processor import (
+    IMAGE_TOKENS,
+    FrameProcessor,
+)
+from pupil_labs.automate_custom_events.rate_limiter import RateLimiter
+
+# gpt-4o-2024-05-13 list prices in USD per token
+INPUT_PRICE = 5 / 1e6
+OUTPUT_PRICE = 15 / 1e6
+
+# Latency of the stand-in: a fixed part plus a part per input token
+BASE_LATENCY = 0.4
+LATENCY_PER_TOKEN = 0.00015
+
+
+class NullPublisher:
+    def publish(self, keyword, ts):
+        return True
+
+
+class StandIn:
+    def __init__(self, activity_start, latency_scale):
+        self.activity_start = activity_start
+        self.latency_scale = latency_scale
+        self.requests = 0
+        self.frames = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    async def chat_completions(self, request):
+        body = await request.json()
+        text = "".join(
+            m["content"] for m in body["messages"] if isinstance(m["content"], str)
+        )
+        images = sum(
+            len(m["content"])
+            for m in body["messages"]
+            if isinstance(m["content"], list)
+        )
+        tokens = len(text) // 4 + IMAGE_TOKENS * images
+        rows = json.loads(body["messages"][2]["content"].split(": ", 1)[1])
+        lines = [
+            f"Frame {row['frame']}: Timestamp - {row['timestamp [s]']}, "
+            "Code - reading_book"
+            for row in rows
+            if row["frame"] >= self.activity_start
+        ]
+        content = "\n".join(lines) or "No activity detected."
+        self.requests += 1
+        self.frames += images
+        self.input_tokens += tokens
+        self.output_tokens += len(content) // 4
+        await asyncio.sleep(
+            (BASE_LATENCY + LATENCY_PER_TOKEN * tokens) * self.latency_scale
+        )
+        return web.json_response({"choices": [{"message": {"content": content}}]})
+
+
+async def run(num_frames, batch_size, frames_per_request, concurrency, latency_scale):
+    stand_in = StandIn(int(num_frames * 0.6), latency_scale)
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", stand_in.chat_completions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    frame_processor.OPENAI_URL = f"http://127.0.0.1:{port}/v1/chat/completions"
+
+    metadata = pd.DataFrame({"timestamp [s]": [i / 30 for i in range(num_frames)]})
+    processor = FrameProcessor(
+        ["A" * 1000] * num_frames,
+        metadata,
+        "openai-key",
+        "cloud-token",
+        "recording",
+        "workspace",
+        "reading a book; looking at the phone",
+        "reading_book; looking_phone",
+        batch_size,
+        0,
+        num_frames,
+        rate_limiter=RateLimiter(concurrency),
+        frames_per_request=frames_per_request,
+    )
+    processor.event_publisher = NullPublisher()
+
+    start = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        results = await processor.process_batches(session, batch_size)
+    elapsed = time.perf_counter() - start
+    await runner.cleanup()
+
+    analysed = stand_in.frames
+    cost = stand_in.input_tokens * INPUT_PRICE + stand_in.output_tokens * OUTPUT_PRICE
+    first_hit = min((r["frame_id"] for r in results), default=None)
+    return {
+        "frames/request": frames_per_request,
+        "requests": stand_in.requests,
+        "input tokens/frame": stand_in.input_tokens / analysed,
+        "USD/frame": cost / analysed,
+        "ms/frame": 1000 * elapsed / analysed,
+        "wall [s]": elapsed,
+        "first hit": first_hit,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--frames", type=int, default=600)
+    parser.add_argument("--batch-size", type=int, default=60)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--latency-scale",
+        type=float,
+        default=0.1,
+        help="scales the simulated API latency, 1 for realistic timings",
+    )
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    rows = [
+        asyncio.run(
+            run(
+                args.frames,
+                args.batch_size,
+                k,
+                args.concurrency,
+                args.latency_scale,
+            )
+        )
+        for k in args.k
+    ]
+    print(pd.DataFrame(rows).to_string(index=False, float_format="{:.4g}".format))
+
+
+if __name__ == "__main__":
+    main()
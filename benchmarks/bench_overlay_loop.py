@@ -0,0 +1,135 @@
+"""
+Frames per second of the overlay render loop (decode, look up the gaze row,
+draw) with a pandas row lookup and get_frame per frame as before, and with
+the gaze table as arrays and a single sequential decoder.
+
+    python benchmarks/bench_overlay_loop.py --frames 600 --width 1088 --height 1080
+"""
+
+import argparse
+import logging
+import tempfile
+import time
+from pathlib import Path
+
+import av
+import numpy as np
+import pandas as pd
+from synthetic import make_scene_video
+
+from pupil_labs.automate_custom_events.video_utils import (
+    iter_gaze_overlay_frames,
+    render_gaze_overlay,
+)
+
+
+def make_merged(video_path):
+    with av.open(str(video_path)) as container:
+        pts = sorted(p.pts for p in container.demux(video=0) if p.pts is not None)
+    ts = pd.Series(np.arange(len(pts), dtype=np.uint64) * 33_333_333)
+    merged = pd.DataFrame(
+        {
+            "pts": pts,
+            "timestamp [ns]": ts,
+            "gaze x [px]": np.linspace(0, 1000, len(pts)),
+            "gaze y [px]": 500.0,
+        }
+    )
+    return merged, ts
+
+
+def get_frame(av_container, pts, last_pts, frame, audio=False):
+    """
+    Gets the frame at the given timestamp, as the package did before
+    iter_gaze_overlay_frames.
+    :param av_container: The container of the video.
+    :param pts: The pts of the frame we are looking for.
+    :param last_pts: The last pts of the video readed.
+    :param frame: Last frame decoded.
+    """
+    if audio:
+        strm = av_container.streams.audio[0]
+    else:
+        strm = av_container.streams.video[0]
+    if last_pts < pts:
+        try:
+            for frame in av_container.decode(strm):
+                logging.debug(
+                    f"Frame {frame.pts} read from video and looking for {pts}"
+                )
+                if pts == frame.pts:
+                    last_pts = frame.pts
+                    return frame, last_pts
+                if pts < frame.pts:
+                    logging.warning(f"Frame {pts} not found in video, used {frame.pts}")
+                    last_pts = frame.pts
+                    return frame, last_pts
+        except av.EOFError:
+            logging.info("End of the file")
+            return None, last_pts
+    else:
+        logging.debug("This frame was already decoded")
+        return frame, last_pts
+
+
+def legacy_loop(merged_video, video_path, world_timestamps_df):
+    """The per-frame iloc and get_frame loop that iter_gaze_overlay_frames replaced."""
+    merged_video = merged_video[
+        merged_video["timestamp [ns]"] >= world_timestamps_df[0]
+    ]
+    with av.open(str(video_path)) as video:
+        vid_frame, lpts = None, -1
+        for i in range(merged_video.shape[0]):
+            row = merged_video.iloc[i]
+            vid_frame, lpts = get_frame(video, int(row["pts"]), lpts, vid_frame)
+            if vid_frame is None:
+                break
+            xy = row[["gaze x [px]", "gaze y [px]"]].to_numpy(dtype=np.float64)
+            yield vid_frame, render_gaze_overlay(vid_frame, xy), xy
+
+
+def measure_fps(loop, merged, video_path, ts):
+    num_frames = 0
+    t0 = time.perf_counter()
+    for _ in loop(merged, str(video_path), ts):
+        num_frames += 1
+    return num_frames / (time.perf_counter() - t0), num_frames
+
+
+def decode_only(merged, video_path, ts):
+    with av.open(str(video_path)) as container:
+        for vid_frame in container.decode(video=0):
+            yield vid_frame.to_ndarray(format="bgr24")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--frames", type=int, default=600)
+    parser.add_argument("--width", type=int, default=1088)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument(
+        "--debug", action="store_true", help="log at DEBUG level like a verbose run"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        video_path = make_scene_video(
+            Path(tmp_dir) / "scene.mp4", args.frames, args.width, args.height
+        )
+        merged, ts = make_merged(video_path)
+        measure_fps(decode_only, merged, video_path, ts)
+        results = {
+            "decode + convert only": measure_fps(decode_only, merged, video_path, ts),
+            "iloc + get_frame": measure_fps(legacy_loop, merged, video_path, ts),
+            "arrays + one decoder": measure_fps(
+                iter_gaze_overlay_frames, merged, video_path, ts
+            ),
+        }
+
+    for name, (fps, num_frames) in results.items():
+        print(f"{name:>22}: {fps:8.1f} fps ({num_frames} frames)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Frames per second of the gaze overlay rendering (decode, draw, convert to an
+encoder frame) before and after rendering in place on uint8 buffers.
+
+    python benchmarks/bench_overlay_render.py --frames 300 --width 1088 --height 1080
+"""
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import av
+import cv2
+import numpy as np
+from synthetic import make_scene_video
+
+from pupil_labs.automate_custom_events.video_utils import (
+    OVERLAY_PARAMS,
+    render_gaze_overlay,
+)
+
+
+def legacy_render(vid_frame, xy):
+    """The float32 + NORM_MINMAX rendering that render_gaze_overlay replaced."""
+    img_original = vid_frame.to_ndarray(format="rgb24")
+    frame = cv2.cvtColor(img_original, cv2.COLOR_RGB2BGR)
+    frame = np.asarray(frame, dtype=np.float32)
+    if not np.isnan(xy).any():
+        cv2.circle(
+            frame,
+            np.asarray(xy, dtype=np.int32),
+            OVERLAY_PARAMS["radius"],
+            OVERLAY_PARAMS["color_bgr"],
+            OVERLAY_PARAMS["thickness"],
+        )
+    out_ = cv2.normalize(frame, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+    cv2.cvtColor(out_, cv2.COLOR_BGR2RGB, out_)
+    return av.VideoFrame.from_ndarray(out_, format="rgb24")
+
+
+def inplace_render(vid_frame, xy):
+    out_ = render_gaze_overlay(vid_frame, xy)
+    return av.VideoFrame.from_ndarray(out_, format="bgr24")
+
+
+def measure_fps(video_path, render):
+    with av.open(str(video_path)) as container:
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        xy = np.array([stream.width / 2, stream.height / 2])
+        num_frames = 0
+        t0 = time.perf_counter()
+        for vid_frame in container.decode(stream):
+            render(vid_frame, xy)
+            num_frames += 1
+        return num_frames / (time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--width", type=int, default=1088)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--video", type=Path, help="use this video instead")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        video_path = args.video or make_scene_video(
+            Path(tmp_dir) / "scene.mp4", args.frames, args.width, args.height
+        )
+        # Warm up the file cache so both variants read from memory
+        measure_fps(video_path, lambda frame, xy: None)
+        decode_fps = measure_fps(video_path, lambda frame, xy: None)
+        before = measure_fps(video_path, legacy_render)
+        after = measure_fps(video_path, inplace_render)
+
+    print(f"decode only:          {decode_fps:8.1f} fps")
+    print(f"float32 + normalize:  {before:8.1f} fps")
+    print(f"uint8 in place:       {after:8.1f} fps ({after / before:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""
+End-to-end timings of the stages of run_modules on a synthetic recording,
+against local stand-ins for the OpenAI chat completions endpoint and the
+Pupil Cloud export and events endpoints: wall and CPU time, frames/s and
+requests/s of every stage and the peak resident memory while it runs, plus
+the sub-stages recorded in run_metrics.json.
+
+    python benchmarks/bench_pipeline.py --duration 60 --latency 0.5 \\
+        --rate-limit-every 25 --json pipeline.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import resource
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import pandas as pd
+from stand_ins import ChatCompletions, PupilCloud, StandInServer
+from synthetic import make_export_zip, make_recording
+
+from pupil_labs.automate_custom_events import (
+    cloud_interaction,
+    frame_processor,
+    video_utils,
+)
+from pupil_labs.automate_custom_events.control_modules import (
+    detect_events,
+    fetch_recording,
+    prepare_frames,
+)
+from pupil_labs.automate_custom_events.run_metrics import RunMetrics
+
+RECORDING_ID = "4e5f6a7b-0000-4000-8000-000000000000"
+WORKSPACE_ID = "0a1b2c3d-0000-4000-8000-000000000000"
+
+
+def current_rss():
+    """Resident memory of the process in bytes."""
+    try:
+        with open("/proc/self/statm") as fd:
+            return int(fd.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # The peak so far, in kB on Linux and in bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if os.uname().sysname == "Darwin" else maxrss * 1024
+
+
+class PeakRSS:
+    """Samples the resident memory while a block runs."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+@contextlib.contextmanager
+def timed_stage(rows, name):
+    """Adds a row with the wall and process CPU time and peak RSS of a block.
+    The block fills in the frames and requests it handled."""
+    row = {"stage": name, "frames": None, "requests": None, "MB": None}
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    with PeakRSS() as rss:
+        yield row
+    row["wall [s]"] = time.perf_counter() - started
+    row["cpu [s]"] = time.process_time() - cpu_started
+    row["peak RSS [MB]"] = rss.peak / 1e6
+    rows.append(row)
+
+
+async def query(cache, prepared, args, metrics):
+    base64_frames, frame_metadata, frame_signatures, _ = prepared
+    # FrameProcessor prints every response
+    with contextlib.redirect_stdout(io.StringIO()):
+        return await detect_events(
+            cache,
+            base64_frames,
+            frame_metadata,
+            frame_signatures,
+            # A key of its own gives the run a fresh shared rate limiter
+            f"openai-key-{time.monotonic()}",
+            WORKSPACE_ID,
+            "cloud-key",
+            "reading a book",
+            "reading_book",
+            args.batch_size,
+            None,
+            None,
+            query_concurrency=args.concurrency,
+            frames_per_request=args.frames_per_request,
+            use_response_cache=False,
+            search_strategy=args.search_strategy,
+            metrics=metrics,
+        )
+
+
+def run(args, tmp):
+    recording = make_recording(
+        tmp / "export",
+        RECORDING_ID,
+        args.duration,
+        args.width,
+        args.height,
+        args.rate,
+        args.gaze_rate,
+    )
+    export_zip = make_export_zip(recording, tmp / "export.zip", RECORDING_ID)
+    num_frames = int(args.duration * args.rate)
+    chat = ChatCompletions(
+        activity_start=int(num_frames * args.activity_start),
+        latency=args.latency,
+        jitter=args.jitter,
+        rate_limit_every=args.rate_limit_every,
+    )
+    cloud = PupilCloud(export_zip, event_latency=args.event_latency)
+    metrics = RunMetrics(RECORDING_ID)
+    rows = []
+
+    with StandInServer(chat, cloud) as server:
+        cloud_interaction.API_URL = server.api_url
+        frame_processor.OPENAI_URL = server.openai_url
+
+        with timed_stage(rows, "download") as row:
+            cache = fetch_recording(
+                RECORDING_ID, WORKSPACE_ID, "cloud-key", tmp / "downloads", metrics
+            )
+            row["frames"] = num_frames
+            row["MB"] = export_zip.stat().st_size / 1e6
+
+        with timed_stage(rows, "prepare") as row:
+            prepared = prepare_frames(
+                cache,
+                None,
+                None,
+                lazy_frames=args.lazy,
+                stream_frames=False,
+                metrics=metrics,
+            )
+            row["frames"] = len(prepared[0])
+
+        with timed_stage(rows, "query") as row:
+            events = asyncio.run(query(cache, prepared, args, metrics))
+            row["frames"] = chat.frames
+            row["requests"] = chat.requests
+
+    for row in rows:
+        row["frames/s"] = row["frames"] / row["wall [s]"]
+        if row["requests"] is not None:
+            row["requests/s"] = row["requests"] / row["wall [s]"]
+        if row["MB"] is not None:
+            row["MB/s"] = row["MB"] / row["wall [s]"]
+    report = metrics.report()
+    summary = {
+        "events": len(events),
+        "events posted": len(cloud.events),
+        "429s": chat.rate_limited,
+        "analysed frames": chat.frames,
+        "recording frames": num_frames,
+    }
+    return rows, report, summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds")
+    parser.add_argument("--width", type=int, default=1088)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--rate", type=int, default=30, help="scene frames/s")
+    parser.add_argument("--gaze-rate", type=int, default=200, help="gaze samples/s")
+    parser.add_argument("--latency", type=float, default=0.5, help="chat latency")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument(
+        "--rate-limit-every", type=int, help="answer every n-th request with a 429"
+    )
+    parser.add_argument("--event-latency", type=float, default=0.05)
+    parser.add_argument(
+        "--activity-start",
+        type=float,
+        default=0.3,
+        help="share of the recording before the activity starts",
+    )
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--frames-per-request", type=int, default=1)
+    parser.add_argument(
+        "--search-strategy",
+        choices=frame_processor.SEARCH_STRATEGIES,
+        default="binary",
+    )
+    parser.add_argument(
+        "--lazy", action="store_true", help="encode frames when they are queried"
+    )
+    parser.add_argument("--json", type=Path, help="also write the results here")
+    args = parser.parse_args()
+    logging.getLogger().handlers = []
+    logging.disable(logging.WARNING)
+    video_utils.SHOW_PROGRESS = False
+
+    with tempfile.TemporaryDirectory() as tmp:
+        rows, report, summary = run(args, Path(tmp))
+
+    columns = [
+        "stage",
+        "wall [s]",
+        "cpu [s]",
+        "frames",
+        "frames/s",
+        "requests",
+        "requests/s",
+        "MB/s",
+        "peak RSS [MB]",
+    ]
+    print(
+        pd.DataFrame(rows, columns=columns).to_string(
+            index=False, float_format="{:.2f}".format, na_rep="-"
+        )
+    )
+    print()
+    print(
+        pd.DataFrame(report["stages"])
+        .T.astype({"calls": int})
+        .rename_axis("sub-stage")
+        .to_string(float_format="{:.2f}".format, na_rep="-")
+    )
+    print()
+    latency = report["histograms"].get("openai_request_latency_seconds")
+    if latency:
+        print(
+            f"OpenAI latency p50 {latency['p50']:.2f}s, p90 {latency['p90']:.2f}s, "
+            f"p99 {latency['p99']:.2f}s"
+        )
+    print(", ".join(f"{value} {name}" for name, value in summary.items()))
+    if args.json:
+        args.json.write_text(
+            json.dumps(
+                {
+                    "config": vars(args) | {"json": str(args.json)},
+                    "stages": rows,
+                    "summary": summary,
+                    "run_metrics": report,
+                },
+                indent=2,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Time to the first request, the first event and the end of the search when
+all frames are rendered and encoded before the search starts, and when they
+are encoded on a worker thread while the search already queries the first
+ones (StreamingFrames), against a local stand-in for the chat completions
+endpoint.
+
+    python benchmarks/bench_streaming_frames.py --frames 900 --width 1088 --height 1080
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+import av
+import numpy as np
+import pandas as pd
+from aiohttp import web
+from synthetic import make_scene_video
+
+from pupil_labs.automate_custom_events import frame_processor, video_utils
+from pupil_labs.automate_custom_events.frame_processor import FrameProcessor
+from pupil_labs.automate_custom_events.rate_limiter import RateLimiter
+from pupil_labs.automate_custom_events.video_utils import (
+    StreamingFrames,
+    create_gaze_overlay_frames,
+    frame_metadata_for_pts,
+)
+
+
+class TimedPublisher:
+    def __init__(self, started):
+        self.started = started
+        self.first_event = None
+
+    def publish(self, keyword, ts):
+        if self.first_event is None:
+            self.first_event = time.perf_counter() - self.started
+        return True
+
+
+class StandIn:
+    def __init__(self, started, activity_start, latency):
+        self.started = started
+        self.activity_start = activity_start
+        self.latency = latency
+        self.first_request = None
+
+    async def chat_completions(self, request):
+        if self.first_request is None:
+            self.first_request = time.perf_counter() - self.started
+        body = await request.json()
+        rows = json.loads(body["messages"][2]["content"].split(": ", 1)[1])
+        content = "\n".join(
+            f"Frame {row['frame']}: Timestamp - {row['timestamp [s]']}, "
+            "Code - reading_book"
+            for row in rows
+            if row["frame"] >= self.activity_start
+        )
+        await asyncio.sleep(self.latency)
+        return web.json_response({"choices": [{"message": {"content": content}}]})
+
+
+def make_merged(video_path):
+    with av.open(str(video_path)) as container:
+        pts = sorted(p.pts for p in container.demux(video=0) if p.pts is not None)
+    ts = pd.Series(np.arange(len(pts), dtype=np.uint64) * 33_333_333)
+    merged = pd.DataFrame(
+        {
+            "pts": pts,
+            "timestamp [ns]": ts,
+            "gaze x [px]": np.linspace(0, 1000, len(pts)),
+            "gaze y [px]": 500.0,
+        }
+    )
+    return merged, ts
+
+
+async def run(video_path, merged, ts, streaming, batch_size, latency):
+    started = time.perf_counter()
+    stand_in = StandIn(started, int(len(merged) * 0.1), latency)
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", stand_in.chat_completions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    frame_processor.OPENAI_URL = f"http://127.0.0.1:{port}/v1/chat/completions"
+
+    def encode(frames=None):
+        return create_gaze_overlay_frames(merged, video_path, ts, frames=frames)
+
+    if streaming:
+        base64_frames = StreamingFrames(len(merged), encode)
+        metadata = frame_metadata_for_pts(video_path, merged["pts"])
+    else:
+        # Encoding blocks like it does in run_modules
+        base64_frames, metadata = encode()
+    processor = FrameProcessor(
+        base64_frames,
+        metadata,
+        "openai-key",
+        "cloud-token",
+        "recording",
+        "workspace",
+        "reading a book",
+        "reading_book",
+        batch_size,
+        0,
+        None,
+        rate_limiter=RateLimiter(8),
+    )
+    processor.event_publisher = publisher = TimedPublisher(started)
+    async with aiohttp.ClientSession() as session:
+        await processor.process_batches(session, batch_size)
+    if streaming:
+        base64_frames.close()
+    elapsed = time.perf_counter() - started
+    await runner.cleanup()
+    return {
+        "mode": "streaming" if streaming else "encode first",
+        "first request [s]": stand_in.first_request,
+        "first event [s]": publisher.first_event,
+        "done [s]": elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--frames", type=int, default=900)
+    parser.add_argument("--width", type=int, default=1088)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--batch-size", type=int, default=60)
+    parser.add_argument("--latency", type=float, default=0.5)
+    args = parser.parse_args()
+    logging.getLogger().handlers = []
+    logging.disable(logging.WARNING)
+    video_utils.SHOW_PROGRESS = False
+
+    with tempfile.TemporaryDirectory() as tmp:
+        video_path = make_scene_video(
+            Path(tmp) / "scene.mp4", args.frames, args.width, args.height
+        )
+        merged, ts = make_merged(video_path)
+        # FrameProcessor prints every response
+        with contextlib.redirect_stdout(io.StringIO()):
+            rows = [
+                asyncio.run(
+                    run(
+                        video_path,
+                        merged,
+                        ts,
+                        streaming,
+                        args.batch_size,
+                        args.latency,
+                    )
+                )
+                for streaming in (False, True)
+            ]
+    print(pd.DataFrame(rows).to_string(index=False, float_format="{:.2f}".format))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Local stand-ins for the OpenAI chat completions endpoint and the Pupil Cloud
+raw data export and events endpoints, for the benchmarks.
+
+The servers run on their own event loop in a background thread, because
+the pipeline downloads recordings with blocking requests calls.
+"""
+
+import asyncio
+import json
+import random
+import threading
+
+from aiohttp import web
+
+from pupil_labs.automate_custom_events.frame_processor import IMAGE_TOKENS
+
+
+class ChatCompletions:
+    """
+    Answers chat requests after a configurable latency. Every frame from
+    activity_start on is reported as showing the activity.
+
+    :param latency: seconds before a response.
+    :param jitter: the latency varies by up to this share either way.
+    :param rate_limit_every: answer every n-th request with a 429 and a
+        retry-after of retry_after_ms.
+    """
+
+    def __init__(
+        self,
+        activity_start=0,
+        code="reading_book",
+        latency=0.5,
+        jitter=0.0,
+        rate_limit_every=None,
+        retry_after_ms=200,
+        seed=0,
+    ):
+        self.activity_start = activity_start
+        self.code = code
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_every = rate_limit_every
+        self.retry_after_ms = retry_after_ms
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.rate_limited = 0
+        self.frames = 0
+
+    async def handle(self, request):
+        self.requests += 1
+        if self.rate_limit_every and self.requests % self.rate_limit_every == 0:
+            self.rate_limited += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "code": "rate_limit"}},
+                status=429,
+                headers={"retry-after-ms": str(self.retry_after_ms)},
+            )
+        body = await request.json()
+        text = "".join(
+            m["content"] for m in body["messages"] if isinstance(m["content"], str)
+        )
+        images = sum(
+            len(m["content"])
+            for m in body["messages"]
+            if isinstance(m["content"], list)
+        )
+        self.frames += images
+        rows = json.loads(body["messages"][2]["content"].split(": ", 1)[1])
+        content = "\n".join(
+            f"Frame {row['frame']}: Timestamp - {row['timestamp [s]']}, "
+            f"Code - {self.code}"
+            for row in rows
+            if row["frame"] >= self.activity_start
+        )
+        latency = self.latency * (1 + self.jitter * self.random.uniform(-1, 1))
+        await asyncio.sleep(latency)
+        return web.json_response(
+            {
+                "choices": [{"message": {"content": content}}],
+                "usage": {
+                    "prompt_tokens": len(text) // 4 + IMAGE_TOKENS * images,
+                    "completion_tokens": len(content) // 4,
+                },
+            }
+        )
+
+
+class PupilCloud:
+    """
+    Serves a zip file as the raw data export of every recording, with Range
+    support, and accepts events.
+
+    :param event_latency: seconds before an event post is answered.
+    """
+
+    def __init__(self, export_zip, event_latency=0.05):
+        self.export_zip = export_zip
+        self.event_latency = event_latency
+        self.exports = 0
+        self.events = []
+
+    async def raw_data_export(self, request):
+        self.exports += 1
+        return web.FileResponse(
+            self.export_zip, headers={"Content-Type": "application/zip"}
+        )
+
+    async def post_event(self, request):
+        self.events.append(await request.json())
+        await asyncio.sleep(self.event_latency)
+        return web.json_response({})
+
+
+class StandInServer:
+    """
+    Serves the stand-ins on a free local port from a background thread.
+    openai_url and api_url are the URLs to patch into the pipeline.
+    """
+
+    def __init__(self, chat=None, cloud=None):
+        self.app = web.Application(client_max_size=256 * 1024 * 1024)
+        if chat is not None:
+            self.app.router.add_post("/v1/chat/completions", chat.handle)
+        if cloud is not None:
+            self.app.router.add_get(
+                "/v2/workspaces/{workspace}/recordings:raw-data-export",
+                cloud.raw_data_export,
+            )
+            self.app.router.add_post(
+                "/v2/workspaces/{workspace}/recordings/{recording}/events",
+                cloud.post_event,
+            )
+        self.port = None
+        self._loop = asyncio.new_event_loop()
+        self._runner = web.AppRunner(self.app, access_log=None)
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+
+    async def _start(self):
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        return site._server.sockets[0].getsockname()[1]
+
+    def __enter__(self):
+        self._thread.start()
+        self.port = asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+        return self
+
+    def __exit__(self, *exc_info):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    @property
+    def openai_url(self):
+        return f"http://127.0.0.1:{self.port}/v1/chat/completions"
+
+    @property
+    def api_url(self):
+        return f"http://127.0.0.1:{self.port}/v2"
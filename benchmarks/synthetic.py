@@ -0,0 +1,127 @@
+"""Synthetic inputs for the benchmarks."""
+
+import json
+import zipfile
+from fractions import Fraction
+from pathlib import Path
+
+import av
+import numpy as np
+import pandas as pd
+
+
+def make_scene_video(
+    path, num_frames=300, width=1088, height=1080, rate=30, keyframe_interval=30
+):
+    """
+    Writes an H.264 video with a moving gradient, so that the encoder has
+    realistic work to do on every frame.
+    """
+    yy, xx = np.mgrid[0:height, 0:width]
+    with av.open(str(path), "w") as container:
+        stream = container.add_stream(
+            "libx264", rate=rate, options={"g": str(keyframe_interval)}
+        )
+        stream.width, stream.height = width, height
+        stream.pix_fmt = "yuv420p"
+        stream.codec_context.time_base = Fraction(1, rate)
+        for i in range(num_frames):
+            img = np.empty((height, width, 3), np.uint8)
+            img[..., 0] = (xx + 4 * i) % 256
+            img[..., 1] = (yy + 2 * i) % 256
+            img[..., 2] = (xx + yy) % 256
+            frame = av.VideoFrame.from_ndarray(img, format="rgb24")
+            frame.pts = i
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+    return path
+
+
+# Start of the synthetic recordings on the UTC clock of the Companion device
+RECORDING_START_NS = 1_700_000_000_000_000_000
+
+
+def make_recording(
+    folder,
+    recording_id="4e5f6a7b-0000-4000-8000-000000000000",
+    duration_s=20.0,
+    width=1088,
+    height=1080,
+    rate=30,
+    gaze_rate=200,
+):
+    """
+    Writes a recording in the layout of the Pupil Cloud raw data export: the
+    scene video, gaze.csv, world_timestamps.csv and the smaller files the
+    pipeline does not read. The gaze circles around the image centre.
+    :return: the folder.
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    num_frames = max(int(duration_s * rate), 1)
+    make_scene_video(
+        folder / f"{recording_id[:8]}_0.0-{duration_s:.3f}.mp4",
+        num_frames,
+        width,
+        height,
+        rate,
+    )
+
+    world_ts = RECORDING_START_NS + np.arange(num_frames, dtype=np.uint64) * int(
+        1e9 / rate
+    )
+    ids = {"section id": recording_id, "recording id": recording_id}
+    pd.DataFrame({**ids, "timestamp [ns]": world_ts}).to_csv(
+        folder / "world_timestamps.csv", index=False
+    )
+
+    num_samples = max(int(duration_s * gaze_rate), 1)
+    gaze_ts = RECORDING_START_NS + np.arange(num_samples, dtype=np.uint64) * int(
+        1e9 / gaze_rate
+    )
+    angle = np.linspace(0, 4 * np.pi, num_samples)
+    radius = min(width, height) / 3
+    pd.DataFrame(
+        {
+            **ids,
+            "timestamp [ns]": gaze_ts,
+            "gaze x [px]": width / 2 + radius * np.cos(angle),
+            "gaze y [px]": height / 2 + radius * np.sin(angle),
+            "worn": 1,
+            "fixation id": None,
+            "blink id": None,
+            "azimuth [deg]": 0.0,
+            "elevation [deg]": 0.0,
+        }
+    ).to_csv(folder / "gaze.csv", index=False)
+
+    pd.DataFrame(
+        {
+            **ids,
+            "timestamp [ns]": [world_ts[0], world_ts[-1]],
+            "name": ["recording.begin", "recording.end"],
+            "type": "recording",
+        }
+    ).to_csv(folder / "events.csv", index=False)
+    (folder / "info.json").write_text(
+        json.dumps(
+            {
+                "recording_id": recording_id,
+                "start_time": RECORDING_START_NS,
+                "duration": int(duration_s * 1e9),
+            }
+        )
+    )
+    return folder
+
+
+def make_export_zip(recording_folder, path, recording_id):
+    """Zips a recording folder like the raw data export of Pupil Cloud, with
+    the files in a dated folder."""
+    prefix = f"2024-01-01_00-00-00-{recording_id[:8]}"
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as zf:
+        for file in sorted(Path(recording_folder).iterdir()):
+            zf.write(file, f"{prefix}/{file.name}")
+    return path
@@ -9,23 +9,9 @@ import logging
 import re
 from pupil_labs.automate_custom_events.tk_utils import TTKFormLayoutHelper
 from pupil_labs.automate_custom_events.control_modules import run_modules
+from pupil_labs.automate_custom_events.cloud_interaction import extract_ids
 
 
-def extract_ids(url):
-    # Use regex to extract the workspace ID and recording ID
-    workspace_pattern = r"workspaces/([a-f0-9\-]+)/"
-    recording_pattern = r"id=([a-f0-9\-]+)&"
-
-    # Find matches using regex
-    workspace_match = re.search(workspace_pattern, url)
-    recording_match = re.search(recording_pattern, url)
-
-    # Extract the values if they exist
-    workspace_id = workspace_match.group(1) if workspace_match else None
-    recording_id = recording_match.group(1) if recording_match else None
-
-    return workspace_id, recording_id
-
 # Create GUI handler for the GUI console
 class TextHandler(logging.Handler):
     def __init__(self, text_widget):
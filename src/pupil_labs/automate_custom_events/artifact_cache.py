@@ -0,0 +1,231 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import time
+from pathlib import Path
+from typing import Iterable, List, Optional, Union
+
+import numpy as np
+
+from pupil_labs.automate_custom_events.response_cache import RESPONSE_CACHE_NAME
+
+MANIFEST_NAME = "cache_manifest.json"
+
+# Inputs up to this size are fingerprinted by content, larger ones (the videos)
+# by size and modification time.
+CONTENT_HASH_MAX_BYTES = 64 * 1024 * 1024
+
+ENCODED_FRAMES_NAME = "encoded_frames.b64"
+ENCODED_FRAMES_INDEX_NAME = "encoded_frames_index.npy"
+FRAME_SIGNATURES_NAME = "frame_signatures.npz"
+
+
+def fingerprint(path: Union[str, Path]) -> str:
+    path = Path(path)
+    stat = path.stat()
+    if stat.st_size <= CONTENT_HASH_MAX_BYTES:
+        digest = hashlib.sha256()
+        with path.open("rb") as fd:
+            while chunk := fd.read(1024 * 1024):
+                digest.update(chunk)
+        return f"sha256:{digest.hexdigest()}"
+    return f"stat:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class ArtifactCache:
+    """
+    Manifest of the artifacts run_modules produced for one recording.
+
+    Every stage is stored under a key derived from the recording ID, the stage
+    parameters and the fingerprints of its input files. A stage can be skipped
+    when its key matches and its outputs are still on disk unchanged. Because
+    the outputs of one stage are the inputs of the next, rebuilding a stage
+    invalidates everything downstream of it.
+    """
+
+    def __init__(self, rec_path: Union[str, Path], recording_id: str):
+        self.rec_path = Path(rec_path)
+        self.recording_id = recording_id
+        self.manifest_path = self.rec_path / MANIFEST_NAME
+        self.manifest = self._load()
+
+    def _load(self) -> dict:
+        try:
+            manifest = json.loads(self.manifest_path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {"recording_id": self.recording_id, "stages": {}}
+        if manifest.get("recording_id") != self.recording_id:
+            return {"recording_id": self.recording_id, "stages": {}}
+        return manifest
+
+    def _save(self) -> None:
+        self.rec_path.mkdir(parents=True, exist_ok=True)
+        self.manifest["last_used"] = time.time()
+        tmp_path = self.manifest_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self.manifest, indent=2))
+        os.replace(tmp_path, self.manifest_path)
+
+    def key(
+        self, stage: str, params: Optional[dict] = None, inputs: Iterable[Path] = ()
+    ) -> str:
+        description = {
+            "recording_id": self.recording_id,
+            "stage": stage,
+            "params": params or {},
+            "inputs": {Path(p).name: fingerprint(p) for p in inputs},
+        }
+        blob = json.dumps(description, sort_keys=True, default=str)
+        return hashlib.sha256(blob.encode()).hexdigest()
+
+    def is_valid(self, stage: str, key: str) -> bool:
+        entry = self.manifest["stages"].get(stage)
+        if entry is None or entry["key"] != key:
+            return False
+        for name, size in entry["outputs"].items():
+            path = self.rec_path / name
+            if not path.exists() or path.stat().st_size != size:
+                return False
+        logging.info(f"Reusing cached {stage} artifacts")
+        return True
+
+    def outputs(self, stage: str) -> List[Path]:
+        return [
+            self.rec_path / name for name in self.manifest["stages"][stage]["outputs"]
+        ]
+
+    def store(self, stage: str, key: str, outputs: Iterable[Path]) -> None:
+        self.manifest["stages"][stage] = {
+            "key": key,
+            "outputs": {
+                Path(p).relative_to(self.rec_path).as_posix(): Path(p).stat().st_size
+                for p in outputs
+            },
+            "created": time.time(),
+        }
+        self._save()
+
+    def invalidate(self, stage: str) -> None:
+        """Forgets a stage, e.g. because another one overwrote its outputs."""
+        if self.manifest["stages"].pop(stage, None) is not None:
+            self._save()
+
+    def touch(self) -> None:
+        """Marks the recording as used now, for eviction purposes."""
+        self._save()
+
+
+def _artifact_files(rec_path: Path, manifest: dict) -> List[Path]:
+    """The stage outputs and response cache of a recording that exist."""
+    names = {
+        name
+        for entry in manifest.get("stages", {}).values()
+        for name in entry.get("outputs", {})
+    }
+    # SQLite keeps a journal next to the database while it is written
+    names.update(
+        RESPONSE_CACHE_NAME + suffix for suffix in ("", "-journal", "-wal", "-shm")
+    )
+    paths = (rec_path / name for name in sorted(names))
+    return [path for path in paths if path.is_file()]
+
+
+def _remove_empty_dirs(path: Path, stop: Path) -> None:
+    while path != stop and path.is_dir() and not any(path.iterdir()):
+        path.rmdir()
+        path = path.parent
+
+
+def evict_recordings(
+    download_path: Union[str, Path], max_bytes: int, keep: Iterable[str] = ()
+) -> List[Path]:
+    """
+    Deletes the cached artifacts of the least recently used recordings under
+    download_path until the artifacts take at most max_bytes. Only folders
+    with a cache manifest are considered. The artifacts are the outputs of the
+    stages in the manifest and the response cache; the results of the runs,
+    such as custom_events.csv and run_metrics.json, are kept and not counted.
+    :param keep: recording IDs that must not be evicted, e.g. the current one.
+    :return: the folders whose artifacts were deleted.
+    """
+    keep = set(keep)
+    entries = []
+    for manifest_path in Path(download_path).glob(f"*/{MANIFEST_NAME}"):
+        rec_path = manifest_path.parent
+        try:
+            manifest = json.loads(manifest_path.read_text())
+        except json.JSONDecodeError:
+            manifest = {}
+        files = _artifact_files(rec_path, manifest)
+        size = sum(path.stat().st_size for path in files)
+        entries.append((manifest.get("last_used", 0), rec_path, files, size))
+
+    total = sum(size for *_, size in entries)
+    evicted = []
+    for _, rec_path, files, size in sorted(entries, key=lambda e: e[0]):
+        if total <= max_bytes:
+            break
+        if rec_path.name in keep or not files:
+            continue
+        logging.info(f"Evicting cached recording {rec_path.name} ({size / 1e6:.1f} MB)")
+        for path in files:
+            path.unlink(missing_ok=True)
+            _remove_empty_dirs(path.parent, rec_path)
+        # Without its artifacts the manifest describes nothing
+        (rec_path / MANIFEST_NAME).unlink(missing_ok=True)
+        _remove_empty_dirs(rec_path, rec_path.parent)
+        total -= size
+        evicted.append(rec_path)
+    return evicted
+
+
+def save_encoded_frames(rec_path: Union[str, Path], base64_frames) -> List[Path]:
+    """
+    Writes base64 encoded frames as one line each, plus an index of the line
+    offsets so single frames can be read back without loading the whole file.
+    """
+    rec_path = Path(rec_path)
+    frames_path = rec_path / ENCODED_FRAMES_NAME
+    index_path = rec_path / ENCODED_FRAMES_INDEX_NAME
+    offsets = np.zeros(len(base64_frames) + 1, dtype=np.uint64)
+    with frames_path.open("wb") as fd:
+        for i, frame in enumerate(base64_frames):
+            data = frame.encode("ascii")
+            fd.write(data)
+            fd.write(b"\n")
+            offsets[i + 1] = offsets[i] + len(data) + 1
+    np.save(index_path, offsets)
+    return [frames_path, index_path]
+
+
+class EncodedFrameFile:
+    """
+    Read-only sequence of the base64 frames written by save_encoded_frames,
+    memory mapped so that only the frames that are accessed are read.
+    """
+
+    def __init__(self, rec_path: Union[str, Path]):
+        rec_path = Path(rec_path)
+        self.offsets = np.load(rec_path / ENCODED_FRAMES_INDEX_NAME)
+        self._fd = (rec_path / ENCODED_FRAMES_NAME).open("rb")
+        size = int(self.offsets[-1])
+        self._data: Union[mmap.mmap, bytes] = (
+            mmap.mmap(self._fd.fileno(), size, access=mmap.ACCESS_READ) if size else b""
+        )
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        start, end = int(self.offsets[index]), int(self.offsets[index + 1]) - 1
+        return self._data[start:end].decode("ascii")
+
+    def close(self) -> None:
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._fd.close()
@@ -0,0 +1,216 @@
+import asyncio
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+OPENAI_API_URL = "https://api.openai.com/v1"
+CHAT_ENDPOINT = "/v1/chat/completions"
+
+# Limits of a single batch input file
+MAX_BATCH_REQUESTS = 50_000
+MAX_BATCH_BYTES = 200 * 1024 * 1024
+
+# Batches are billed at half the price of live requests
+BATCH_PRICE_FACTOR = 0.5
+
+# How long OpenAI may take for a batch, and seconds between status checks
+COMPLETION_WINDOW = "24h"
+POLL_INTERVAL = 30.0
+
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+class BatchError(Exception):
+    pass
+
+
+def batch_lines(requests: Dict[str, dict]) -> Dict[str, str]:
+    """
+    The lines of a batch input file for chat requests, by custom id.
+
+    >>> line = json.loads(batch_lines({"7": {"model": "gpt-4o"}})["7"])
+    >>> line["custom_id"], line["url"], line["body"]
+    ('7', '/v1/chat/completions', {'model': 'gpt-4o'})
+    """
+    return {
+        custom_id: json.dumps(
+            {
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": CHAT_ENDPOINT,
+                "body": body,
+            }
+        )
+        for custom_id, body in requests.items()
+    }
+
+
+def split_batches(lines: Dict[str, str]) -> List[Dict[str, str]]:
+    """Splits input lines into files within the request and size limits."""
+    batches: List[Dict[str, str]] = []
+    size = 0
+    for custom_id, line in lines.items():
+        line_size = len(line.encode()) + 1
+        if (
+            not batches
+            or len(batches[-1]) >= MAX_BATCH_REQUESTS
+            or size + line_size > MAX_BATCH_BYTES
+        ):
+            batches.append({})
+            size = 0
+        batches[-1][custom_id] = line
+        size += line_size
+    return batches
+
+
+def parse_output_line(line: str) -> Tuple[str, Optional[dict], Optional[str]]:
+    """
+    Reads a line of a batch output or error file.
+    :return: the custom id, the response body if the request succeeded and
+        otherwise the reason it failed.
+    """
+    result = json.loads(line)
+    response = result.get("response") or {}
+    status = response.get("status_code")
+    if status == 200 and not result.get("error"):
+        return result["custom_id"], response.get("body"), None
+    error = result.get("error") or (response.get("body") or {}).get("error") or {}
+    reason = error.get("message") or error.get("code") or f"HTTP {status}"
+    return result["custom_id"], None, f"batch request failed: {reason}"
+
+
+class BatchClient:
+    """
+    Runs chat requests through the OpenAI Batch API: writes them to a JSONL
+    input file, uploads and submits it, polls the batch until it is done and
+    reads the responses back from its output and error files.
+    """
+
+    def __init__(
+        self,
+        openai_api_key: str,
+        work_dir: Union[str, Path, None] = None,
+        api_url: Optional[str] = None,
+        completion_window: str = COMPLETION_WINDOW,
+        poll_interval: float = POLL_INTERVAL,
+    ):
+        self.openai_api_key = openai_api_key
+        self.work_dir = Path(work_dir) if work_dir is not None else None
+        self.api_url = api_url or OPENAI_API_URL
+        self.completion_window = completion_window
+        self.poll_interval = poll_interval
+        self.num_batches = 0
+
+    @property
+    def headers(self):
+        return {"Authorization": f"Bearer {self.openai_api_key}"}
+
+    async def _json(self, session, method, path, **kwargs):
+        async with session.request(
+            method, f"{self.api_url}{path}", headers=self.headers, **kwargs
+        ) as response:
+            if response.status != 200:
+                raise BatchError(
+                    f"{method} {path}: HTTP {response.status} {await response.text()}"
+                )
+            return await response.json()
+
+    async def _file_lines(self, session, file_id):
+        if not file_id:
+            return []
+        async with session.get(
+            f"{self.api_url}/files/{file_id}/content", headers=self.headers
+        ) as response:
+            if response.status != 200:
+                raise BatchError(f"Downloading {file_id}: HTTP {response.status}")
+            text = await response.text()
+        return [line for line in text.splitlines() if line.strip()]
+
+    async def submit(self, session, lines: List[str]) -> str:
+        """Uploads an input file and creates a batch of it.
+        :return: the batch id."""
+        data = ("\n".join(lines) + "\n").encode()
+        self.num_batches += 1
+        filename = f"batch_input_{self.num_batches:03d}.jsonl"
+        if self.work_dir is not None:
+            self.work_dir.mkdir(parents=True, exist_ok=True)
+            (self.work_dir / filename).write_bytes(data)
+        form = aiohttp.FormData()
+        form.add_field("purpose", "batch")
+        form.add_field(
+            "file", data, filename=filename, content_type="application/jsonl"
+        )
+        uploaded = await self._json(session, "POST", "/files", data=form)
+        batch = await self._json(
+            session,
+            "POST",
+            "/batches",
+            json={
+                "input_file_id": uploaded["id"],
+                "endpoint": CHAT_ENDPOINT,
+                "completion_window": self.completion_window,
+            },
+        )
+        logger.info(f"Submitted batch {batch['id']} of {len(lines)} requests")
+        return batch["id"]
+
+    async def wait(self, session, batch_id: str) -> dict:
+        """Polls a batch until it is completed, failed, expired or cancelled."""
+        started = time.monotonic()
+        while True:
+            batch = await self._json(session, "GET", f"/batches/{batch_id}")
+            if batch["status"] in TERMINAL_STATUSES:
+                break
+            counts = batch.get("request_counts") or {}
+            logger.debug(
+                f"Batch {batch_id} {batch['status']}: "
+                f"{counts.get('completed', 0)}/{counts.get('total', '?')} done"
+            )
+            await asyncio.sleep(self.poll_interval)
+        logger.info(
+            f"Batch {batch_id} {batch['status']} after "
+            f"{time.monotonic() - started:.0f}s"
+        )
+        return batch
+
+    async def _run_batch(self, session, lines):
+        results = {}
+        try:
+            batch_id = await self.submit(session, list(lines.values()))
+            batch = await self.wait(session, batch_id)
+            for file_id in (batch.get("output_file_id"), batch.get("error_file_id")):
+                for line in await self._file_lines(session, file_id):
+                    custom_id, body, reason = parse_output_line(line)
+                    results[custom_id] = (body, reason)
+            # Requests of expired or cancelled batches have no output line
+            missing = f"batch {batch['status']}"
+        except (BatchError, aiohttp.ClientError) as e:
+            logger.warning(f"Batch of {len(lines)} requests failed: {e}")
+            missing = f"{type(e).__name__}: {e}"
+        for custom_id in lines:
+            results.setdefault(custom_id, (None, missing))
+        return results
+
+    async def run(
+        self, session, requests: Dict[str, dict]
+    ) -> Dict[str, Tuple[Optional[dict], Optional[str]]]:
+        """
+        Runs chat requests by custom id as one or more batches.
+        :return: (response body, None) or (None, reason of the failure) by
+            custom id.
+        """
+        if not requests:
+            return {}
+        batches = split_batches(batch_lines(requests))
+        results = {}
+        for batch_results in await asyncio.gather(
+            *(self._run_batch(session, lines) for lines in batches)
+        ):
+            results.update(batch_results)
+        return results
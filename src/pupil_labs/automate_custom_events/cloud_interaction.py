@@ -1,58 +1,411 @@
 import requests
-import json
+import aiohttp
+import asyncio
 import logging
-import shutil
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Iterator, Optional, Sequence, Union
+from pupil_labs.automate_custom_events.zip_utils import extract_zip_stream
 
 API_URL = "https://api.cloud.pupil-labs.com/v2"
 
+# Read/write buffer for streamed downloads. Large enough that Python-level
+# overhead per chunk is negligible next to the network and disk I/O.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
 
-def download_url(path: str, save_path: str, API_KEY, chunk_size=128) -> None:
+# Files of the raw data export that the annotation pipeline reads
+PIPELINE_MEMBERS = ("*.mp4", "gaze.csv", "world_timestamps.csv")
+
+RETRYABLE_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+)
+
+
+def extract_ids(url):
+    # Use regex to extract the workspace ID and recording ID
+    workspace_pattern = r"workspaces/([a-f0-9\-]+)/"
+    recording_pattern = r"id=([a-f0-9\-]+)&"
+
+    # Find matches using regex
+    workspace_match = re.search(workspace_pattern, url)
+    recording_match = re.search(recording_pattern, url)
+
+    # Extract the values if they exist
+    workspace_id = workspace_match.group(1) if workspace_match else None
+    recording_id = recording_match.group(1) if recording_match else None
+
+    return workspace_id, recording_id
+
+
+def _probe_range_support(url: str, headers: dict, timeout: float) -> Optional[int]:
+    """
+    Asks the server for the first byte of the resource.
+    :return: the total size in bytes if the server honours Range requests,
+        otherwise None.
+    """
+    with requests.get(
+        url, stream=True, headers={**headers, "Range": "bytes=0-0"}, timeout=timeout
+    ) as r:
+        r.raise_for_status()
+        content_range = r.headers.get("Content-Range", "")
+        if r.status_code != 206 or "/" not in content_range:
+            return None
+        total = content_range.rsplit("/", 1)[1]
+        return int(total) if total.isdigit() else None
+
+
+class _ResumableStream:
+    """
+    Iterates over the body of a GET request in chunks. After a dropped
+    connection the request is reissued with a Range header starting at the
+    first byte not yet yielded, so consumers see one uninterrupted stream.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        headers: dict,
+        start: int = 0,
+        end: Optional[int] = None,
+        chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+        max_retries: int = 5,
+        timeout: float = 60,
+    ):
+        self.url = url
+        self.headers = headers
+        self.offset = start
+        self.end = end
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.status_code: Optional[int] = None
+
+    def __iter__(self) -> Iterator[bytes]:
+        attempt = 0
+        while True:
+            request_headers = dict(self.headers)
+            if self.offset > 0 or self.end is not None:
+                end_str = "" if self.end is None else str(self.end)
+                request_headers["Range"] = f"bytes={self.offset}-{end_str}"
+            received = 0
+            try:
+                with requests.get(
+                    self.url, stream=True, headers=request_headers, timeout=self.timeout
+                ) as r:
+                    if r.status_code >= 500:
+                        raise requests.exceptions.ConnectionError(
+                            f"Server error {r.status_code}"
+                        )
+                    r.raise_for_status()
+                    self.status_code = r.status_code
+                    # A server ignoring the Range header sends the whole body
+                    # again, so drop what was already delivered.
+                    skip = 0
+                    if "Range" in request_headers and r.status_code != 206:
+                        skip = self.offset
+                        logging.warning(
+                            f"Server does not support resuming, skipping {skip} bytes"
+                        )
+                    for chunk in r.iter_content(chunk_size=self.chunk_size):
+                        if skip:
+                            chunk, skip = chunk[skip:], max(skip - len(chunk), 0)
+                        if self.end is not None:
+                            chunk = chunk[: self.end + 1 - self.offset]
+                        if not chunk:
+                            continue
+                        self.offset += len(chunk)
+                        received += len(chunk)
+                        yield chunk
+                    if self.end is not None and self.offset <= self.end:
+                        raise requests.exceptions.ChunkedEncodingError(
+                            f"Connection closed at byte {self.offset}, "
+                            f"expected {self.end + 1}"
+                        )
+                    return
+            except RETRYABLE_ERRORS as e:
+                attempt = 1 if received else attempt + 1
+                if attempt > self.max_retries:
+                    raise
+                wait_time = min(2**attempt, 30)
+                logging.warning(
+                    f"Download interrupted at byte {self.offset} ({e}). "
+                    f"Resuming in {wait_time} seconds..."
+                )
+                time.sleep(wait_time)
+
+
+def _fetch_range(stream: _ResumableStream, save_path: Path) -> Optional[int]:
+    """Writes the bytes of the stream into save_path at the same offsets."""
+    with save_path.open("r+b") as fd:
+        fd.seek(stream.offset)
+        for chunk in stream:
+            fd.write(chunk)
+    return stream.status_code
+
+
+def _log_throughput(num_bytes: int, t0: float) -> None:
+    elapsed = time.perf_counter() - t0
+    size_mb = num_bytes / 1e6
+    logging.info(
+        f"Downloaded {size_mb:.1f} MB in {elapsed:.1f} s "
+        f"({size_mb / max(elapsed, 1e-9):.1f} MB/s)"
+    )
+
+
+def download_url(
+    path: str,
+    save_path: Union[str, Path],
+    API_KEY,
+    chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+    num_connections: int = 1,
+    max_retries: int = 5,
+    timeout: float = 60,
+) -> Optional[int]:
+    """
+    Downloads an API resource to disk, resuming interrupted transfers from the
+    last received byte.
+    :param chunk_size: size in bytes of the read/write buffer.
+    :param num_connections: if larger than 1 and the server supports Range
+        requests, the file is fetched as that many byte ranges in parallel.
+    :param max_retries: consecutive failures without progress before giving up.
+    """
     url = f"{API_URL}/{path}"
-    r = requests.get(url, stream=True, headers={"api-key": API_KEY})
-    r.raise_for_status()
+    headers = {"api-key": API_KEY}
     save_path = Path(save_path)
-    with save_path.open("wb") as fd:
-        for chunk in r.iter_content(chunk_size=chunk_size):
-            fd.write(chunk)
+    save_path.write_bytes(b"")
+
+    t0 = time.perf_counter()
+    total = None
+    if num_connections > 1:
+        total = _probe_range_support(url, headers, timeout)
+        if total is None:
+            logging.info("Server does not support ranges, using a single connection")
+
+    if total:
+        with save_path.open("r+b") as fd:
+            fd.truncate(total)
+        bounds = [total * i // num_connections for i in range(num_connections + 1)]
+        streams = [
+            _ResumableStream(
+                url, headers, start, end - 1, chunk_size, max_retries, timeout
+            )
+            for start, end in zip(bounds[:-1], bounds[1:])
+            if end > start
+        ]
+        with ThreadPoolExecutor(max_workers=num_connections) as executor:
+            futures = [executor.submit(_fetch_range, s, save_path) for s in streams]
+            status = [f.result() for f in futures][0]
+    else:
+        stream = _ResumableStream(
+            url, headers, 0, None, chunk_size, max_retries, timeout
+        )
+        status = _fetch_range(stream, save_path)
 
-    return r.status_code
+    _log_throughput(save_path.stat().st_size, t0)
+    return status
+
+
+def _iter_file(path: Path, chunk_size: int) -> Iterator[bytes]:
+    with path.open("rb") as fd:
+        while chunk := fd.read(chunk_size):
+            yield chunk
 
 
 def download_recording(
-    recording_id: str, workspace_id: str, download_path: str, API_KEY
-) -> None:
+    recording_id: str,
+    workspace_id: str,
+    download_path: Union[str, Path],
+    API_KEY,
+    chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+    num_connections: int = 1,
+    stream_extract: bool = True,
+    members: Optional[Sequence[str]] = None,
+) -> Optional[int]:
+    """
+    Downloads the raw data export of a recording into download_path/recording_id,
+    with the files of the export folder placed directly in it.
+    :param stream_extract: extract the archive while it downloads instead of
+        saving the zip first. Range-parallel downloads need the zip on disk, so
+        this is ignored when num_connections > 1.
+    :param members: glob patterns of the files to keep, e.g. PIPELINE_MEMBERS.
+        None keeps the whole export.
+    """
     download_path = Path(download_path)  # Ensure download_path is a Path object
     download_path.mkdir(parents=True, exist_ok=True)  # Create directory if it doesn't exist
 
+    api_path = (
+        f"workspaces/{workspace_id}/recordings:raw-data-export?ids={recording_id}"
+    )
+    rec_path = download_path / recording_id
+
+    if stream_extract and num_connections <= 1:
+        t0 = time.perf_counter()
+        stream = _ResumableStream(
+            f"{API_URL}/{api_path}", {"api-key": API_KEY}, chunk_size=chunk_size
+        )
+        extract_zip_stream(stream, rec_path, members)
+        _log_throughput(stream.offset, t0)
+        return stream.status_code
+
     zip_path = download_path / f"{recording_id}.zip"
     status = download_url(
-        f"workspaces/{workspace_id}/recordings:raw-data-export?ids={recording_id}",
+        api_path,
         zip_path,
         API_KEY,
-        chunk_size=128,
+        chunk_size=chunk_size,
+        num_connections=num_connections,
     )
-    rec_path = download_path / recording_id
-
-    shutil.unpack_archive(zip_path, rec_path)
+    extract_zip_stream(_iter_file(zip_path, chunk_size), rec_path, members)
     zip_path.unlink()
 
-    for file_source in rec_path.glob("*/*"):
-        shutil.move(file_source, file_source.parent.parent / file_source.name)
-
     return status
 
 
-def send_event_to_cloud(workspace_id, recording_id, keyword, timestamp_sec, API_KEY):
-    url = f"{API_URL}/workspaces/{workspace_id}/recordings/{recording_id}/events"
-    headers = {
-        "accept": "application/json",
-        "Content-Type": "application/json",
-        "api-key": API_KEY,
-    }
-    data = {"name": keyword, "offset_s": timestamp_sec}
-    response = requests.post(url, headers=headers, data=json.dumps(data))
-    if response.status_code == 200:
-        logging.debug(f"Event sent successfully: {data}")
-    else:
-        logging.debug(f"Failed to send event: {response.status_code}, {response.text}")
\ No newline at end of file
+class EventPublisher:
+    """
+    Posts events to a Pupil Cloud recording from background tasks, so that
+    callers running in the event loop never wait on Cloud I/O.
+
+    Events are queued by publish() and sent by a fixed number of workers over
+    one keep-alive session. An event with the same name and offset as one
+    already queued is dropped. Failed posts are retried with exponential
+    backoff; close() waits until the queue is drained.
+    :param metrics: optional RunMetrics to count the POST outcomes, retries
+        and latencies in.
+    """
+
+    def __init__(
+        self,
+        workspace_id,
+        recording_id,
+        API_KEY,
+        max_concurrency: int = 4,
+        max_retries: int = 5,
+        metrics=None,
+    ):
+        self.url = (
+            f"{API_URL}/workspaces/{workspace_id}/recordings/{recording_id}/events"
+        )
+        self.headers = {
+            "accept": "application/json",
+            "Content-Type": "application/json",
+            "api-key": API_KEY,
+        }
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.metrics = metrics
+        self.sent: list = []
+        self.failed: list = []
+        self._seen: set = set()
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: list = []
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_concurrency)
+        )
+        self._workers = [
+            asyncio.create_task(self._worker()) for _ in range(self.max_concurrency)
+        ]
+
+    def publish(self, keyword, timestamp_sec) -> bool:
+        """
+        Queues an event without waiting for it to be sent.
+        :return: False if the same event was already queued.
+        """
+        if self._queue is None:
+            raise RuntimeError("EventPublisher.start() has not been called")
+        event = {"name": keyword, "offset_s": float(timestamp_sec)}
+        key = (event["name"], round(event["offset_s"], 3))
+        if key in self._seen:
+            logging.debug(f"Event already queued, skipping: {event}")
+            return False
+        self._seen.add(key)
+        self._queue.put_nowait(event)
+        return True
+
+    async def _worker(self) -> None:
+        assert self._queue is not None
+        while True:
+            event = await self._queue.get()
+            try:
+                await self._post(event)
+            finally:
+                self._queue.task_done()
+
+    async def _post(self, event: dict) -> None:
+        assert self._session is not None
+        started = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            status, text = None, ""
+            sent_at = time.perf_counter()
+            try:
+                async with self._session.post(
+                    self.url, headers=self.headers, json=event
+                ) as response:
+                    status = response.status
+                    text = await response.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                text = str(e)
+                self._count("cloud_posts", status=type(e).__name__)
+            else:
+                self._count("cloud_posts", status=status)
+                if self.metrics is not None:
+                    self.metrics.observe(
+                        "cloud_post_latency_seconds", time.perf_counter() - sent_at
+                    )
+            if status == 200:
+                logging.debug(f"Event sent successfully: {event}")
+                self.sent.append(event)
+                self._finished(started, "sent")
+                return
+            retryable = status is None or status == 429 or status >= 500
+            if not retryable or attempt == self.max_retries:
+                break
+            wait_time = 2**attempt
+            logging.debug(
+                f"Failed to send event ({status}), retrying in {wait_time} seconds"
+            )
+            self._count("cloud_post_retries")
+            await asyncio.sleep(wait_time)
+        logging.warning(f"Failed to send event {event}: {status}, {text}")
+        self.failed.append(event)
+        self._finished(started, "failed")
+
+    def _count(self, name, **labels) -> None:
+        if self.metrics is not None:
+            self.metrics.count(name, **labels)
+
+    def _finished(self, started, outcome) -> None:
+        self._count("cloud_events", outcome=outcome)
+        if self.metrics is not None:
+            # Posts run interleaved in the event loop, only wall time is known
+            self.metrics.add_stage("event_post", time.perf_counter() - started, None)
+
+    async def flush(self) -> None:
+        """Waits until every queued event was sent or given up on."""
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def close(self) -> None:
+        await self.flush()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
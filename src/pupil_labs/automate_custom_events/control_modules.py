@@ -1,104 +1,405 @@
+import asyncio
 import pandas as pd
 from pathlib import Path
 import os
-import glob
 import logging
+import time
+from fnmatch import fnmatch
 import numpy as np
-from pupil_labs.automate_custom_events.cloud_interaction import download_recording
+from pupil_labs.automate_custom_events.cloud_interaction import (
+    PIPELINE_MEMBERS,
+    download_recording,
+)
 from pupil_labs.automate_custom_events.video_utils import (
     encode_video_as_base64,
     create_gaze_overlay_video,
+    create_gaze_overlay_frames,
+    LazyFrameSource,
+    StreamingFrames,
+    FrameSignatures,
+    frame_metadata_for_pts,
+    time_window_mask,
+    FrameEncodingStats,
+    ENCODE_PARAMS,
+    OVERLAY_PARAMS,
 )
 from pupil_labs.automate_custom_events.frame_processor import FrameProcessor
+from pupil_labs.automate_custom_events.batch_api import BatchClient
+from pupil_labs.automate_custom_events.prefilter import Prefilter
+from pupil_labs.automate_custom_events.artifact_cache import (
+    ArtifactCache,
+    FRAME_SIGNATURES_NAME,
+    EncodedFrameFile,
+    evict_recordings,
+    save_encoded_frames,
+)
+from pupil_labs.automate_custom_events.response_cache import (
+    RESPONSE_CACHE_NAME,
+    ResponseCache,
+)
+from pupil_labs.automate_custom_events.run_metrics import RunMetrics
 from pupil_labs.dynamic_content_on_rim.video.read import read_video_ts
 
+GAZE_OVERLAY_NAME = "gaze_overlay.mp4"
 
-async def run_modules(
-    openai_api_key,
-    worksp_id,
-    rec_id,
-    cloud_api_key,
-    download_path,
-    description,
-    event_code,
-    batch_size,
-    start_time_seconds,
-    end_time_seconds,
-):
+
+def _downloaded_files(recpath):
+    return [
+        p
+        for p in recpath.iterdir()
+        if p.name != GAZE_OVERLAY_NAME
+        and any(fnmatch(p.name, pattern) for pattern in PIPELINE_MEMBERS)
+    ]
+
+
+def fetch_recording(rec_id, worksp_id, cloud_api_key, download_path, metrics=None):
+    """
+    Downloads the files of a recording that the pipeline needs, unless they
+    are already cached.
+    :param metrics: optional RunMetrics to time the download in.
+    :return: the ArtifactCache of the recording folder.
+    """
     #############################################################################
     # 1. Download, read data, and create gaze overlay video to be sent to OpenAI
     #############################################################################
-    logging.info(
-        "◎ Getting the recording data from Pupil Cloud! ⚡️[/]", extra={"markup": True}
-    )
+    recpath = Path(download_path) / rec_id
+    cache = ArtifactCache(recpath, rec_id)
+    metrics = metrics or RunMetrics(rec_id)
+
+    download_key = cache.key("download", {"members": PIPELINE_MEMBERS})
+    if not cache.is_valid("download", download_key):
+        logging.info(
+            "◎ Getting the recording data from Pupil Cloud! ⚡️[/]",
+            extra={"markup": True},
+        )
+        with metrics.stage("download"):
+            download_recording(
+                rec_id,
+                worksp_id,
+                download_path,
+                cloud_api_key,
+                members=PIPELINE_MEMBERS,
+            )
+        cache.store("download", download_key, _downloaded_files(recpath))
+    return cache
 
-    download_recording(rec_id, worksp_id, download_path, cloud_api_key)
-    recpath = Path(download_path / rec_id)
-    gaze_overlay_path = os.path.join(recpath, "gaze_overlay.mp4")
-    if os.path.exists(gaze_overlay_path):
-        logging.debug(f"{gaze_overlay_path} exists.")
 
+def _number_frames(frame_metadata, window_rows):
+    """
+    Adds the numbers of the frames in the whole scene video, the "frames"
+    column of the merged gaze, as the "frame" column of the metadata of the
+    frames of the time window.
+    """
+    frame_metadata = frame_metadata.drop(columns="frame", errors="ignore")
+    numbers = window_rows["frames"].to_numpy()[: len(frame_metadata)]
+    frame_metadata.insert(0, "frame", numbers)
+    return frame_metadata
+
+
+def prepare_frames(
+    cache,
+    start_time_seconds,
+    end_time_seconds,
+    fused_overlay=True,
+    save_overlay_video=False,
+    lazy_frames=True,
+    encode_params=None,
+    overlay_workers=1,
+    stream_frames=True,
+    metrics=None,
+):
+    """
+    Merges the gaze into the scene video and prepares the frames of the time
+    window for querying, reusing the cached stages where possible.
+    :param cache: the ArtifactCache returned by fetch_recording.
+    :param stream_frames: if the frames are not lazy and not cached, encode
+        them on a worker thread and return them while they are encoded, see
+        StreamingFrames.
+    :param metrics: optional RunMetrics to time the gaze merge, overlay and
+        encoding in.
+    :return: the base64 frames, their metadata, their FrameSignatures and the
+        FrameEncodingStats, which lazily encoded frames keep adding to.
+    """
+    recpath = cache.rec_path
+    raw_video_path = next(p for p in _downloaded_files(recpath) if p.suffix == ".mp4")
+    gaze_path = recpath / "gaze.csv"
+    world_timestamps_path = recpath / "world_timestamps.csv"
+    merged_path = recpath / "merged_sc_gaze_GM.csv"
+    gaze_overlay_path = os.path.join(recpath, GAZE_OVERLAY_NAME)
+
+    metrics = metrics or RunMetrics(cache.recording_id)
+
+    # Format to read timestamps
+    oftype = {"timestamp [ns]": np.uint64}
+
+    # Read the world timestamps (needed for gaze module)
+    logging.debug("Reading world timestamps...")
+    world_timestamps_df = pd.read_csv(world_timestamps_path, dtype=oftype)
+    ts_world = world_timestamps_df["timestamp [ns]"]
+
+    merge_key = cache.key(
+        "gaze_merge", inputs=[raw_video_path, gaze_path, world_timestamps_path]
+    )
+    if cache.is_valid("gaze_merge", merge_key):
+        merged_sc_gaze = pd.read_csv(merged_path, dtype=oftype)
     else:
-        logging.debug(f"{gaze_overlay_path} does not exist.")
-        raw_video_path = next(recpath.glob("*.mp4"))
+        with metrics.stage("gaze_merge"):
+            # read video
+            _, frames, pts, ts = read_video_ts(raw_video_path)
+
+            # Read gaze data
+            logging.debug("Reading gaze data...")
+            gaze_df = pd.read_csv(gaze_path, dtype=oftype)
 
-        # Format to read timestamps
-        oftype = {"timestamp [ns]": np.uint64}
+            # Prepare df for gaze overlay
+            video_for_gaze_module = pd.DataFrame(
+                {
+                    "frames": np.arange(frames),
+                    "pts": pts.astype(int),
+                    "timestamp [ns]": ts_world,
+                }
+            )
 
-        # read video
-        _, frames, pts, ts = read_video_ts(raw_video_path)
+            logging.debug("Merging video and gaze dfs..")
+            selected_col = ["timestamp [ns]", "gaze x [px]", "gaze y [px]"]
+            gaze_df = gaze_df[selected_col]
+            gaze_df = gaze_df.sort_values(by="timestamp [ns]")
+            video_for_gaze_module = video_for_gaze_module.sort_values(
+                by="timestamp [ns]"
+            )
 
-        # Read gaze data
-        logging.debug("Reading gaze data...")
-        gaze_df = pd.read_csv(recpath / "gaze.csv", dtype=oftype)
-        # Read the world timestamps (needed for gaze module)
-        logging.debug("Reading world timestamps...")
+            merged_sc_gaze = pd.merge_asof(
+                video_for_gaze_module,
+                gaze_df,
+                on="timestamp [ns]",
+                direction="nearest",
+                suffixes=["video", "gaze"],
+            )
+            merged_sc_gaze.to_csv(merged_path, index=False)
+        cache.store("gaze_merge", merge_key, [merged_path])
 
-        world_timestamps_df = pd.read_csv(recpath / "world_timestamps.csv", dtype=oftype)
+    #############################################################################
+    # 2. Draw the gaze overlay and get baseframes
+    #############################################################################
+    baseframes_path = recpath / "output_get_baseframes.csv"
+    signatures_path = recpath / FRAME_SIGNATURES_NAME
+    encode_params = {**ENCODE_PARAMS, **(encode_params or {})}
+    encoding_stats = FrameEncodingStats(metrics=metrics)
+    metrics.add_report("encoding", encoding_stats)
 
-        # Prepare df for gaze overlay
-        ts_world = world_timestamps_df["timestamp [ns]"]
+    # Only the frames of the requested time window are decoded, rendered,
+    # encoded and searched
+    window = {"start": start_time_seconds, "end": end_time_seconds}
+    in_video = merged_sc_gaze["timestamp [ns]"] >= ts_world[0]
+    in_window = time_window_mask(
+        raw_video_path, merged_sc_gaze["pts"], start_time_seconds, end_time_seconds
+    )
+    window_rows = merged_sc_gaze[in_video & in_window]
+    logging.info(
+        f"{len(window_rows)} of {int(in_video.sum())} frames are in the time window"
+    )
 
-        video_for_gaze_module = pd.DataFrame(
-            {
-                "frames": np.arange(frames),
-                "pts": pts.astype(int),
-                "timestamp [ns]": ts_world,
-            }
+    if not fused_overlay or (lazy_frames and save_overlay_video):
+        overlay_key = cache.key(
+            "overlay",
+            {**OVERLAY_PARAMS, "window": window},
+            inputs=[raw_video_path, merged_path],
         )
+        if not cache.is_valid("overlay", overlay_key):
+            with metrics.stage("overlay"):
+                create_gaze_overlay_video(
+                    window_rows,
+                    raw_video_path,
+                    ts_world,
+                    gaze_overlay_path,
+                    num_workers=overlay_workers,
+                )
+            cache.store("overlay", overlay_key, [Path(gaze_overlay_path)])
 
-        logging.debug("Merging video and gaze dfs..")
-        selected_col = ["timestamp [ns]", "gaze x [px]", "gaze y [px]"]
-        gaze_df = gaze_df[selected_col]
-        gaze_df = gaze_df.sort_values(by="timestamp [ns]")
-        video_for_gaze_module = video_for_gaze_module.sort_values(by="timestamp [ns]")
-
-        merged_sc_gaze = pd.merge_asof(
-            video_for_gaze_module,
-            gaze_df,
-            on="timestamp [ns]",
-            direction="nearest",
-            suffixes=["video", "gaze"],
+    if lazy_frames:
+        # Frames are only decoded and encoded when the search asks for them
+        if fused_overlay:
+            base64_frames = LazyFrameSource(
+                raw_video_path,
+                pts=window_rows["pts"],
+                gaze_xy=window_rows[["gaze x [px]", "gaze y [px]"]],
+                encode_params=encode_params,
+                stats=encoding_stats,
+            )
+            frame_metadata = base64_frames.frame_metadata()
+        else:
+            base64_frames = LazyFrameSource(
+                gaze_overlay_path, encode_params=encode_params, stats=encoding_stats
+            )
+            # The overlay video starts at the window, keep the scene clock
+            frame_metadata = frame_metadata_for_pts(
+                raw_video_path, window_rows["pts"].iloc[: len(base64_frames)]
+            )
+        frame_metadata = _number_frames(frame_metadata, window_rows)
+        frame_metadata.to_csv(baseframes_path, index=False)
+        frame_signatures = base64_frames.signatures
+    elif fused_overlay:
+        # Overlay and JPEG encoding in one pass, the video is only a side output
+        overlay_outputs = [Path(gaze_overlay_path)] if save_overlay_video else []
+        frames_params = {
+            **OVERLAY_PARAMS,
+            **encode_params,
+            "save_overlay_video": save_overlay_video,
+            "signatures": True,
+            "window": window,
+        }
+        frames_key = cache.key(
+            "fused_frames", frames_params, inputs=[raw_video_path, merged_path]
         )
+        if not cache.is_valid("fused_frames", frames_key):
+            frame_signatures = FrameSignatures(len(window_rows))
+
+            def encode_frames(frames=None):
+                with metrics.stage("overlay"):
+                    base64_frames, frame_metadata = create_gaze_overlay_frames(
+                        window_rows,
+                        raw_video_path,
+                        ts_world,
+                        gaze_overlay_path if save_overlay_video else None,
+                        encode_params,
+                        encoding_stats,
+                        frame_signatures,
+                        frames=frames,
+                    )
+                frame_metadata = _number_frames(frame_metadata, window_rows)
+                frame_metadata.to_csv(baseframes_path, index=False)
+                frame_files = save_encoded_frames(
+                    recpath, base64_frames if frames is None else frames.encoded()
+                )
+                frame_signatures.save(signatures_path)
+                cache.store(
+                    "fused_frames",
+                    frames_key,
+                    [baseframes_path, *frame_files, signatures_path, *overlay_outputs],
+                )
+                cache.invalidate("frames")
 
-        # If it doesn't exist
-        create_gaze_overlay_video(
-            merged_sc_gaze, raw_video_path, ts_world, gaze_overlay_path
+            if stream_frames:
+                # The search starts on the first frames while the rest are
+                # encoded, the encoded frames are cached once all are done
+                frame_metadata = frame_metadata_for_pts(
+                    raw_video_path, window_rows["pts"]
+                )
+                base64_frames = StreamingFrames(len(window_rows), encode_frames)
+                frame_metadata = _number_frames(frame_metadata, window_rows)
+                return base64_frames, frame_metadata, frame_signatures, encoding_stats
+            encode_frames()
+        frame_metadata = pd.read_csv(baseframes_path, dtype=oftype)
+        base64_frames = EncodedFrameFile(recpath)
+        frame_signatures = FrameSignatures.load(signatures_path)
+    else:
+        frames_key = cache.key(
+            "frames",
+            {**encode_params, "signatures": "gaze", "window": window},
+            inputs=[gaze_overlay_path],
         )
-        merged_sc_gaze.to_csv(recpath / "merged_sc_gaze_GM.csv", index=False)
+        if not cache.is_valid("frames", frames_key):
+            frame_signatures = FrameSignatures(len(window_rows))
+            gaze_xy = window_rows[["gaze x [px]", "gaze y [px]"]].to_numpy(
+                dtype=np.float64
+            )
 
+            def encode_frames(frames=None):
+                base64_frames, frame_metadata = encode_video_as_base64(
+                    gaze_overlay_path,
+                    encode_params=encode_params,
+                    stats=encoding_stats,
+                    signatures=frame_signatures,
+                    frames=frames,
+                    gaze_xy=gaze_xy,
+                )
+                if frames is not None:
+                    base64_frames = frames.encoded()
+                # The overlay video starts at the window, keep the scene clock
+                frame_metadata = frame_metadata_for_pts(
+                    raw_video_path, window_rows["pts"].iloc[: len(base64_frames)]
+                )
+                frame_metadata = _number_frames(frame_metadata, window_rows)
+                output_get_baseframes = pd.DataFrame(frame_metadata)
+                output_get_baseframes.to_csv(baseframes_path, index=False)
+                frame_files = save_encoded_frames(recpath, base64_frames)
+                frame_signatures.save(signatures_path)
+                cache.store(
+                    "frames",
+                    frames_key,
+                    [baseframes_path, *frame_files, signatures_path],
+                )
+                cache.invalidate("fused_frames")
+
+            if stream_frames:
+                # See the fused branch
+                frame_metadata = frame_metadata_for_pts(
+                    raw_video_path, window_rows["pts"]
+                )
+                base64_frames = StreamingFrames(len(window_rows), encode_frames)
+                frame_metadata = _number_frames(frame_metadata, window_rows)
+                return base64_frames, frame_metadata, frame_signatures, encoding_stats
+            encode_frames()
+        frame_metadata = pd.read_csv(baseframes_path, dtype=oftype)
+        base64_frames = EncodedFrameFile(recpath)
+        frame_signatures = FrameSignatures.load(signatures_path)
+
+    # Also for frame metadata cached before it had the frame numbers
+    frame_metadata = _number_frames(frame_metadata, window_rows)
+    return base64_frames, frame_metadata, frame_signatures, encoding_stats
 
-    #############################################################################
-    # 2. Read gaze_overlay_video and get baseframes
-    #############################################################################
-    base64_frames, frame_metadata = encode_video_as_base64(gaze_overlay_path)
-    output_get_baseframes = pd.DataFrame(frame_metadata)
-    output_get_baseframes.to_csv(recpath / "output_get_baseframes.csv", index=False)
 
+async def detect_events(
+    cache,
+    base64_frames,
+    frame_metadata,
+    frame_signatures,
+    openai_api_key,
+    worksp_id,
+    cloud_api_key,
+    description,
+    event_code,
+    batch_size,
+    start_time_seconds,
+    end_time_seconds,
+    query_concurrency=8,
+    frames_per_request=1,
+    use_response_cache=True,
+    response_cache_size_mb=256,
+    search_strategy="binary",
+    search_params=None,
+    query_backend="live",
+    metrics=None,
+    prometheus_metrics=False,
+    prefilter_scorer=None,
+    prefilter_params=None,
+):
+    """
+    Searches the prepared frames for the activities and sends their events
+    to Pupil Cloud.
+    :param frame_signatures: FrameSignatures to skip near-duplicate frames
+        with, or None to query them.
+    :param metrics: the RunMetrics of the earlier stages, written to
+        run_metrics.json in the recording folder with those of the search.
+    :param prometheus_metrics: also write them in the Prometheus text format,
+        to run_metrics.prom.
+    :param prefilter_scorer: optional FrameScorer of a local model; frames it
+        rates below the threshold of prefilter_params are not sent, see
+        Prefilter.
+    :return: the detected events.
+    """
+    recpath = cache.rec_path
+    rec_id = cache.recording_id
+    metrics = metrics or RunMetrics(rec_id)
     #############################################################################
     # 3. Process Frames with GPT-4o
     #############################################################################
     logging.info("Start processing the frames..")
+    response_cache = ResponseCache(
+        recpath / RESPONSE_CACHE_NAME,
+        max_bytes=int(response_cache_size_mb * 1024 * 1024),
+        enabled=use_response_cache,
+    )
     frame_processor = FrameProcessor(
         base64_frames,
         frame_metadata,
@@ -111,11 +412,41 @@ async def run_modules(
         int(batch_size),
         start_time_seconds,
         end_time_seconds,
+        max_concurrency=query_concurrency,
+        frames_per_request=frames_per_request,
+        response_cache=response_cache,
+        frame_signatures=frame_signatures,
+        search_strategy=search_strategy,
+        search_params=search_params,
+        backend=query_backend,
+        # Keeps the JSONL input files of the batch jobs with the recording
+        batch_client=BatchClient(openai_api_key, work_dir=recpath),
+        metrics=metrics,
+        prefilter=(
+            None
+            if prefilter_scorer is None
+            else Prefilter(prefilter_scorer, prefilter_params)
+        ),
     )
 
+    # The event loop thread also runs the queries of other recordings, so
+    # only the wall time of the search is its own
+    started = time.perf_counter()
     async_process_frames_output_events = await frame_processor.prompting(
         recpath, int(batch_size)
     )
+    metrics.add_stage("query", time.perf_counter() - started, None)
+
+    # Streamed frames may still be encoding, which must not hold up the
+    # queries of other recordings on the loop; fails on an encoding error
+    await asyncio.to_thread(base64_frames.close)
+    metrics.count("response_cache_hits", response_cache.hits)
+    metrics.count("response_cache_misses", response_cache.misses)
+    metrics.count("duplicate_frames_skipped", frame_processor.num_duplicates_skipped)
+    response_cache.log_report()
+    if frame_processor.usage_stats.num_requests:
+        frame_processor.usage_stats.log_report()
+    response_cache.close()
 
     print(async_process_frames_output_events)
     final_output_path = pd.DataFrame(async_process_frames_output_events)
@@ -125,4 +456,88 @@ async def run_modules(
         extra={"markup": True},
     )
 
+    metrics_path = metrics.write(recpath, prometheus=prometheus_metrics)
+    logging.info(f"Run metrics written to {metrics_path}")
+
+    cache.touch()
+    return final_output_path
+
+
+async def run_modules(
+    openai_api_key,
+    worksp_id,
+    rec_id,
+    cloud_api_key,
+    download_path,
+    description,
+    event_code,
+    batch_size,
+    start_time_seconds,
+    end_time_seconds,
+    cache_size_limit_gb=None,
+    fused_overlay=True,
+    save_overlay_video=False,
+    lazy_frames=True,
+    encode_params=None,
+    overlay_workers=1,
+    stream_frames=True,
+    query_concurrency=8,
+    frames_per_request=1,
+    use_response_cache=True,
+    response_cache_size_mb=256,
+    skip_duplicate_frames=True,
+    search_strategy="binary",
+    search_params=None,
+    query_backend="live",
+    prometheus_metrics=False,
+    prefilter_scorer=None,
+    prefilter_params=None,
+):
+    metrics = RunMetrics(rec_id)
+    cache = fetch_recording(
+        rec_id, worksp_id, cloud_api_key, download_path, metrics=metrics
+    )
+    base64_frames, frame_metadata, frame_signatures, encoding_stats = prepare_frames(
+        cache,
+        start_time_seconds,
+        end_time_seconds,
+        fused_overlay=fused_overlay,
+        save_overlay_video=save_overlay_video,
+        lazy_frames=lazy_frames,
+        encode_params=encode_params,
+        overlay_workers=overlay_workers,
+        stream_frames=stream_frames,
+        metrics=metrics,
+    )
+    final_output_path = await detect_events(
+        cache,
+        base64_frames,
+        frame_metadata,
+        frame_signatures if skip_duplicate_frames else None,
+        openai_api_key,
+        worksp_id,
+        cloud_api_key,
+        description,
+        event_code,
+        batch_size,
+        start_time_seconds,
+        end_time_seconds,
+        query_concurrency=query_concurrency,
+        frames_per_request=frames_per_request,
+        use_response_cache=use_response_cache,
+        response_cache_size_mb=response_cache_size_mb,
+        search_strategy=search_strategy,
+        search_params=search_params,
+        query_backend=query_backend,
+        metrics=metrics,
+        prometheus_metrics=prometheus_metrics,
+        prefilter_scorer=prefilter_scorer,
+        prefilter_params=prefilter_params,
+    )
+    if encoding_stats.num_frames:
+        encoding_stats.log_report()
+
+    if cache_size_limit_gb is not None:
+        evict_recordings(download_path, int(cache_size_limit_gb * 1e9), keep=[rec_id])
+
     return final_output_path
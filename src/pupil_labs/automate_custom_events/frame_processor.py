@@ -1,15 +1,138 @@
 from openai import OpenAI
+import numpy as np
 import pandas as pd
 import re
 import os
 import json
 import aiohttp
-from pupil_labs.automate_custom_events.cloud_interaction import send_event_to_cloud
+from pupil_labs.automate_custom_events.batch_api import BATCH_PRICE_FACTOR, BatchClient
+from pupil_labs.automate_custom_events.cloud_interaction import EventPublisher
+from pupil_labs.automate_custom_events.prefilter import PREFILTER_SCORES_NAME
+from pupil_labs.automate_custom_events.response_cache import request_key
+from pupil_labs.automate_custom_events.run_metrics import RunMetrics
+from pupil_labs.automate_custom_events.rate_limiter import (
+    RETRYABLE_STATUSES,
+    shared_rate_limiter,
+)
 import asyncio
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
+OPENAI_URL = "https://api.openai.com/v1/chat/completions"
+
+# Tokens of one frame resized to 768px at high detail (4 tiles of 170 + 85)
+IMAGE_TOKENS = 765
+# Frame metadata and message framing, per frame
+PROMPT_OVERHEAD_TOKENS = 100
+MAX_TOKENS = 300
+# Extra completion budget for each further frame of a multi-frame request
+OUTPUT_TOKENS_PER_FRAME = 30
+
+# Frames whose difference hashes differ in at most max_hash_distance of 64
+# bits and whose gaze is at most max_gaze_distance pixels apart count as
+# near-duplicates
+DEDUP_PARAMS = {"max_hash_distance": 4, "max_gaze_distance": 30}
+
+SEARCH_STRATEGIES = ("binary", "coarse_to_fine")
+# "live" sends chat requests as the search needs them, "batch" submits the
+# requests of each search round as an OpenAI Batch API job
+BACKENDS = ("live", "batch")
+# Frames between the samples of the coarse pass, and how close the frames on
+# either side of a change must be before the refinement stops
+SEARCH_PARAMS = {"stride": 30, "tolerance": 1}
+# Event name suffixes of the start and end of an occurrence
+EVENT_SUFFIXES = ("_start", "_end")
+
+# USD per token, cached prompt tokens are billed at half the input price
+PRICES = {"input": 5 / 1e6, "cached_input": 2.5 / 1e6, "output": 15 / 1e6}
+
+
+class TokenUsageStats:
+    """
+    Token usage reported by the chat completion responses of a run, including
+    how much of the prompts the provider served from its prompt cache.
+    :param price_factor: scales the list prices, e.g. for batch discounts.
+    """
+
+    def __init__(self, price_factor=1.0):
+        self.price_factor = price_factor
+        self.num_requests = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self.latencies = {True: [], False: []}
+
+    def add(self, usage, latency=None):
+        usage = usage or {}
+        details = usage.get("prompt_tokens_details") or {}
+        cached = details.get("cached_tokens") or 0
+        self.num_requests += 1
+        self.prompt_tokens += usage.get("prompt_tokens") or 0
+        self.cached_tokens += cached
+        self.completion_tokens += usage.get("completion_tokens") or 0
+        if latency is not None:
+            self.latencies[cached > 0].append(latency)
+
+    def report(self):
+        uncached_tokens = self.prompt_tokens - self.cached_tokens
+        cost = self.price_factor * (
+            uncached_tokens * PRICES["input"]
+            + self.cached_tokens * PRICES["cached_input"]
+            + self.completion_tokens * PRICES["output"]
+        )
+        saved = (
+            self.price_factor
+            * self.cached_tokens
+            * (PRICES["input"] - PRICES["cached_input"])
+        )
+        return {
+            "requests": self.num_requests,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cached_share": self.cached_tokens / max(self.prompt_tokens, 1),
+            "completion_tokens": self.completion_tokens,
+            "cost_usd_estimate": cost,
+            "saved_usd_estimate": saved,
+            "mean_latency_cached_s": _mean(self.latencies[True]),
+            "mean_latency_uncached_s": _mean(self.latencies[False]),
+        }
+
+    def log_report(self):
+        report = self.report()
+        logger.info(
+            f"{report['requests']} OpenAI requests, "
+            f"{report['prompt_tokens']} prompt tokens of which "
+            f"{report['cached_tokens']} cached ({100 * report['cached_share']:.0f}%), "
+            f"{report['completion_tokens']} completion tokens, "
+            f"~${report['cost_usd_estimate']:.3f} "
+            f"(~${report['saved_usd_estimate']:.3f} saved by prompt caching)"
+        )
+        if report["mean_latency_cached_s"] is not None:
+            logger.info(
+                f"Mean latency {report['mean_latency_cached_s']:.2f}s with cached "
+                f"prompt, {report['mean_latency_uncached_s'] or 0:.2f}s without"
+            )
+
+
+def _mean(values):
+    return sum(values) / len(values) if values else None
+
+
+def _seconds(value):
+    return None if value is None else int(value)
+
+
+def _detected(frame_detections):
+    """The frames with at least one detection."""
+    return {
+        index: detections
+        for index, detections in frame_detections.items()
+        if detections
+    }
+
+
 class FrameProcessor:
     def __init__(
         self,
@@ -24,6 +147,18 @@ class FrameProcessor:
         batch_size,
         start_time_seconds,
         end_time_seconds,
+        max_concurrency=8,
+        rate_limiter=None,
+        frames_per_request=1,
+        response_cache=None,
+        frame_signatures=None,
+        dedup_params=None,
+        search_strategy="binary",
+        search_params=None,
+        backend="live",
+        batch_client=None,
+        metrics=None,
+        prefilter=None,
     ):
         # General params
         self.base64_frames = base64_frames
@@ -33,8 +168,27 @@ class FrameProcessor:
         self.recording_id = recording_id
         self.workspace_id = workspace_id
         self.batch_size = batch_size
-        self.start_time_seconds = int(start_time_seconds)
-        self.end_time_seconds = int(end_time_seconds)
+        # None leaves a bound of the time range open
+        self.start_time_seconds = _seconds(start_time_seconds)
+        self.end_time_seconds = _seconds(end_time_seconds)
+
+        # The frame numbers in the whole scene video, as given to the model
+        # and reported in the results. Frames are indexed by their position in
+        # base64_frames, which starts at the time window.
+        if "frame" in vid_df.columns:
+            self.frame_numbers = vid_df["frame"].to_numpy(dtype=np.int64)
+        else:
+            self.frame_numbers = np.arange(len(vid_df), dtype=np.int64)
+        # The frame metadata as arrays, so that queries don't create pandas
+        # objects per frame, and the prompt row of every queried frame as JSON
+        self.frame_columns = {
+            column: vid_df[column].to_numpy()
+            for column in vid_df.columns
+            if column != "frame"
+        }
+        self.timestamps = vid_df["timestamp [s]"].to_numpy(dtype=np.float64)
+        self.in_time_range = self.time_range_mask(self.timestamps)
+        self._frame_rows_json = {}
 
         self.client = OpenAI(api_key=openai_api_key)
         self.activities = re.split(r"\s*;\s*", prompt_description)
@@ -90,6 +244,66 @@ class FrameProcessor:
         """
 
         self.last_event = None
+        self.event_publisher = None
+        # Admits the OpenAI requests of all processors of this process, so
+        # they share the rate limit budgets and back off together
+        self.rate_limiter = rate_limiter or shared_rate_limiter(
+            openai_api_key, max_concurrency
+        )
+        # Frames sent per chat request, sharing one copy of the system prompt
+        self.frames_per_request = max(1, int(frames_per_request))
+        self.failed_frames = []
+        # Optional ResponseCache of earlier answers to identical requests
+        self.response_cache = response_cache
+
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend: {backend}")
+        self.backend = backend
+        self.batch_client = batch_client or BatchClient(openai_api_key)
+        self.usage_stats = TokenUsageStats(
+            BATCH_PRICE_FACTOR if backend == "batch" else 1.0
+        )
+        # RunMetrics of the run, counts requests, 429s, retries and latencies
+        self.metrics = metrics or RunMetrics(recording_id)
+        self.metrics.add_report("tokens", self.usage_stats)
+
+        # Optional Prefilter; frames its local model rates unlikely to show
+        # an activity are not sent, see build_request
+        self.prefilter = prefilter
+        if prefilter is not None:
+            prefilter.activities = self.activities
+            self.metrics.add_report("prefilter", prefilter)
+
+        # Optional FrameSignatures; frames that look like an analysed frame
+        # reuse its detections, see reuse_duplicates
+        self.frame_signatures = frame_signatures
+        self.dedup_params = {**DEDUP_PARAMS, **(dedup_params or {})}
+        self.frame_results = {}
+        self.num_duplicates_skipped = 0
+
+        # "binary" searches each batch for the first detection of every code,
+        # "coarse_to_fine" finds the start and end of every occurrence
+        if search_strategy not in SEARCH_STRATEGIES:
+            raise ValueError(f"Unknown search strategy: {search_strategy}")
+        self.search_strategy = search_strategy
+        self.search_params = {**SEARCH_PARAMS, **(search_params or {})}
+
+        # Shared by every request of the run, see query_frames
+        self.prompt_prefix = [
+            {
+                "role": "system",
+                "content": (self.base_prompt),
+            },
+            {
+                "role": "user",
+                "content": (
+                    "The frames are extracted from this video. Their frame "
+                    "numbers and timestamps are stored in the dataframe of the "
+                    "next message, in the same order as the images that follow "
+                    "it."
+                ),
+            },
+        ]
 
     def is_within_time_range(self, timestamp):
         # Check if the timestamp is within the start_time_seconds and end_time_seconds
@@ -99,24 +313,114 @@ class FrameProcessor:
             return False
         return True
 
+    def time_range_mask(self, timestamps):
+        """is_within_time_range for an array of timestamps."""
+        mask = np.ones(len(timestamps), dtype=bool)
+        if self.start_time_seconds is not None:
+            mask &= timestamps >= self.start_time_seconds
+        if self.end_time_seconds is not None:
+            mask &= timestamps <= self.end_time_seconds
+        return mask
+
+    def frame_row_json(self, index):
+        """The metadata of a frame as it is given to the model, as JSON."""
+        row_json = self._frame_rows_json.get(index)
+        if row_json is None:
+            row = {"frame": self.frame_number(index)}
+            row.update(
+                (column, values[index].item())
+                for column, values in self.frame_columns.items()
+            )
+            row_json = self._frame_rows_json[index] = json.dumps(row)
+        return row_json
+
+    def frame_number(self, index):
+        """The number in the whole scene video of the frame at index."""
+        return int(self.frame_numbers[index])
+
     async def query_frame(self, index, session):
-        # Check if the frame's timestamp is within the specified time range
-        timestamp = self.frame_metadata.iloc[index]["timestamp [s]"]
-        if not self.is_within_time_range(timestamp):
-            # print(f"Timestamp {timestamp} is not within selected timerange")
-            return None
+        """Queries a single frame, see query_frames."""
+        frame_detections = await self.query_frames([index], session)
+        return frame_detections.get(index) if frame_detections else None
+
+    async def frames_available(self, indices):
+        """
+        Waits until the given frames are encoded, for frames that are still
+        being encoded while the search runs, see StreamingFrames, or that are
+        only encoded when they are needed, see LazyFrameSource.
+        """
+        wait_for = getattr(self.base64_frames, "wait_for", None)
+        if wait_for is not None and len(indices):
+            # Frames are encoded in order
+            await wait_for(max(indices))
+        get = getattr(self.base64_frames, "get", None)
+        if get is not None:
+            # Decoded off the event loop, the request then reads them from
+            # the cache of the source
+            for index in sorted(indices):
+                if self.in_time_range[index]:
+                    await get(index)
 
-        base64_frames_content = [{"image": self.base64_frames[index], "resize": 768}]
-        video_gaze_df_content = [self.frame_metadata.iloc[index].to_dict()]
+    async def score_frames(self, indices):
+        """
+        Rates the frames with the local model of the pre-filter, on a worker
+        thread so that the other requests go on meanwhile.
+        """
+        if self.prefilter is None:
+            return
+        indices = [index for index in indices if self.in_time_range[index]]
+        if self.frame_signatures is not None and self.frame_results:
+            # Near-duplicates of analysed frames are not sent either way
+            analysed = list(self.frame_results)
+            indices = [
+                index
+                for index in indices
+                if self.find_duplicate(index, analysed) is None
+            ]
+        indices = self.prefilter.unscored(indices)
+        if indices:
+            # Lazily encoded frames are cached since frames_available
+            frames = [self.base64_frames[index] for index in indices]
+            await asyncio.to_thread(self.prefilter.score_frames, indices, frames)
 
+    def build_request(self, indices):
+        """
+        The chat request for the given frames, leaving out frames outside the
+        time range, near-duplicates of analysed frames and frames skipped by
+        the pre-filter.
+        :return: the indices of the frames in the request, the reused
+            detections by frame index (see reuse_duplicates, skipped frames
+            have none) and the request
+            parameters, None if no frame is left to query.
+        """
+        # Check if the frames' timestamps are within the specified time range
+        indices = [index for index in indices if self.in_time_range[index]]
+        reused = self.reuse_duplicates(indices)
+        indices = [index for index in indices if index not in reused]
+        if self.prefilter is not None:
+            # Frames the pre-filter rates unlikely count as without activity
+            unscored = self.prefilter.unscored(indices)
+            self.prefilter.score_frames(
+                unscored, [self.base64_frames[index] for index in unscored]
+            )
+            for index in self.prefilter.skip(indices):
+                reused[index] = []
+            indices = [index for index in indices if index not in reused]
+        if not indices:
+            return indices, reused, None
+
+        base64_frames_content = [
+            {"image": self.base64_frames[index], "resize": 768} for index in indices
+        ]
+        video_gaze_df_content = ", ".join(self.frame_row_json(i) for i in indices)
+
+        # Everything that varies per request comes after the shared prefix, so
+        # the provider can reuse its cached computation of the prefix
         PROMPT_MESSAGES = [
-            {
-                "role": "system",
-                "content": (self.base_prompt),
-            },
+            *self.prompt_prefix,
             {
                 "role": "user",
-                "content": f"The frames are extracted from this video and the timestamps and frame numbers are stored in this dataframe: {json.dumps(video_gaze_df_content)}",
+                "content": f"Dataframe: [{video_gaze_df_content}]",
             },
             {"role": "user", "content": base64_frames_content},
         ]
@@ -124,123 +428,605 @@ class FrameProcessor:
         params = {
             "model": "gpt-4o-2024-05-13",  # gpt-4o-2024-05-13 is the old version / gpt-4o-2024-08-06 the newer
             "messages": PROMPT_MESSAGES,
-            "max_tokens": 300,
+            "max_tokens": MAX_TOKENS + OUTPUT_TOKENS_PER_FRAME * (len(indices) - 1),
         }
+        return indices, reused, params
+
+    async def query_frames(self, indices, session):
+        """
+        Sends the given frames to OpenAI in one chat request.
+        :param indices: indices of the frames, in timeline order.
+        :return: the detections parsed from the response by frame index. Frames
+            outside the time range and frames without detections are left out.
+            None if the request failed.
+        """
+        await self.frames_available(indices)
+        await self.score_frames(indices)
+        indices, reused, params = self.build_request(indices)
+        if params is None:
+            return _detected(reused)
+
         headers = {
             "Authorization": f"Bearer {self.openai_api_key}",
             "Content-Type": "application/json",
         }
+        request_tokens = self.request_tokens(len(indices))
+
+        cache_key = None
+        response_message = None
+        if self.response_cache is not None:
+            cache_key = request_key(params)
+            response_message = self.response_cache.get(cache_key)
 
         retry_count = 0
         max_retries = 5
-        while retry_count < max_retries:
-            async with session.post(
-                "https://api.openai.com/v1/chat/completions",
-                headers=headers,
-                json=params,
-            ) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    response_message = result["choices"][0]["message"]["content"]
-                    print("Response from OpenAI API:", response_message)
-
-                    # Updated regex pattern to match the new output format
-                    pattern = (
-                        r"Frame\s(\d+):\sTimestamp\s-\s([\d.]+),\sCode\s-\s(\w+_\w+)"
-                    )
-                    matches = re.findall(pattern, response_message)
-
-                    if matches:
-                        for match in matches:
-                            frame_number = int(match[0])
-                            timestamp = float(match[1])
-                            code = match[2]
-                            # # Check if the activity code is valid
-                            if code not in self.codes:
-                                print("The activity was not detected")
-                                continue
-
-                            # Get the current state of the activity
-                            activity_active = self.activity_states[code]
-
-                            if not activity_active:
-                                # Activity is starting or being detected for the first time
-                                self.activity_states[code] = True
-                                send_event_to_cloud(
-                                    self.workspace_id,
-                                    self.recording_id,
-                                    code,
-                                    timestamp,
-                                    self.cloud_token,
-                                )
-                                logger.info(f"Activity detected: {code}")
-                            else:
-                                # Activity already detected, ignore
-                                logger.debug(
-                                    f"Event for {code} already sent - ignoring."
-                                )
-
-                        return {
-                            "frame_id": frame_number,
-                            "timestamp [s]": timestamp,
-                            "code": code,
-                        }
-                    else:
-                        print("No match found in the response")
-                        return None
-                elif response.status == 429:
-                    retry_count += 1
-                    wait_time = 2**retry_count  # Exponential backoff
-                    logger.warning(
-                        f"Rate limit hit. Retrying in {wait_time} seconds..."
-                    )
-                    await asyncio.sleep(wait_time)
-                else:
+        reason = None
+        while response_message is None and retry_count < max_retries:
+            if retry_count:
+                self.metrics.count("openai_retries")
+            try:
+                async with self.rate_limiter.slot(request_tokens):
+                    # The latency leaves out the wait for the limiter
+                    sent_at = time.perf_counter()
+                    async with session.post(
+                        OPENAI_URL,
+                        headers=headers,
+                        json=params,
+                    ) as response:
+                        self.rate_limiter.update(response.status, response.headers)
+                        self.metrics.count("openai_requests", status=response.status)
+                        if response.status == 200:
+                            result = await response.json()
+                            latency = time.perf_counter() - sent_at
+                            self.usage_stats.add(result.get("usage"), latency)
+                            self.metrics.observe(
+                                "openai_request_latency_seconds", latency
+                            )
+                            message = result["choices"][0]["message"]
+                            response_message = message["content"]
+                            if self.response_cache is not None:
+                                self.response_cache.put(cache_key, response_message)
+                            break
+                        reason = f"HTTP {response.status}"
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                reason = f"{type(e).__name__}: {e}"
+                self.metrics.count("openai_requests", status=type(e).__name__)
+            else:
+                if response.status not in RETRYABLE_STATUSES:
                     logger.debug(f"Error: {response.status}")
+                    self.report_failure(indices, reason)
                     return None
-        print("Max retries reached. Exiting.")
+            retry_count += 1
+            if reason != "HTTP 429":
+                # The limiter only pauses for rate limits
+                await asyncio.sleep(2**retry_count)
+        if response_message is None:
+            self.report_failure(
+                indices, f"gave up after {max_retries} tries ({reason})"
+            )
+            return None
+
+        return self.parse_response(indices, reused, response_message)
+
+    def parse_response(self, indices, reused, response_message):
+        """
+        Reads the detections of the queried frames from a response and adds
+        the reused detections of their near-duplicates.
+        :return: the detections by frame index, see query_frames.
+        """
+        print("Response from OpenAI API:", response_message)
+
+        # Updated regex pattern to match the new output format
+        pattern = r"Frame\s(\d+):\sTimestamp\s-\s([\d.]+),\sCode\s-\s(\w+_\w+)"
+        matches = re.findall(pattern, response_message)
+
+        if not matches:
+            print("No match found in the response")
+
+        frame_detections = {}
+        for match in matches:
+            detection = {
+                "frame_id": int(match[0]),
+                "timestamp [s]": float(match[1]),
+                "code": match[2],
+            }
+            index = self._route_detection(indices, detection)
+            if index is None:
+                logger.warning(f"Ignoring detection of an unknown frame: {detection}")
+                continue
+            frame_detections.setdefault(index, []).append(detection)
+
+        for index in indices:
+            self.frame_results[index] = frame_detections.get(index, [])
+        if self.prefilter is not None:
+            self.prefilter.record(indices, frame_detections)
+        frame_detections.update(_detected(reused))
+        return frame_detections
+
+    async def query_groups_batch(self, session, groups):
+        """
+        Queries groups of frames like query_frames does, but sends all
+        requests the response cache cannot answer as one Batch API job.
+        :param groups: lists of frame indices, one request each.
+        :return: the detections by frame index of every group, None for the
+            groups whose request failed.
+        """
+        planned = []
+        requests = {}
+        for position, group in enumerate(groups):
+            # Group by group, so that lazily encoded frames are still cached
+            # when the request is built
+            await self.frames_available(group)
+            await self.score_frames(group)
+            indices, reused, params = self.build_request(group)
+            cache_key = response_message = None
+            if params is not None and self.response_cache is not None:
+                cache_key = request_key(params)
+                response_message = self.response_cache.get(cache_key)
+            if params is not None and response_message is None:
+                requests[str(position)] = params
+            planned.append((indices, reused, params, cache_key, response_message))
+
+        submitted_at = time.perf_counter()
+        responses = await self.batch_client.run(session, requests)
+        if requests:
+            self.metrics.observe(
+                "openai_batch_latency_seconds", time.perf_counter() - submitted_at
+            )
+
+        outcomes = []
+        for position, planned_request in enumerate(planned):
+            indices, reused, params, cache_key, response_message = planned_request
+            if params is None:
+                outcomes.append(_detected(reused))
+                continue
+            if response_message is None:
+                body, reason = responses[str(position)]
+                self.metrics.count(
+                    "openai_requests", status="failed" if body is None else 200
+                )
+                if body is None:
+                    self.report_failure(indices, reason)
+                    outcomes.append(None)
+                    continue
+                self.usage_stats.add(body.get("usage"))
+                response_message = body["choices"][0]["message"]["content"]
+                if self.response_cache is not None:
+                    self.response_cache.put(cache_key, response_message)
+            outcomes.append(self.parse_response(indices, reused, response_message))
+        return outcomes
+
+    def reuse_duplicates(self, indices):
+        """
+        Finds the frames that are near-duplicates of an already analysed frame,
+        by perceptual hash and gaze position, and gives them that frame's
+        detections instead of querying them.
+        :return: the reused detections by frame index.
+        """
+        reused = {}
+        if self.frame_signatures is None or not self.frame_results:
+            return reused
+        analysed = list(self.frame_results)
+        for index in indices:
+            duplicate = self.find_duplicate(index, analysed)
+            if duplicate is None:
+                continue
+            timestamp = self.timestamps[index]
+            frame_id = self.frame_number(index)
+            reused[index] = [
+                {**detection, "frame_id": frame_id, "timestamp [s]": timestamp}
+                for detection in self.frame_results[duplicate]
+            ]
+            self.num_duplicates_skipped += 1
+            logger.debug(
+                f"Frame {frame_id} is a near-duplicate of frame "
+                f"{self.frame_number(duplicate)}"
+            )
+        return reused
+
+    def find_duplicate(self, index, analysed):
+        """The analysed frame that frame index is a near-duplicate of, or None."""
+        signatures = self.frame_signatures
+        if index >= len(signatures) or not signatures.known[index]:
+            # Lazily encoded frames get their signature once encoded
+            self.base64_frames[index]
+        return signatures.find_duplicate(index, analysed, **self.dedup_params)
+
+    def _route_detection(self, indices, detection):
+        """Finds which of the requested frames a parsed output line is about."""
+        if len(indices) == 1:
+            return indices[0]
+        for index in indices:
+            if self.frame_numbers[index] == detection["frame_id"]:
+                return index
+        for index in indices:
+            timestamp = self.timestamps[index]
+            if abs(timestamp - detection["timestamp [s]"]) < 1e-3:
+                return index
         return None
 
-    async def binary_search(self, session, start, end, identified_activities):
+    def request_tokens(self, num_frames):
+        """Upper bound of the tokens a request of num_frames frames counts
+        against the token budget."""
+        return (
+            len(self.base_prompt) // 4
+            + (IMAGE_TOKENS + PROMPT_OVERHEAD_TOKENS) * num_frames
+            + MAX_TOKENS
+            + OUTPUT_TOKENS_PER_FRAME * (num_frames - 1)
+        )
+
+    def report_failure(self, indices, reason):
+        """Records frames that could not be analysed, so they are not mistaken
+        for frames without activity."""
+        self.metrics.count("failed_frames", len(indices))
+        for index in indices:
+            frame_id = self.frame_number(index)
+            timestamp = self.timestamps[index]
+            logger.warning(
+                f"Giving up on frame {frame_id} at {timestamp:.3f}s: {reason}"
+            )
+            self.failed_frames.append(
+                {"frame_id": frame_id, "timestamp [s]": timestamp, "reason": reason}
+            )
+
+    def handle_detections(self, detections):
+        """Sends an event for every activity that is detected for the first time."""
+        for detection in detections:
+            code = detection["code"]
+            # # Check if the activity code is valid
+            if code not in self.codes:
+                print("The activity was not detected")
+                continue
+
+            # Get the current state of the activity
+            activity_active = self.activity_states[code]
+
+            if not activity_active:
+                # Activity is starting or being detected for the first time
+                self.activity_states[code] = True
+                self.event_publisher.publish(code, detection["timestamp [s]"])
+                logger.info(f"Activity detected: {code}")
+            else:
+                # Activity already detected, ignore
+                logger.debug(f"Event for {code} already sent - ignoring.")
+
+    def probe_indices(self, start, end):
+        """
+        Frames queried for the range [start, end): frames_per_request frames
+        splitting it into equal parts, or all of them if the range is that short.
+        With one frame per request this is the middle frame.
+        """
+        k = self.frames_per_request
+        if end - start <= k:
+            return list(range(start, end))
+        return [start + (i * (end - start)) // (k + 1) for i in range(1, k + 1)]
+
+    async def binary_search(self, session, start, end, detections):
+        """
+        Searches the frames [start, end) by querying the probe frames in one
+        request and continuing left of the first probe with a hit, or right of
+        the last probe if none has one. With one frame per request this is a
+        binary search on the middle frame.
+        :param detections: list that the detections of every frame with a hit
+            are appended to, in query order.
+        :return: the last detection of every frame with a hit, in query order.
+        """
         if start >= end:
             return []
 
-        mid = (start + end) // 2
+        probes = self.probe_indices(start, end)
 
+        # Process the probe frames and ensure both prompts are evaluated
+        frame_detections = await self.query_frames(probes, session) or {}
+        results, (start, end) = self.narrow_range(
+            start, end, probes, frame_detections, detections
+        )
+        results.extend(await self.binary_search(session, start, end, detections))
+        return results
+
+    def narrow_range(self, start, end, probes, frame_detections, detections):
+        """
+        A step of binary_search: appends the detections of the probes with a
+        hit to detections and picks the range to search next, left of the
+        first probe with a hit or right of the last probe if none has one.
+        :return: the last detection of every probe with a hit and the range.
+        """
         results = []
-        # Process the mid frame and ensure both prompts are evaluated
-        mid_frame_result = await self.query_frame(mid, session)
-        if mid_frame_result:
-            activity = mid_frame_result["code"]
+        hits = [index for index in probes if frame_detections.get(index)]
+        for index in hits:
+            detections.append(frame_detections[index])
+            results.append(frame_detections[index][-1])
+        if hits:
+            previous = [index for index in probes if index < hits[0]]
+            return results, (previous[-1] + 1 if previous else start, hits[0])
+        return results, (probes[-1] + 1, end)
+
+    async def _search_batch(self, session, start, end):
+        detections = []
+        results = await self.binary_search(session, start, end, detections)
+        return results, detections
+
+    async def process_batches(self, session, batch_size):
+        """
+        Searches all batches concurrently, with at most max_concurrency
+        requests in flight. The outcome of each batch is applied in timeline
+        order once all earlier batches are done, so events and results are the
+        same as when searching the batches one after another.
+        """
+        tasks = [
+            asyncio.create_task(
+                self._search_batch(
+                    session, i, min(i + batch_size, len(self.base64_frames))
+                )
+            )
+            for i in range(0, len(self.base64_frames), batch_size)
+        ]
+        all_results = []
+        try:
+            for task in tasks:
+                self.apply_batch(*await task, all_results)
+        finally:
+            for task in tasks:
+                task.cancel()
+        return all_results
+
+    def apply_batch(self, batch_results, detections, all_results):
+        """Sends the events of a searched batch and adds the first result of
+        every activity that is not in all_results yet."""
+        for frame_detections in detections:
+            self.handle_detections(frame_detections)
+        identified_activities = {result["code"] for result in all_results}
+        for result in batch_results:
+            activity = result["code"]
             if activity not in identified_activities:
                 identified_activities.add(activity)
-                results.append(mid_frame_result)
-            left_results = await self.binary_search(
-                session, start, mid, identified_activities
+                all_results.append(result)
+
+    async def batch_binary_search(self, session, batch_size):
+        """
+        The search of process_batches in rounds for the batch backend: each
+        round plans the probe frames of every batch that is still being
+        searched, sends them as one batch job and narrows down the batches
+        like binary_search does.
+        """
+        num_frames = len(self.base64_frames)
+        ranges = {
+            i: (i, min(i + batch_size, num_frames))
+            for i in range(0, num_frames, batch_size)
+        }
+        outcomes = {i: ([], []) for i in ranges}
+        num_rounds = 0
+        while ranges:
+            probes = {i: self.probe_indices(*ranges[i]) for i in ranges}
+            responses = await self.query_groups_batch(session, list(probes.values()))
+            num_rounds += 1
+            for (i, batch_probes), frame_detections in zip(probes.items(), responses):
+                batch_results, detections = outcomes[i]
+                results, (start, end) = self.narrow_range(
+                    *ranges.pop(i), batch_probes, frame_detections or {}, detections
+                )
+                batch_results.extend(results)
+                if start < end:
+                    ranges[i] = (start, end)
+        logger.info(f"Batch search took {num_rounds} rounds")
+
+        all_results = []
+        for i in sorted(outcomes):
+            self.apply_batch(*outcomes[i], all_results)
+        return all_results
+
+    def frames_in_range(self):
+        """First and last index of the frames within the time range, or None."""
+        in_range = np.flatnonzero(self.in_time_range)
+        return (int(in_range[0]), int(in_range[-1])) if len(in_range) else None
+
+    async def query_code_sets(self, session, indices):
+        """
+        Queries frames, frames_per_request of them per request.
+        :return: the set of valid activity codes detected in each frame, by
+            index. Frames whose request failed are left out.
+        """
+        groups = self.group_frames(indices)
+        responses = await asyncio.gather(
+            *(self.query_frames(group, session) for group in groups)
+        )
+        return self.code_sets(groups, responses)
+
+    def group_frames(self, indices):
+        """Splits frames into requests of frames_per_request frames."""
+        k = self.frames_per_request
+        return [indices[i : i + k] for i in range(0, len(indices), k)]
+
+    def code_sets(self, groups, responses):
+        """The valid codes detected in each frame of the groups, by index,
+        leaving out the groups whose request failed."""
+        code_sets = {}
+        for group, frame_detections in zip(groups, responses):
+            if frame_detections is None:
+                continue
+            for index in group:
+                code_sets[index] = frozenset(
+                    detection["code"]
+                    for detection in frame_detections.get(index, [])
+                    if detection["code"] in self.codes
+                )
+        return code_sets
+
+    async def refine_boundary(self, session, start, end, code_sets):
+        """
+        Narrows down where the detected codes change between the frames start
+        and end, which are both in code_sets, until the frames on either side
+        of every change are at most the tolerance apart. Adds all queried frames
+        to code_sets.
+        """
+        if end - start <= self.search_params["tolerance"]:
+            return
+        probes = self.refine_probes(start, end)
+        code_sets.update(await self.query_code_sets(session, probes))
+        if not any(probe in code_sets for probe in probes):
+            return
+        await asyncio.gather(
+            *(
+                self.refine_boundary(session, a, b, code_sets)
+                for a, b in self.changes([start, *probes, end], code_sets)
             )
-            results.extend(left_results)
-        else:
-            right_results = await self.binary_search(
-                session, mid + 1, end, identified_activities
+        )
+
+    def refine_probes(self, start, end):
+        """The frames_per_request frames splitting (start, end) evenly."""
+        k = self.frames_per_request
+        return sorted(
+            {start + (i * (end - start)) // (k + 1) for i in range(1, k + 1)}
+            - {start, end}
+        )
+
+    def changes(self, indices, code_sets):
+        """Pairs of consecutive known frames whose detected codes differ."""
+        known = [index for index in indices if index in code_sets]
+        return [
+            (a, b) for a, b in zip(known, known[1:]) if code_sets[a] != code_sets[b]
+        ]
+
+    def sample_frames(self):
+        """The frames of the coarse pass, every stride frames of the time
+        range and its last frame, or None if no frame is in the range."""
+        frame_range = self.frames_in_range()
+        if frame_range is None:
+            return None
+        first, last = frame_range
+        samples = list(range(first, last + 1, self.search_params["stride"]))
+        if samples[-1] != last:
+            samples.append(last)
+        return samples
+
+    async def coarse_to_fine_search(self, session):
+        """
+        Samples the frames in the time range every search_params["stride"]
+        frames, then refines every interval in which the detected codes change
+        down to search_params["tolerance"] frames. Each occurrence of an
+        activity yields a start event at the first and an end event at the
+        last frame it was detected in.
+        :return: the events in timeline order.
+        """
+        samples = self.sample_frames()
+        if samples is None:
+            return []
+        code_sets = await self.query_code_sets(session, samples)
+        await asyncio.gather(
+            *(
+                self.refine_boundary(session, a, b, code_sets)
+                for a, b in self.changes(samples, code_sets)
             )
-            results.extend(right_results)
-        return results
+        )
+        return self.publish_occurrences(code_sets)
 
-    async def process_batches(self, session, batch_size):
-        identified_activities = set()
-        all_results = []
-        for i in range(0, len(self.base64_frames), batch_size):
-            end = min(i + batch_size, len(self.base64_frames))
-            batch_results = await self.binary_search(
-                session, i, end, identified_activities
+    async def batch_coarse_to_fine_search(self, session):
+        """
+        coarse_to_fine_search in rounds for the batch backend: the coarse
+        samples are sent as one batch job, then each round refines all
+        intervals in which the detected codes change with one more job.
+        """
+        samples = self.sample_frames()
+        if samples is None:
+            return []
+        groups = self.group_frames(samples)
+        responses = await self.query_groups_batch(session, groups)
+        code_sets = self.code_sets(groups, responses)
+        intervals = self.changes(samples, code_sets)
+        tolerance = self.search_params["tolerance"]
+        while True:
+            intervals = [(a, b) for a, b in intervals if b - a > tolerance]
+            if not intervals:
+                break
+            groups = [self.refine_probes(a, b) for a, b in intervals]
+            responses = await self.query_groups_batch(session, groups)
+            code_sets.update(self.code_sets(groups, responses))
+            refined = []
+            for (a, b), probes in zip(intervals, groups):
+                # Like refine_boundary, give up on intervals whose probes failed
+                if any(probe in code_sets for probe in probes):
+                    refined += self.changes([a, *probes, b], code_sets)
+            intervals = refined
+        return self.publish_occurrences(code_sets)
+
+    def publish_occurrences(self, code_sets):
+        """
+        Sends a start event at the first and an end event at the last frame of
+        every occurrence of an activity in the queried frames.
+        :return: the events in timeline order.
+        """
+        first, last = self.frames_in_range()
+        logger.info(
+            f"Coarse-to-fine search queried {len(code_sets)} of "
+            f"{last - first + 1} frames"
+        )
+        known = sorted(code_sets)
+        events = []
+        for code in self.codes:
+            onset = previous = None
+            for index in known:
+                if code in code_sets[index]:
+                    if onset is None:
+                        onset = index
+                    previous = index
+                elif onset is not None:
+                    events += [(onset, 0, code), (previous, 1, code)]
+                    onset = None
+            if onset is not None:
+                events += [(onset, 0, code), (previous, 1, code)]
+
+        results = []
+        for index, kind, code in sorted(events):
+            timestamp = self.timestamps[index]
+            event = f"{code}{EVENT_SUFFIXES[kind]}"
+            self.event_publisher.publish(event, timestamp)
+            logger.info(f"Activity {'ended' if kind else 'started'}: {code}")
+            results.append(
+                {
+                    "frame_id": self.frame_number(index),
+                    "timestamp [s]": timestamp,
+                    "code": code,
+                    "event": event,
+                }
             )
-            all_results.extend(batch_results)
-        return all_results
+        return results
 
     async def prompting(self, save_path, batch_size):
-        async with aiohttp.ClientSession() as session:
-            activity_data = await self.process_batches(session, batch_size)
+        async with aiohttp.ClientSession() as session, EventPublisher(
+            self.workspace_id, self.recording_id, self.cloud_token, metrics=self.metrics
+        ) as self.event_publisher:
+            if self.backend == "batch":
+                if self.search_strategy == "coarse_to_fine":
+                    activity_data = await self.batch_coarse_to_fine_search(session)
+                else:
+                    activity_data = await self.batch_binary_search(
+                        session, batch_size
+                    )
+            elif self.search_strategy == "coarse_to_fine":
+                activity_data = await self.coarse_to_fine_search(session)
+            else:
+                activity_data = await self.process_batches(session, batch_size)
             print("Filtered Activity Data:", activity_data)
+            if self.frame_signatures is not None:
+                logger.info(
+                    f"Skipped {self.num_duplicates_skipped} near-duplicate frames"
+                )
+            if self.failed_frames:
+                logger.warning(
+                    f"{len(self.failed_frames)} frames could not be analysed, "
+                    "see failed_frames.csv"
+                )
+                pd.DataFrame(self.failed_frames).to_csv(
+                    os.path.join(save_path, "failed_frames.csv"), index=False
+                )
+            if self.prefilter is not None:
+                self.prefilter.log_report()
+                scores = self.prefilter.scores_table()
+                positions = scores["frame"].to_numpy(np.int64)
+                scores["frame"] = self.frame_numbers[positions]
+                scores.to_csv(
+                    os.path.join(save_path, PREFILTER_SCORES_NAME), index=False
+                )
             output_df = pd.DataFrame(activity_data)
             output_df.to_csv(
                 os.path.join(save_path, "output_detected_events.csv"), index=False
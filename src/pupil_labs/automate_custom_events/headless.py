@@ -0,0 +1,373 @@
+import argparse
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+from pupil_labs.automate_custom_events import video_utils
+from pupil_labs.automate_custom_events.artifact_cache import evict_recordings
+from pupil_labs.automate_custom_events.cloud_interaction import extract_ids
+from pupil_labs.automate_custom_events.control_modules import (
+    detect_events,
+    fetch_recording,
+    prepare_frames,
+)
+from pupil_labs.automate_custom_events.frame_processor import (
+    BACKENDS,
+    SEARCH_STRATEGIES,
+)
+from pupil_labs.automate_custom_events.prefilter import (
+    PREFILTER_PARAMS,
+    load_onnx_scorer,
+)
+from pupil_labs.automate_custom_events.run_metrics import RunMetrics
+
+SUMMARY_NAME = "batch_summary.csv"
+
+# Recordings handled at once by each stage. Downloads and the gaze merge,
+# overlay and encoding run on worker threads, querying on the event loop, so
+# one recording can be downloaded or rendered while others are queried.
+STAGE_WORKERS = {"download": 2, "prepare": 1, "query": 4}
+
+
+def read_manifest(path):
+    """
+    Reads the recordings listed in a manifest file, one recording ID or
+    recording link per line. Blank lines and lines starting with # are
+    skipped.
+    """
+    lines = Path(path).read_text().splitlines()
+    return [line.strip() for line in lines if line.strip() and not line.startswith("#")]
+
+
+def parse_recording(value, workspace_id=None):
+    """
+    The workspace and recording ID of a recording given by its ID or by its
+    link, which also names the workspace.
+
+    >>> parse_recording("0f3d-11", "ws")
+    ('ws', '0f3d-11')
+    >>> parse_recording(
+    ...     "https://cloud.pupil-labs.com/workspaces/ab12/recordings?id=0f3d-11&x=1"
+    ... )
+    ('ab12', '0f3d-11')
+    """
+    link_workspace_id, recording_id = extract_ids(value)
+    if recording_id is None:
+        return workspace_id, value.strip()
+    return link_workspace_id or workspace_id, recording_id
+
+
+def _timed(function, *args, **kwargs):
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+class BatchRunner:
+    """
+    Annotates many recordings with the stages of run_modules, overlapping the
+    stages of different recordings with a separate number of workers each.
+
+    :param stage_workers: recordings handled at once per stage, see
+        STAGE_WORKERS.
+    :param prepare_options: keyword arguments of prepare_frames.
+    :param query_options: keyword arguments of detect_events.
+    """
+
+    def __init__(
+        self,
+        openai_api_key,
+        cloud_api_key,
+        download_path,
+        description,
+        event_code,
+        batch_size,
+        start_time_seconds=None,
+        end_time_seconds=None,
+        stage_workers=None,
+        cache_size_limit_gb=None,
+        skip_duplicate_frames=True,
+        prepare_options=None,
+        query_options=None,
+    ):
+        self.openai_api_key = openai_api_key
+        self.cloud_api_key = cloud_api_key
+        self.download_path = Path(download_path)
+        self.description = description
+        self.event_code = event_code
+        self.batch_size = batch_size
+        self.start_time_seconds = start_time_seconds
+        self.end_time_seconds = end_time_seconds
+        self.stage_workers = {**STAGE_WORKERS, **(stage_workers or {})}
+        self.cache_size_limit_gb = cache_size_limit_gb
+        self.skip_duplicate_frames = skip_duplicate_frames
+        self.prepare_options = prepare_options or {}
+        self.query_options = query_options or {}
+        self._active = set()
+        self._pools = {}
+        self._admitted = None
+        self._query_slots = None
+
+    async def run(self, recordings):
+        """
+        Runs every recording through download, preparation and querying. A
+        failing recording is reported in the summary and does not stop the
+        others.
+        :param recordings: (workspace ID, recording ID) pairs.
+        :return: the summary, one row per recording in the given order.
+        """
+        workers = self.stage_workers
+        # Recordings admitted at once; bounds the prepared recordings that
+        # hold open videos while they wait for a query worker
+        self._admitted = asyncio.Semaphore(sum(workers.values()))
+        self._query_slots = asyncio.Semaphore(workers["query"])
+        self._pools = {
+            stage: ThreadPoolExecutor(workers[stage], thread_name_prefix=stage)
+            for stage in ("download", "prepare")
+        }
+        try:
+            rows = await asyncio.gather(
+                *(
+                    self.run_recording(workspace_id, rec_id)
+                    for workspace_id, rec_id in recordings
+                )
+            )
+        finally:
+            for pool in self._pools.values():
+                pool.shutdown()
+        return pd.DataFrame(rows).astype({"events": "Int64"})
+
+    async def run_recording(self, workspace_id, rec_id):
+        """Processes one recording.
+        :return: its row of the summary."""
+        row = {
+            "recording_id": rec_id,
+            "status": "ok",
+            "events": None,
+            "download_s": None,
+            "prepare_s": None,
+            "query_s": None,
+            "total_s": None,
+        }
+        loop = asyncio.get_running_loop()
+        metrics = RunMetrics(rec_id)
+        async with self._admitted:
+            self._active.add(rec_id)
+            started = time.perf_counter()
+            try:
+                cache, row["download_s"] = await loop.run_in_executor(
+                    self._pools["download"],
+                    lambda: _timed(
+                        fetch_recording,
+                        rec_id,
+                        workspace_id,
+                        self.cloud_api_key,
+                        self.download_path,
+                        metrics=metrics,
+                    ),
+                )
+                prepared, row["prepare_s"] = await loop.run_in_executor(
+                    self._pools["prepare"],
+                    lambda: _timed(
+                        prepare_frames,
+                        cache,
+                        self.start_time_seconds,
+                        self.end_time_seconds,
+                        metrics=metrics,
+                        **self.prepare_options,
+                    ),
+                )
+                base64_frames, frame_metadata, frame_signatures, _ = prepared
+                async with self._query_slots:
+                    query_started = time.perf_counter()
+                    events = await detect_events(
+                        cache,
+                        base64_frames,
+                        frame_metadata,
+                        frame_signatures if self.skip_duplicate_frames else None,
+                        self.openai_api_key,
+                        workspace_id,
+                        self.cloud_api_key,
+                        self.description,
+                        self.event_code,
+                        self.batch_size,
+                        self.start_time_seconds,
+                        self.end_time_seconds,
+                        metrics=metrics,
+                        **self.query_options,
+                    )
+                    row["query_s"] = time.perf_counter() - query_started
+                row["events"] = len(events)
+            except Exception as e:
+                logging.error(f"Recording {rec_id} failed: {e}", exc_info=True)
+                row["status"] = f"failed: {type(e).__name__}: {e}"
+            finally:
+                row["total_s"] = time.perf_counter() - started
+                self._active.discard(rec_id)
+            if self.cache_size_limit_gb is not None:
+                evict_recordings(
+                    self.download_path,
+                    int(self.cache_size_limit_gb * 1e9),
+                    keep=self._active,
+                )
+        logging.info(f"Recording {rec_id}: {row['status']} after {row['total_s']:.1f}s")
+        return row
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="pl-automate-custom-events-batch",
+        description="Annotates many Pupil Cloud recordings without the GUI.",
+    )
+    parser.add_argument(
+        "recordings", nargs="*", help="recording IDs or recording links"
+    )
+    parser.add_argument(
+        "--manifest", help="file with one recording ID or link per line"
+    )
+    parser.add_argument(
+        "--workspace", help="workspace of the recordings given by their ID"
+    )
+    parser.add_argument("--description", required=True, help="activities, ;-separated")
+    parser.add_argument("--codes", required=True, help="event codes, ;-separated")
+    parser.add_argument("--download-path", default=Path.cwd(), type=Path)
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--start", type=int, default=0, help="start of the window (s)")
+    parser.add_argument("--end", type=int, help="end of the window (s)")
+    parser.add_argument(
+        "--openai-api-key",
+        default=os.environ.get("OPENAI_API_KEY"),
+        help="defaults to $OPENAI_API_KEY",
+    )
+    parser.add_argument(
+        "--cloud-api-key",
+        default=os.environ.get("PUPIL_CLOUD_API_KEY"),
+        help="defaults to $PUPIL_CLOUD_API_KEY",
+    )
+    for stage, workers in STAGE_WORKERS.items():
+        parser.add_argument(
+            f"--{stage}-workers",
+            type=int,
+            default=workers,
+            help=f"recordings in the {stage} stage at once",
+        )
+    parser.add_argument(
+        "--overlay-workers",
+        type=int,
+        default=1,
+        help="worker processes per overlay render",
+    )
+    parser.add_argument(
+        "--query-concurrency",
+        type=int,
+        default=8,
+        help="OpenAI requests in flight, shared by all recordings",
+    )
+    parser.add_argument("--frames-per-request", type=int, default=1)
+    parser.add_argument(
+        "--search-strategy", choices=SEARCH_STRATEGIES, default="binary"
+    )
+    parser.add_argument("--backend", choices=BACKENDS, default="live")
+    parser.add_argument(
+        "--prefilter-model",
+        type=Path,
+        help="folder with an ONNX CLIP model to skip unlikely frames with",
+    )
+    parser.add_argument(
+        "--prefilter-threshold", type=float, default=PREFILTER_PARAMS["threshold"]
+    )
+    parser.add_argument(
+        "--prefilter-audit-every",
+        type=int,
+        default=PREFILTER_PARAMS["audit_every"],
+        help="send every n-th skipped frame anyway to estimate the recall",
+    )
+    parser.add_argument("--cache-size-limit-gb", type=float)
+    parser.add_argument(
+        "--prometheus",
+        action="store_true",
+        help="also write the run metrics of each recording as run_metrics.prom",
+    )
+    parser.add_argument(
+        "--summary", type=Path, help=f"defaults to DOWNLOAD_PATH/{SUMMARY_NAME}"
+    )
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    values = list(args.recordings)
+    if args.manifest:
+        values += read_manifest(args.manifest)
+    if not values:
+        parser.error("no recordings given")
+    args.recordings = [parse_recording(value, args.workspace) for value in values]
+    missing = [rec_id for workspace_id, rec_id in args.recordings if not workspace_id]
+    if missing:
+        parser.error(f"no workspace for {', '.join(missing)}, use --workspace")
+    if not args.openai_api_key or not args.cloud_api_key:
+        parser.error("the OpenAI and Pupil Cloud API keys are required")
+    return args
+
+
+def run_main(argv=None):
+    args = parse_args(argv)
+
+    logger = logging.getLogger()
+    logger.handlers = []
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter("%(asctime)s - %(threadName)s - %(levelname)s - %(message)s")
+    )
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    video_utils.SHOW_PROGRESS = args.prepare_workers == 1
+
+    runner = BatchRunner(
+        args.openai_api_key,
+        args.cloud_api_key,
+        args.download_path,
+        args.description,
+        args.codes,
+        args.batch_size,
+        args.start,
+        args.end,
+        stage_workers={
+            stage: getattr(args, f"{stage}_workers") for stage in STAGE_WORKERS
+        },
+        cache_size_limit_gb=args.cache_size_limit_gb,
+        prepare_options={"overlay_workers": args.overlay_workers},
+        query_options={
+            "query_concurrency": args.query_concurrency,
+            "frames_per_request": args.frames_per_request,
+            "search_strategy": args.search_strategy,
+            "query_backend": args.backend,
+            "prometheus_metrics": args.prometheus,
+            "prefilter_scorer": (
+                load_onnx_scorer(args.prefilter_model) if args.prefilter_model else None
+            ),
+            "prefilter_params": {
+                "threshold": args.prefilter_threshold,
+                "audit_every": args.prefilter_audit_every,
+            },
+        },
+    )
+    started = time.perf_counter()
+    summary = asyncio.run(runner.run(args.recordings))
+    summary_path = args.summary or args.download_path / SUMMARY_NAME
+    summary.to_csv(summary_path, index=False)
+
+    print(summary.to_string(index=False, float_format="{:.1f}".format))
+    failed = (summary["status"] != "ok").sum()
+    logging.info(
+        f"{len(summary) - failed} of {len(summary)} recordings done in "
+        f"{time.perf_counter() - started:.0f}s, summary in {summary_path}"
+    )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(run_main())
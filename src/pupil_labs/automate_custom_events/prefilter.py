@@ -0,0 +1,324 @@
+import base64
+import functools
+import logging
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import cv2
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+PREFILTER_SCORES_NAME = "prefilter_scores.csv"
+
+# Frames scoring below threshold are not sent to the remote model, except
+# every audit_every-th of them, whose answers estimate the recall lost by
+# skipping. CLIP similarities of matching image-text pairs are around 0.25 to
+# 0.35, calibrate the threshold on the prefilter_scores.csv of a run.
+PREFILTER_PARAMS = {"threshold": 0.2, "audit_every": 20}
+
+# Input size and normalisation of the CLIP image encoders
+CLIP_IMAGE_SIZE = 224
+CLIP_MEAN = np.array([0.48145466, 0.4578275, 0.40821073], np.float32)
+CLIP_STD = np.array([0.26862954, 0.26130258, 0.27577711], np.float32)
+CLIP_CONTEXT_LENGTH = 77
+
+# Files of a model folder for OnnxClipScorer.from_dir
+ONNX_MODEL_FILES = {
+    "image_model": "image_model.onnx",
+    "text_model": "text_model.onnx",
+    "tokenizer": "tokenizer.json",
+}
+
+
+class FrameScorer(ABC):
+    """
+    Scores how likely frames show any of the activities, for Prefilter.
+    Scorers are shared by the processors of several recordings and must not
+    keep per-run state.
+    """
+
+    @abstractmethod
+    def score(self, images: List[np.ndarray], activities: Sequence[str]) -> np.ndarray:
+        """
+        :param images: BGR images of the frames.
+        :param activities: descriptions of the activities.
+        :return: one score per image, higher meaning more likely.
+        """
+
+
+def clip_preprocess(img: np.ndarray, size: int = CLIP_IMAGE_SIZE) -> np.ndarray:
+    """
+    Resizes a BGR image so that its short side is size, crops its centre and
+    normalises it like the CLIP image encoders expect.
+
+    >>> clip_preprocess(np.zeros((1080, 1088, 3), np.uint8)).shape
+    (3, 224, 224)
+    """
+    height, width = img.shape[:2]
+    scale = size / min(height, width)
+    resized = cv2.resize(
+        img,
+        (max(size, round(width * scale)), max(size, round(height * scale))),
+        interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC,
+    )
+    top = (resized.shape[0] - size) // 2
+    left = (resized.shape[1] - size) // 2
+    crop = resized[top : top + size, left : left + size, ::-1]
+    normalised = (crop.astype(np.float32) / 255 - CLIP_MEAN) / CLIP_STD
+    return normalised.transpose(2, 0, 1)
+
+
+def _normalise(embeddings: np.ndarray) -> np.ndarray:
+    return embeddings / np.linalg.norm(embeddings, axis=-1, keepdims=True)
+
+
+class OnnxClipScorer(FrameScorer):
+    """
+    Scores frames by the cosine similarity of their CLIP image embedding to
+    the text embeddings of the activities, with the image and text encoders
+    exported to ONNX and run on the CPU by onnxruntime. The score of a frame
+    is its similarity to the closest activity.
+
+    Needs the onnxruntime and tokenizers packages, see the prefilter extra.
+
+    :param image_model: ONNX image encoder taking pixel_values of shape
+        (batch, 3, 224, 224) and returning the image embeddings.
+    :param text_model: ONNX text encoder taking input_ids and attention_mask
+        and returning the text embeddings.
+    :param tokenizer: tokenizer.json of the text encoder.
+    """
+
+    def __init__(
+        self,
+        image_model: Union[str, Path],
+        text_model: Union[str, Path],
+        tokenizer: Union[str, Path],
+        num_threads: Optional[int] = None,
+    ):
+        try:
+            import onnxruntime
+            from tokenizers import Tokenizer
+        except ImportError as e:
+            raise ImportError(
+                "The ONNX pre-filter needs onnxruntime and tokenizers, install "
+                "pupil-labs-automate-custom-events[prefilter]"
+            ) from e
+
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        providers = ["CPUExecutionProvider"]
+        self.image_session = onnxruntime.InferenceSession(
+            str(image_model), options, providers=providers
+        )
+        self.text_session = onnxruntime.InferenceSession(
+            str(text_model), options, providers=providers
+        )
+        self.tokenizer = Tokenizer.from_file(str(tokenizer))
+        self.tokenizer.enable_padding(length=CLIP_CONTEXT_LENGTH)
+        self.tokenizer.enable_truncation(CLIP_CONTEXT_LENGTH)
+        self._text_embeddings: Dict[Tuple[str, ...], np.ndarray] = {}
+
+    @classmethod
+    def from_dir(cls, model_dir: Union[str, Path], num_threads=None):
+        """Loads the models of a folder with the files of ONNX_MODEL_FILES."""
+        model_dir = Path(model_dir)
+        paths = {key: model_dir / name for key, name in ONNX_MODEL_FILES.items()}
+        return cls(**paths, num_threads=num_threads)
+
+    def _run(self, session, feeds):
+        names = {model_input.name for model_input in session.get_inputs()}
+        return session.run(None, {k: v for k, v in feeds.items() if k in names})[0]
+
+    def text_embeddings(self, activities: Sequence[str]) -> np.ndarray:
+        key = tuple(activities)
+        if key not in self._text_embeddings:
+            encodings = self.tokenizer.encode_batch(list(activities))
+            feeds = {
+                "input_ids": np.array([e.ids for e in encodings], np.int64),
+                "attention_mask": np.array(
+                    [e.attention_mask for e in encodings], np.int64
+                ),
+            }
+            self._text_embeddings[key] = _normalise(self._run(self.text_session, feeds))
+        return self._text_embeddings[key]
+
+    def score(self, images, activities):
+        pixel_values = np.stack([clip_preprocess(img) for img in images])
+        image_embeddings = _normalise(
+            self._run(self.image_session, {"pixel_values": pixel_values})
+        )
+        similarities = image_embeddings @ self.text_embeddings(activities).T
+        return similarities.max(axis=1)
+
+
+@functools.lru_cache(maxsize=None)
+def load_onnx_scorer(model_dir, num_threads=None):
+    """The OnnxClipScorer of a model folder, loaded once per process."""
+    return OnnxClipScorer.from_dir(model_dir, num_threads)
+
+
+def decode_frame(base64_frame: str):
+    """Decodes a base64 frame as sent to the model to a BGR image."""
+    buffer = np.frombuffer(base64.b64decode(base64_frame), np.uint8)
+    return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+
+
+class Prefilter:
+    """
+    Decides which frames of a run reach the remote model: frames that a local
+    FrameScorer rates below the threshold count as showing no activity.
+
+    Every audit_every-th skipped frame is sent anyway. The share of audited
+    frames the remote model finds activities in estimates how many positives
+    the skipped frames hold, which gives the recall of the pre-filter next to
+    the share of remote calls it saves.
+
+    :param scorer: the FrameScorer.
+    :param params: overrides of PREFILTER_PARAMS. Frames scoring below
+        "threshold" are skipped, every "audit_every"-th of them is sent
+        anyway, 0 sends none.
+    """
+
+    def __init__(self, scorer: FrameScorer, params: Optional[dict] = None):
+        self.scorer = scorer
+        params = {**PREFILTER_PARAMS, **(params or {})}
+        self.threshold = float(params["threshold"])
+        self.audit_every = int(params["audit_every"])
+        self.activities: Sequence[str] = ()
+        self.scores: Dict[int, float] = {}
+        # Decision and remote answer by frame index
+        self.decisions: Dict[int, str] = {}
+        self.detected: Dict[int, bool] = {}
+        self.num_below_threshold = 0
+
+    def unscored(self, indices) -> List[int]:
+        return [index for index in indices if index not in self.scores]
+
+    def score_frames(self, indices, base64_frames) -> None:
+        """Scores frames, given as their base64 frames in the order of indices."""
+        if not indices:
+            return
+        images = [decode_frame(base64_frame) for base64_frame in base64_frames]
+        scores = self.scorer.score(images, self.activities)
+        self.scores.update(zip(indices, (float(score) for score in scores)))
+
+    def skip(self, indices) -> List[int]:
+        """
+        Decides which of the given scored frames are not sent.
+        :return: the skipped frames.
+        """
+        skipped = []
+        for index in indices:
+            decision = self.decisions.get(index)
+            if decision is None:
+                decision = "escalated"
+                if self.scores[index] < self.threshold:
+                    self.num_below_threshold += 1
+                    audit = (
+                        self.audit_every
+                        and self.num_below_threshold % self.audit_every == 0
+                    )
+                    decision = "audited" if audit else "skipped"
+                self.decisions[index] = decision
+            if decision == "skipped":
+                skipped.append(index)
+        return skipped
+
+    def record(self, indices, frame_detections) -> None:
+        """Notes which of the sent frames the remote model found activities in."""
+        for index in indices:
+            if index in self.decisions:
+                self.detected[index] = bool(frame_detections.get(index))
+
+    def report(self) -> dict:
+        decisions = list(self.decisions.values())
+        escalated = decisions.count("escalated")
+        skipped = decisions.count("skipped")
+        audited = decisions.count("audited")
+        escalated_positives = sum(
+            self.detected.get(index, False)
+            for index, decision in self.decisions.items()
+            if decision == "escalated"
+        )
+        audited_positives = sum(
+            self.detected.get(index, False)
+            for index, decision in self.decisions.items()
+            if decision == "audited"
+        )
+        recall = None
+        if audited:
+            # Positives among the frames below the threshold, sent or not
+            below = audited_positives / audited * (skipped + audited)
+            if escalated_positives + below:
+                recall = escalated_positives / (escalated_positives + below)
+        return {
+            "threshold": self.threshold,
+            "frames_scored": len(self.scores),
+            "frames_escalated": escalated,
+            "frames_skipped": skipped,
+            "frames_audited": audited,
+            "positives_escalated": escalated_positives,
+            "positives_audited": audited_positives,
+            "call_reduction": skipped / max(len(decisions), 1),
+            "recall_estimate": recall,
+        }
+
+    def log_report(self) -> None:
+        report = self.report()
+        logger.info(
+            f"Pre-filter skipped {report['frames_skipped']} of "
+            f"{len(self.decisions)} frames "
+            f"({100 * report['call_reduction']:.0f}% fewer remote calls)"
+        )
+        if report["recall_estimate"] is not None:
+            logger.info(
+                f"Estimated pre-filter recall {100 * report['recall_estimate']:.0f}% "
+                f"from {report['frames_audited']} audited frames"
+            )
+
+    def scores_table(self) -> pd.DataFrame:
+        """The score, decision and remote answer of every scored frame, to
+        calibrate the threshold with threshold_sweep."""
+        indices = sorted(self.scores)
+        return pd.DataFrame(
+            {
+                "frame": indices,
+                "score": [self.scores[index] for index in indices],
+                "decision": [self.decisions.get(index) for index in indices],
+                "detected": pd.array(
+                    [self.detected.get(index) for index in indices], dtype="boolean"
+                ),
+            }
+        )
+
+
+def threshold_sweep(scores, detected, thresholds) -> pd.DataFrame:
+    """
+    Recall and call reduction of a pre-filter at several thresholds, from
+    frames whose remote answers are known, e.g. the sent frames of a run with
+    a low threshold.
+
+    >>> sweep = threshold_sweep(
+    ...     [0.1, 0.15, 0.25, 0.3], [False, True, True, True], [0.12, 0.2]
+    ... )
+    >>> sweep.round(2).to_dict("records")
+    [{'threshold': 0.12, 'recall': 1.0, 'call_reduction': 0.25}, \
+{'threshold': 0.2, 'recall': 0.67, 'call_reduction': 0.5}]
+    """
+    scores = np.asarray(scores, np.float64)
+    detected = np.asarray(detected, bool)
+    rows = []
+    for threshold in thresholds:
+        sent = scores >= threshold
+        rows.append(
+            {
+                "threshold": threshold,
+                "recall": (sent & detected).sum() / max(detected.sum(), 1),
+                "call_reduction": 1 - sent.mean() if len(scores) else 0.0,
+            }
+        )
+    return pd.DataFrame(rows)
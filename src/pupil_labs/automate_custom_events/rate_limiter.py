@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import re
+import time
+import weakref
+from contextlib import asynccontextmanager
+from typing import Dict, Mapping, Optional
+
+# Statuses after which a request is worth sending again
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+# Pause after a 429 that carries no retry-after or reset header, doubled for
+# every further 429 in a row.
+DEFAULT_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    """
+    Parses the durations of the x-ratelimit-reset-* headers into seconds.
+
+    >>> parse_reset_duration("6m0s")
+    360.0
+    >>> parse_reset_duration("20ms")
+    0.02
+    >>> parse_reset_duration("1.5") is None
+    True
+    """
+    if not value:
+        return None
+    parts = _DURATION_PART.findall(value)
+    if not parts or "".join(n + u for n, u in parts) != value.strip():
+        return None
+    return sum(float(n) * _DURATION_UNITS[u] for n, u in parts)
+
+
+def _parse_int(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        try:
+            return float(headers[name]) * scale
+        except (KeyError, ValueError):
+            continue
+    return None
+
+
+class _LoopSlots:
+    """The slots of a limiter taken by the requests of one event loop."""
+
+    def __init__(self):
+        self.condition = asyncio.Condition()
+        self.in_flight = 0
+
+
+class RateLimiter:
+    """
+    Request admission shared by all OpenAI calls of a process.
+
+    A request waits for a free slot and for the request and token budgets that
+    the last x-ratelimit-* response headers reported. The number of slots
+    adapts to the rate limits actually hit: every 429 halves it and pauses all
+    requests until the server says the limit resets, while each run of
+    successful requests as long as the current limit adds a slot back, up to
+    max_concurrency.
+
+    Slots are counted per event loop, so that one limiter can outlive several
+    asyncio.run calls; the budgets and the limit are shared by all of them.
+    """
+
+    def __init__(self, max_concurrency: int = 8, min_concurrency: int = 1):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = max_concurrency
+        self.remaining_requests: Optional[int] = None
+        self.remaining_tokens: Optional[int] = None
+        self.requests_reset_at = 0.0
+        self.tokens_reset_at = 0.0
+        self.paused_until = 0.0
+        self.num_rate_limited = 0
+        self._consecutive_429 = 0
+        self._successes = 0
+        self._decreased_at = 0.0
+        self._slots: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    def _loop_slots(self) -> _LoopSlots:
+        loop = asyncio.get_running_loop()
+        slots = self._slots.get(loop)
+        if slots is None:
+            slots = self._slots[loop] = _LoopSlots()
+        return slots
+
+    @property
+    def in_flight(self) -> int:
+        """Requests in flight on all event loops."""
+        return sum(slots.in_flight for slots in list(self._slots.values()))
+
+    def _wait_time(self, now: float, tokens: int) -> float:
+        wait = self.paused_until - now
+        if self.remaining_requests is not None and self.remaining_requests <= 0:
+            wait = max(wait, self.requests_reset_at - now)
+        if self.remaining_tokens is not None and self.remaining_tokens < tokens:
+            wait = max(wait, self.tokens_reset_at - now)
+        return wait
+
+    def _expire_budgets(self, now: float) -> None:
+        if now >= self.requests_reset_at:
+            self.remaining_requests = None
+        if now >= self.tokens_reset_at:
+            self.remaining_tokens = None
+
+    async def acquire(self, tokens: int = 0) -> None:
+        """
+        Waits until a request that may use up to `tokens` tokens can be sent.
+        """
+        slots = self._loop_slots()
+        condition = slots.condition
+        async with condition:
+            while True:
+                now = time.monotonic()
+                self._expire_budgets(now)
+                wait = self._wait_time(now, tokens)
+                if wait <= 0 and slots.in_flight < self.limit:
+                    break
+                try:
+                    await asyncio.wait_for(condition.wait(), wait if wait > 0 else None)
+                except asyncio.TimeoutError:
+                    pass
+            slots.in_flight += 1
+            if self.remaining_requests is not None:
+                self.remaining_requests -= 1
+            if self.remaining_tokens is not None:
+                self.remaining_tokens -= tokens
+
+    async def release(self) -> None:
+        slots = self._loop_slots()
+        async with slots.condition:
+            slots.in_flight = max(0, slots.in_flight - 1)
+            slots.condition.notify_all()
+
+    @asynccontextmanager
+    async def slot(self, tokens: int = 0):
+        await self.acquire(tokens)
+        try:
+            yield self
+        finally:
+            await self.release()
+
+    def update(self, status: int, headers: Mapping[str, str]) -> None:
+        """
+        Takes in the budgets reported by a response and adapts the concurrency
+        to whether it was rate limited.
+        """
+        now = time.monotonic()
+        remaining_requests = _parse_int(headers.get("x-ratelimit-remaining-requests"))
+        remaining_tokens = _parse_int(headers.get("x-ratelimit-remaining-tokens"))
+        reset_requests = parse_reset_duration(headers.get("x-ratelimit-reset-requests"))
+        reset_tokens = parse_reset_duration(headers.get("x-ratelimit-reset-tokens"))
+        if remaining_requests is not None:
+            self.remaining_requests = remaining_requests
+            self.requests_reset_at = now + (reset_requests or 0.0)
+        if remaining_tokens is not None:
+            self.remaining_tokens = remaining_tokens
+            self.tokens_reset_at = now + (reset_tokens or 0.0)
+
+        if status == 429:
+            self.num_rate_limited += 1
+            self._consecutive_429 += 1
+            self._successes = 0
+            pause = _retry_after(headers)
+            if pause is None:
+                resets = [
+                    reset
+                    for reset, remaining in (
+                        (reset_requests, remaining_requests),
+                        (reset_tokens, remaining_tokens),
+                    )
+                    if reset is not None and remaining is not None and remaining <= 0
+                ]
+                pause = max(resets) if resets else None
+            if pause is None:
+                pause = min(
+                    DEFAULT_BACKOFF * 2 ** (self._consecutive_429 - 1), MAX_BACKOFF
+                )
+            self.paused_until = max(self.paused_until, now + pause)
+            # The requests that were already in flight when the limit was hit
+            # will see 429s too; count them as one decrease.
+            if now >= self._decreased_at:
+                self.limit = max(self.min_concurrency, self.limit // 2)
+                self._decreased_at = self.paused_until
+                logging.warning(
+                    f"OpenAI rate limit hit, pausing {pause:.1f}s and lowering "
+                    f"concurrency to {self.limit}"
+                )
+        elif status < 400:
+            self._consecutive_429 = 0
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.max_concurrency:
+                self.limit += 1
+                self._successes = 0
+                logging.debug(f"Raising OpenAI concurrency to {self.limit}")
+
+
+_shared_limiters: Dict[str, RateLimiter] = {}
+
+
+def shared_rate_limiter(api_key: str, max_concurrency: int = 8) -> RateLimiter:
+    """
+    Returns the process-wide limiter for an API key, since OpenAI enforces its
+    limits per organization rather than per connection. Asking for a lower
+    max_concurrency than the limiter has lowers it, for every user of the key.
+    """
+    limiter = _shared_limiters.get(api_key)
+    if limiter is None:
+        limiter = _shared_limiters[api_key] = RateLimiter(max_concurrency)
+    elif max_concurrency != limiter.max_concurrency:
+        lowest = min(max_concurrency, limiter.max_concurrency)
+        logging.warning(
+            f"The OpenAI rate limiter of this API key allows "
+            f"{limiter.max_concurrency} concurrent requests, {max_concurrency} "
+            f"were asked for; using {lowest} for all runs with the key"
+        )
+        limiter.max_concurrency = lowest
+        limiter.min_concurrency = min(limiter.min_concurrency, lowest)
+        limiter.limit = min(limiter.limit, lowest)
+    return limiter
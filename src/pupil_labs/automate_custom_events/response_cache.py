@@ -0,0 +1,120 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+RESPONSE_CACHE_NAME = "response_cache.sqlite"
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+def request_key(params: dict) -> str:
+    """
+    Hash of everything that determines the answer to a chat request: the
+    model, max_tokens and the messages, which hold the rendered prompt, the
+    frame metadata and the encoded frames.
+    """
+    blob = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite store of chat completion responses, so that frames that were
+    already asked the identical question are not sent to the API again.
+
+    Entries are evicted least recently used first once the stored responses
+    take more than max_bytes.
+    """
+
+    def __init__(
+        self,
+        db_path: Union[str, Path],
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        enabled: bool = True,
+    ):
+        self.db_path = Path(db_path)
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        if enabled:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_last_used "
+                "ON responses (last_used)"
+            )
+            self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        if self._conn is None:
+            return None
+        row = self._conn.execute(
+            "SELECT response FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._conn.execute(
+            "UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key)
+        )
+        self._conn.commit()
+        return row[0]
+
+    def put(self, key: str, response: str) -> None:
+        if self._conn is None:
+            return
+        size = len(response.encode())
+        self._conn.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+            (key, response, size, time.time()),
+        )
+        self._evict()
+        self._conn.commit()
+
+    def _evict(self) -> None:
+        assert self._conn is not None
+        total = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = 0
+        rows = self._conn.execute(
+            "SELECT key, size FROM responses ORDER BY last_used"
+        ).fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            evicted += 1
+        logging.debug(f"Evicted {evicted} cached responses")
+
+    def __len__(self) -> int:
+        if self._conn is None:
+            return 0
+        return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def log_report(self) -> None:
+        if self.enabled:
+            logging.info(
+                f"Response cache: {self.hits} hits, {self.misses} misses, "
+                f"{len(self)} entries"
+            )
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,244 @@
+import bisect
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+
+RUN_METRICS_NAME = "run_metrics.json"
+PROMETHEUS_NAME = "run_metrics.prom"
+PROMETHEUS_PREFIX = "pl_custom_events"
+
+# Stages of a run in pipeline order. Their wall times overlap: frames are
+# encoded while the search queries them, and events are posted while the
+# search goes on. The overlay pass of the fused overlay also decodes and
+# encodes its frames, the encode stage is that encoding time on its own.
+STAGES = ("download", "gaze_merge", "overlay", "encode", "query", "event_post")
+
+# Upper bounds in seconds of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0)
+
+
+class Histogram:
+    """
+    Counts of observed values by bucket, as Prometheus histograms keep them,
+    plus the values themselves for exact percentiles in the JSON report.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.values: list = []
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.values.append(value)
+
+    def cumulative_counts(self) -> Dict[str, int]:
+        """
+        Observations up to each bucket bound.
+
+        >>> histogram = Histogram((1.0, 2.0))
+        >>> for value in (0.5, 1.5, 1.7, 9.0):
+        ...     histogram.observe(value)
+        >>> histogram.cumulative_counts()
+        {'1.0': 1, '2.0': 3, '+Inf': 4}
+        """
+        bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+        total = 0
+        counts = {}
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            counts[bound] = total
+        return counts
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.values:
+            return None
+        values = sorted(self.values)
+        return values[min(math.ceil(q * len(values)) - 1, len(values) - 1)]
+
+    def report(self) -> dict:
+        return {
+            "count": len(self.values),
+            "sum": sum(self.values),
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "max": max(self.values, default=None),
+            "buckets": self.cumulative_counts(),
+        }
+
+
+def _label_key(labels: dict) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _prometheus_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+def _number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class RunMetrics:
+    """
+    Where the time, requests and tokens of one run went: wall and CPU time
+    per stage, counters such as requests, 429s, retries and Cloud POST
+    outcomes, and latency histograms. Stages of different threads may record
+    at once.
+
+    Other statistics objects with a report() method, like TokenUsageStats,
+    are added as sections with add_report and read when the report is made.
+
+    :param recording_id: labels the Prometheus metrics.
+    """
+
+    def __init__(self, recording_id: Optional[str] = None):
+        self.recording_id = recording_id
+        self.stages: Dict[str, dict] = {}
+        self.counters: Dict[str, Dict[tuple, float]] = {}
+        self.histograms: Dict[str, Histogram] = {}
+        self.sections: dict = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def add_stage(self, name: str, wall_s: float, cpu_s: Optional[float]) -> None:
+        """Adds the wall and CPU time of one call of a stage. cpu_s is None
+        for stages that run interleaved with others in the event loop."""
+        with self._lock:
+            stage = self.stages.setdefault(
+                name, {"calls": 0, "wall_s": 0.0, "cpu_s": None}
+            )
+            stage["calls"] += 1
+            stage["wall_s"] += wall_s
+            if cpu_s is not None:
+                stage["cpu_s"] = (stage["cpu_s"] or 0.0) + cpu_s
+
+    @contextmanager
+    def stage(self, name: str):
+        """Times a block as a call of a stage. The CPU time is that of the
+        calling thread, work handed to other threads or processes is not
+        included."""
+        started = time.perf_counter()
+        cpu_started = time.thread_time()
+        try:
+            yield
+        finally:
+            self.add_stage(
+                name,
+                time.perf_counter() - started,
+                time.thread_time() - cpu_started,
+            )
+
+    def count(self, name: str, value: float = 1, **labels) -> None:
+        with self._lock:
+            counter = self.counters.setdefault(name, {})
+            key = _label_key(labels)
+            counter[key] = counter.get(key, 0) + value
+
+    def observe(self, name: str, value: float) -> None:
+        with self._lock:
+            self.histograms.setdefault(name, Histogram()).observe(value)
+
+    def add_report(self, name: str, source) -> None:
+        self.sections[name] = source
+
+    def report(self) -> dict:
+        with self._lock:
+            counters = {
+                name: (
+                    values[()]
+                    if list(values) == [()]
+                    else {
+                        ",".join(f"{k}={v}" for k, v in key): value
+                        for key, value in values.items()
+                    }
+                )
+                for name, values in self.counters.items()
+            }
+            return {
+                "recording_id": self.recording_id,
+                "started": self.started,
+                "stages": {
+                    name: dict(self.stages[name])
+                    for name in sorted(self.stages, key=_stage_order)
+                },
+                "counters": counters,
+                "histograms": {
+                    name: histogram.report()
+                    for name, histogram in self.histograms.items()
+                },
+                **{name: source.report() for name, source in self.sections.items()},
+            }
+
+    def prometheus_text(self) -> str:
+        """The metrics in the Prometheus text exposition format, e.g. for
+        the textfile collector of the node exporter."""
+        base = (("recording_id", self.recording_id),) if self.recording_id else ()
+        lines = []
+
+        def family(name, kind, samples):
+            metric = f"{PROMETHEUS_PREFIX}_{name}"
+            lines.append(f"# TYPE {metric} {kind}")
+            for suffix, labels, value in samples:
+                lines.append(
+                    f"{metric}{suffix}{_prometheus_labels(base + labels)} {value}"
+                )
+
+        report = self.report()
+        for key in ("wall_s", "cpu_s"):
+            family(
+                f"stage_{key[:-2]}_seconds",
+                "gauge",
+                [
+                    ("", (("stage", name),), stage[key])
+                    for name, stage in report["stages"].items()
+                    if stage[key] is not None
+                ],
+            )
+        with self._lock:
+            counters = {name: dict(values) for name, values in self.counters.items()}
+            histograms = {
+                name: (histogram.cumulative_counts(), sum(histogram.values))
+                for name, histogram in self.histograms.items()
+            }
+        for name, values in counters.items():
+            family(
+                f"{name}_total",
+                "counter",
+                [("", key, value) for key, value in values.items()],
+            )
+        for name, (buckets, total) in histograms.items():
+            samples: list = [
+                ("_bucket", (("le", bound),), count) for bound, count in buckets.items()
+            ]
+            samples += [("_sum", (), total), ("_count", (), buckets["+Inf"])]
+            family(name, "histogram", samples)
+        for section in self.sections:
+            for key, value in report[section].items():
+                if _number(value):
+                    family(f"{section}_{key}", "gauge", [("", (), value)])
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory: Union[str, Path], prometheus: bool = False) -> Path:
+        """
+        Writes run_metrics.json, and with prometheus also run_metrics.prom,
+        into a directory.
+        :return: the path of the JSON file.
+        """
+        directory = Path(directory)
+        path = directory / RUN_METRICS_NAME
+        path.write_text(json.dumps(self.report(), indent=2))
+        if prometheus:
+            (directory / PROMETHEUS_NAME).write_text(self.prometheus_text())
+        return path
+
+
+def _stage_order(name: str) -> int:
+    return STAGES.index(name) if name in STAGES else len(STAGES)
@@ -1,25 +1,256 @@
+import asyncio
 import base64
 import av
+import bisect
 import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from pathlib import Path
 import cv2
 import numpy as np
 from rich.progress import Progress
 import pandas as pd
 from fractions import Fraction
 
+# Gaze marker and encoder settings of the overlay video. The renderer version
+# is part of the cache keys, bump it when the drawing changes so that overlays
+# cached by an older renderer are made again.
+OVERLAY_PARAMS = {
+    "renderer": 2,
+    "radius": 20,
+    "color_bgr": (0, 0, 255),
+    "thickness": 10,
+    "codec": "libx264",
+    "rate": 30,
+    "crf": "18",
+}
+
+# Format and size of the frames sent to the model. OpenAI scales images down
+# until their short side is at most 768 px, so larger frames only add bytes.
+ENCODE_PARAMS = {
+    "format": ".jpg",
+    "short_side": 768,
+    "quality": 95,
+}
+
+IMAGE_QUALITY_FLAGS = {
+    ".jpg": cv2.IMWRITE_JPEG_QUALITY,
+    ".webp": cv2.IMWRITE_WEBP_QUALITY,
+}
+
+# Rich allows one live progress display at a time, so callers that process
+# several videos in parallel threads switch the progress bars off
+SHOW_PROGRESS = True
+
+
+class FrameEncodingStats:
+    """
+    Bytes produced by encode_frame_base64, compared to what a full-resolution
+    JPEG at OpenCV's default quality (the previous encoding) would take. The
+    baseline is only computed for every baseline_every-th frame and
+    extrapolated, to keep the extra encoding cost low.
+    :param metrics: optional RunMetrics to add the encoding time of every
+        frame to, as its "encode" stage.
+    """
+
+    def __init__(self, baseline_every=25, metrics=None):
+        self.baseline_every = baseline_every
+        self.metrics = metrics
+        self.num_frames = 0
+        self.encoded_bytes = 0
+        self.sampled_encoded_bytes = 0
+        self.sampled_baseline_bytes = 0
+
+    def add(self, original_img, num_bytes, wall_s=0.0, cpu_s=0.0):
+        if self.metrics is not None:
+            self.metrics.add_stage("encode", wall_s, cpu_s)
+        if self.num_frames % self.baseline_every == 0:
+            _, baseline = cv2.imencode(".jpg", original_img)
+            self.sampled_baseline_bytes += len(baseline)
+            self.sampled_encoded_bytes += num_bytes
+        self.num_frames += 1
+        self.encoded_bytes += num_bytes
+
+    def report(self):
+        ratio = self.sampled_baseline_bytes / max(self.sampled_encoded_bytes, 1)
+        baseline_bytes = self.encoded_bytes * ratio
+        return {
+            "frames": self.num_frames,
+            "bytes_per_frame": self.encoded_bytes / max(self.num_frames, 1),
+            "total_bytes": self.encoded_bytes,
+            "baseline_bytes_estimate": int(baseline_bytes),
+            "saved_bytes_estimate": int(baseline_bytes - self.encoded_bytes),
+        }
+
+    def log_report(self):
+        report = self.report()
+        saved_pct = 100 * report["saved_bytes_estimate"] / max(
+            report["baseline_bytes_estimate"], 1
+        )
+        logging.info(
+            f"Encoded {report['frames']} frames, "
+            f"{report['bytes_per_frame'] / 1e3:.1f} kB per frame, "
+            f"{report['total_bytes'] / 1e6:.1f} MB in total "
+            f"(~{report['saved_bytes_estimate'] / 1e6:.1f} MB / {saved_pct:.0f}% "
+            "less than full-resolution JPEG)"
+        )
+
+
+def encode_frame_base64(img, encode_params=None, stats=None):
+    """
+    Resizes and encodes a BGR image as configured in encode_params.
+    :param encode_params: dict with the keys of ENCODE_PARAMS. "format" is one
+        of ".jpg", ".webp" or ".png", "short_side" the maximum size in pixels of
+        the shorter image side (None keeps the resolution) and "quality" the
+        JPEG/WebP quality from 0 to 100 (ignored for PNG).
+    :param stats: optional FrameEncodingStats to record the encoded size in.
+    """
+    params = {**ENCODE_PARAMS, **(encode_params or {})}
+    if params["format"] not in (".jpg", ".webp", ".png"):
+        raise ValueError(f"Unsupported frame format: {params['format']}")
+
+    started = time.perf_counter()
+    cpu_started = time.thread_time()
+    resized = img
+    short_side = params["short_side"]
+    height, width = img.shape[:2]
+    if short_side and min(height, width) > short_side:
+        scale = short_side / min(height, width)
+        size = (round(width * scale), round(height * scale))
+        resized = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+    flags = []
+    if params["format"] in IMAGE_QUALITY_FLAGS:
+        flags = [IMAGE_QUALITY_FLAGS[params["format"]], int(params["quality"])]
+    _, buffer = cv2.imencode(params["format"], resized, flags)
+    encoded = base64.b64encode(buffer).decode("utf-8")
+    if stats is not None:
+        stats.add(
+            img,
+            len(buffer),
+            time.perf_counter() - started,
+            time.thread_time() - cpu_started,
+        )
+    return encoded
+
+
+def frame_signature(img):
+    """
+    64 bit difference hash of a BGR image: the image is shrunk to 9x8 gray
+    pixels and every bit tells whether a pixel is brighter than its left
+    neighbour. Near-identical frames get hashes a few bits apart.
+    """
+    small = cv2.resize(img, (9, 8), interpolation=cv2.INTER_AREA)
+    if small.ndim == 3:
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+class FrameSignatures:
+    """
+    Perceptual hashes and gaze positions of the encoded frames, by frame
+    index, to recognise frames that show nearly the same thing. Filled in by
+    the encoding functions as they encode the frames.
+    """
+
+    def __init__(self, num_frames=0):
+        self.hashes = np.zeros(num_frames, dtype=np.uint64)
+        self.gaze_xy = np.full((num_frames, 2), np.nan)
+        self.known = np.zeros(num_frames, dtype=bool)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, index, img, xy=None):
+        if index >= len(self):
+            size = max(index + 1, 2 * len(self))
+            self.hashes = np.resize(self.hashes, size)
+            self.gaze_xy = np.concatenate(
+                [self.gaze_xy, np.full((size - len(self.gaze_xy), 2), np.nan)]
+            )
+            self.known = np.concatenate(
+                [self.known, np.zeros(size - len(self.known), dtype=bool)]
+            )
+        self.hashes[index] = frame_signature(img)
+        if xy is not None:
+            self.gaze_xy[index] = xy
+        self.known[index] = True
+
+    def find_duplicate(self, index, candidates, max_hash_distance, max_gaze_distance):
+        """
+        Returns the first of the candidate frames whose hash differs from the
+        one of frame index in at most max_hash_distance bits and whose gaze is
+        at most max_gaze_distance pixels away, or None. Gaze is only compared
+        if it is known for both frames.
+        """
+        if index >= len(self) or not self.known[index] or not len(candidates):
+            return None
+        candidates = np.asarray(candidates, dtype=np.int64)
+        candidates = candidates[candidates < len(self)]
+        candidates = candidates[self.known[candidates]]
+        xor = self.hashes[candidates] ^ self.hashes[index]
+        distances = np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(1)
+        gaze_distances = np.linalg.norm(
+            self.gaze_xy[candidates] - self.gaze_xy[index], axis=1
+        )
+        close = (distances <= max_hash_distance) & (
+            np.isnan(gaze_distances) | (gaze_distances <= max_gaze_distance)
+        )
+        matches = candidates[close]
+        return int(matches[0]) if len(matches) else None
+
+    def save(self, path):
+        size = int(np.flatnonzero(self.known)[-1]) + 1 if self.known.any() else 0
+        np.savez(
+            path,
+            hashes=self.hashes[:size],
+            gaze_xy=self.gaze_xy[:size],
+            known=self.known[:size],
+        )
+
+    @classmethod
+    def load(cls, path):
+        signatures = cls()
+        with np.load(path) as data:
+            signatures.hashes = data["hashes"]
+            signatures.gaze_xy = data["gaze_xy"]
+            signatures.known = data["known"]
+        return signatures
+
 
 def is_sorted(arr):
     return np.all(np.diff(arr) >= 0)
 
 
-def encode_video_as_base64(video_path, audio=False, auto_thread_type=True):
+def encode_video_as_base64(
+    video_path,
+    audio=False,
+    auto_thread_type=True,
+    encode_params=None,
+    stats=None,
+    signatures=None,
+    frames=None,
+    gaze_xy=None,
+):
     """
     A function to read a video, extract frames, and store them as base64 encoded strings.
     :param video_path: the path to the video
+    :param encode_params: resolution, format and quality, see encode_frame_base64
+    :param stats: optional FrameEncodingStats collecting the encoded sizes
+    :param signatures: optional FrameSignatures to add the frames to
+    :param gaze_xy: optional (number of frames, 2) array of the gaze positions
+        in pixels of the frames in decoding order, added to the signatures.
+    :param frames: list-like to append the encoded frames to as they are
+        encoded, e.g. a StreamingFrames. Defaults to a new list.
     """
-    base64_frames = []
+    base64_frames = [] if frames is None else frames
     # Read the video
-    with av.open(video_path) as video_container, Progress() as progress:
+    progress = Progress(disable=not SHOW_PROGRESS)
+    with av.open(video_path) as video_container, progress:
         if audio:
             stream = video_container.streams.audio[0]
         else:
@@ -49,8 +280,15 @@ def encode_video_as_base64(video_path, audio=False, auto_thread_type=True):
 
                     # Convert the frame to an image and encode it in base64
                     img = frame.to_ndarray(format='bgr24')
-                    _, buffer = cv2.imencode(".jpg", img)
-                    base64_frames.append(base64.b64encode(buffer).decode("utf-8"))
+                    if signatures is not None:
+                        index = len(pts) - 1
+                        xy = None
+                        if gaze_xy is not None and index < len(gaze_xy):
+                            xy = gaze_xy[index]
+                        signatures.add(index, img, xy)
+                    base64_frames.append(
+                        encode_frame_base64(img, encode_params, stats)
+                    )
 
             progress.advance(decode_task)
             progress.refresh()
@@ -82,110 +320,698 @@ def encode_video_as_base64(video_path, audio=False, auto_thread_type=True):
     return base64_frames, frame_metadata  #, fps, nframes, pts, ts
 
 
-def get_frame(av_container, pts, last_pts, frame, audio=False):
+def render_gaze_overlay(vid_frame, xy):
     """
-    Gets the frame at the given timestamp.
-    :param av_container: The container of the video.
-    :param pts: The pts of the frame we are looking for.
-    :param last_pts: The last pts of the video readed.
-    :param frame: Last frame decoded.
+    Draws the gaze circle on a decoded frame.
+    :param xy: gaze position in pixels, may be NaN.
+    :return: the overlay image in BGR uint8.
+    """
+    # Convert straight into the layout OpenCV draws and encodes in, and draw
+    # on that buffer in place.
+    frame = vid_frame.to_ndarray(format="bgr24")
+    if not frame.flags.c_contiguous:
+        frame = np.ascontiguousarray(frame)
+
+    # make a aoi_circle on the gaze
+    if not np.isnan(xy).any():
+        cv2.circle(
+            frame,
+            (int(xy[0]), int(xy[1])),
+            OVERLAY_PARAMS["radius"],
+            OVERLAY_PARAMS["color_bgr"],
+            OVERLAY_PARAMS["thickness"],
+        )
+    return frame
+
+
+def _add_overlay_stream(out_container, width, height, threads=None):
+    options = {"crf": OVERLAY_PARAMS["crf"]}
+    if threads:
+        options["threads"] = str(threads)
+    out_video = out_container.add_stream(
+        OVERLAY_PARAMS["codec"], rate=OVERLAY_PARAMS["rate"], options=options
+    )
+    out_video.width = width
+    out_video.height = height
+    out_video.pix_fmt = "yuv420p"
+    out_video.codec_context.time_base = Fraction(1, OVERLAY_PARAMS["rate"])
+    return out_video
+
+
+def _iter_row_frames(video, row_pts):
+    """
+    Decodes the video from its current position and pairs every row with the
+    first frame whose pts is at or after the row's pts, like the per-row
+    lookup of the legacy loop in benchmarks/bench_overlay_loop.py did.
+    :param row_pts: ascending pts of the rows.
+    :return: a generator of (av.VideoFrame, row index).
+    """
+    row = 0
+    num_inexact = 0
+    for vid_frame in video.decode(video.streams.video[0]):
+        if vid_frame.pts is None:
+            continue
+        while row < len(row_pts) and row_pts[row] <= vid_frame.pts:
+            num_inexact += row_pts[row] != vid_frame.pts
+            yield vid_frame, row
+            row += 1
+        if row == len(row_pts):
+            break
+    if num_inexact:
+        logging.warning(f"{num_inexact} frames not found in video, used later ones")
+
+
+def iter_gaze_overlay_frames(merged_video, video_path, world_timestamps_df):
+    """
+    Decodes the scene video and draws the gaze circle on every frame.
+    :return: a generator of (scene av.VideoFrame, overlay image in BGR uint8,
+        gaze position in pixels).
     """
-    if audio:
-        strm = av_container.streams.audio[0]
-    else:
-        strm = av_container.streams.video[0]
-    if last_pts < pts:
-        try:
-            for frame in av_container.decode(strm):
-                logging.debug(
-                    f"Frame {frame.pts} read from video and looking for {pts}"
-                )
-                if pts == frame.pts:
-                    last_pts = frame.pts
-                    return frame, last_pts
-                if pts < frame.pts:
-                    logging.warning(f"Frame {pts} not found in video, used {frame.pts}")
-                    last_pts = frame.pts
-                    return frame, last_pts
-        except av.EOFError:
-            logging.info("End of the file")
-            return None, last_pts
-    else:
-        logging.debug("This frame was already decoded")
-        return frame, last_pts
-
-
-def create_gaze_overlay_video(merged_video, video_path, world_timestamps_df, output_file):
     start = world_timestamps_df[0]
     merged_video = merged_video[merged_video["timestamp [ns]"] >= start]
+    # Plain arrays, so the loop does no pandas lookups per frame
+    row_pts = merged_video["pts"].to_numpy(dtype=np.int64)
+    row_xy = merged_video[["gaze x [px]", "gaze y [px]"]].to_numpy(dtype=np.float64)
 
-    # Read first frame
-    with av.open(video_path) as vid_container:
-        logging.info("Reading first frames")
-        vid_frame = next(vid_container.decode(video=0))
+    progress_bar = Progress(disable=not SHOW_PROGRESS)
+    with av.open(video_path) as video, progress_bar:
+        logging.info("Ready to process video")
+        video_task = progress_bar.add_task("📹 Processing video", total=len(row_pts))
+        video.streams.video[0].thread_type = "AUTO"
+        if len(row_pts):
+            # Skip ahead to the keyframe before the first row, e.g. of a time
+            # window, instead of decoding everything before it
+            video.seek(int(row_pts[0]), stream=video.streams.video[0])
+        for vid_frame, row in _iter_row_frames(video, row_pts):
+            xy = row_xy[row]
+            yield vid_frame, render_gaze_overlay(vid_frame, xy), xy
+            progress_bar.advance(video_task)
+        progress_bar.stop_task(video_task)
 
-    num_processed_frames = 0
 
+def create_gaze_overlay_video(
+    merged_video, video_path, world_timestamps_df, output_file, num_workers=1
+):
+    """
+    Writes the scene video with the gaze circle drawn on it.
+    :param num_workers: if larger than 1, the video is split at keyframes and
+        the segments are rendered by that many processes, see
+        create_gaze_overlay_video_parallel.
+    """
     # Get the output path
     logging.info(f"Output path: {output_file}")
 
+    if num_workers > 1:
+        create_gaze_overlay_video_parallel(
+            merged_video, video_path, world_timestamps_df, output_file, num_workers
+        )
+        return
+
     # Here we go!
-    with av.open(video_path) as video, av.open(output_file, "w") as out_container:
-        logging.info("Ready to process video")
-        # Prepare the output video
-        out_video = out_container.add_stream("libx264", rate=30, options={"crf": "18"})
-        out_video.width = video.streams.video[0].width
-        out_video.height = video.streams.video[0].height
-        out_video.pix_fmt = "yuv420p"
-        out_video.codec_context.time_base = Fraction(1, 30)
+    with av.open(output_file, "w") as out_container:
+        out_video = None
+        for vid_frame, out_, _ in iter_gaze_overlay_frames(
+            merged_video, video_path, world_timestamps_df
+        ):
+            if out_video is None:
+                out_video = _add_overlay_stream(
+                    out_container, vid_frame.width, vid_frame.height
+                )
+            # Convert to av frame
+            out_frame = av.VideoFrame.from_ndarray(out_, format="bgr24")
+            for packet in out_video.encode(out_frame):
+                out_container.mux(packet)
+        if out_video is not None:
+            for packet in out_video.encode(None):
+                out_container.mux(packet)
+
+    logging.info(
+        "[white bold on #0d122a]◎ Gaze overlay video has been created! ⚡️[/]",
+        extra={"markup": True},
+    )
+    cv2.destroyAllWindows()
+
+
+def _keyframe_pts(video_path):
+    with av.open(str(video_path)) as container:
+        return sorted(
+            packet.pts
+            for packet in container.demux(video=0)
+            if packet.is_keyframe and packet.pts is not None
+        )
+
+
+def _plan_segments(row_pts, keyframe_pts, num_segments):
+    """
+    Splits the rows into about num_segments runs of similar length that each
+    start at a keyframe, so every segment can be decoded independently.
+    :return: a list of (keyframe pts, first row, end row).
+    """
+    # Start at the last keyframe before the first row, e.g. of a time window
+    if len(row_pts):
+        first_keyframe = bisect.bisect_right(keyframe_pts, row_pts[0]) - 1
+        keyframe_pts = keyframe_pts[max(first_keyframe, 0) :]
+    # Row index at which each keyframe interval starts
+    starts = np.searchsorted(row_pts, keyframe_pts, side="left")
+    target = max(len(row_pts) // num_segments, 1)
+    segments = []
+    first_row = 0
+    seek_pts = keyframe_pts[0]
+    for keyframe, start in zip(keyframe_pts[1:], starts[1:]):
+        if start - first_row >= target:
+            segments.append((seek_pts, first_row, int(start)))
+            first_row, seek_pts = int(start), keyframe
+    segments.append((seek_pts, first_row, len(row_pts)))
+    return [segment for segment in segments if segment[2] > segment[1]]
+
+
+def _render_overlay_segment(
+    video_path, segment_path, seek_pts, row_pts, row_xy, threads
+):
+    """
+    Renders one segment of the overlay video in a worker process. Frames are
+    paired with the rows exactly like in iter_gaze_overlay_frames.
+    :return: the number of frames written and whether the video ended early.
+    """
+    num_written = 0
+    with av.open(str(video_path)) as video, av.open(
+        str(segment_path), "w"
+    ) as out_container:
+        stream = video.streams.video[0]
+        video.seek(int(seek_pts), stream=stream)
+        out_video = _add_overlay_stream(
+            out_container, stream.width, stream.height, threads
+        )
+        for vid_frame, row in _iter_row_frames(video, row_pts):
+            out_frame = av.VideoFrame.from_ndarray(
+                render_gaze_overlay(vid_frame, row_xy[row]), format="bgr24"
+            )
+            out_frame.pts = num_written
+            for packet in out_video.encode(out_frame):
+                out_container.mux(packet)
+            num_written += 1
+        for packet in out_video.encode(None):
+            out_container.mux(packet)
+    return num_written, num_written < len(row_pts)
 
-        lpts = -1
 
-        # For every frame in the video
-        with Progress() as progress_bar:
+def _concat_segments(segment_paths, first_indices, output_file):
+    """
+    Joins independently encoded segments into one video without re-encoding.
+    Every segment starts at pts 0 and is shifted to the position of its first
+    frame in the whole video. Decoding timestamps are regenerated from the
+    presentation timestamps with a single reorder delay, so they stay
+    monotonic across segment boundaries.
+    """
+    decode_order = []
+    for segment_path, first_index in zip(segment_paths, first_indices):
+        with av.open(str(segment_path)) as container:
+            stream = container.streams.video[0]
+            ticks_per_frame = 1 / (stream.time_base * OVERLAY_PARAMS["rate"])
+            offset = round(first_index * ticks_per_frame)
+            decode_order.append(
+                [p.pts + offset for p in container.demux(stream) if p.pts is not None]
+            )
+    delay = max(
+        (max(np.sort(pts) - pts) for pts in map(np.asarray, decode_order) if len(pts)),
+        default=0,
+    )
+
+    with av.open(str(segment_paths[0])) as first, av.open(
+        str(output_file), "w"
+    ) as out_container:
+        template = first.streams.video[0]
+        out_stream = out_container.add_stream_from_template(template)
+        for segment_path, pts in zip(segment_paths, decode_order):
+            with av.open(str(segment_path)) as container:
+                stream = container.streams.video[0]
+                if stream.codec_context.extradata != template.codec_context.extradata:
+                    raise RuntimeError(f"{segment_path} has different codec headers")
+                new_pts = iter(pts)
+                new_dts = iter(np.sort(pts) - delay)
+                for packet in container.demux(stream):
+                    if packet.pts is None:
+                        continue
+                    packet.pts = int(next(new_pts))
+                    packet.dts = int(next(new_dts))
+                    packet.stream = out_stream
+                    out_container.mux(packet)
+
+
+def create_gaze_overlay_video_parallel(
+    merged_video, video_path, world_timestamps_df, output_file, num_workers=None
+):
+    """
+    Same output as the serial create_gaze_overlay_video, rendered by a pool of
+    processes. The frames are split into segments starting at keyframes of
+    the scene video; each worker decodes and encodes its segments separately
+    and the results are concatenated losslessly into output_file, with the
+    same pts and frame count as the serial path.
+    :param num_workers: number of processes, defaults to the number of CPUs.
+    """
+    num_workers = num_workers or os.cpu_count() or 1
+    start = world_timestamps_df[0]
+    merged_video = merged_video[merged_video["timestamp [ns]"] >= start]
+    row_pts = merged_video["pts"].to_numpy(dtype=np.int64)
+    row_xy = merged_video[["gaze x [px]", "gaze y [px]"]].to_numpy(dtype=np.float64)
+
+    segments = _plan_segments(row_pts, _keyframe_pts(video_path), num_workers * 4)
+    output_file = Path(output_file)
+    segment_paths = [
+        output_file.with_name(f"{output_file.stem}.part{i:04d}{output_file.suffix}")
+        for i in range(len(segments))
+    ]
+    threads = max((os.cpu_count() or 1) // num_workers, 1)
+    logging.info(
+        f"Rendering {len(segments)} segments with {num_workers} worker processes"
+    )
+
+    try:
+        with ProcessPoolExecutor(
+            max_workers=num_workers
+        ) as executor, Progress(disable=not SHOW_PROGRESS) as progress_bar:
             video_task = progress_bar.add_task(
-                "📹 Processing video", total=merged_video.shape[0]
+                "📹 Processing video", total=len(row_pts)
             )
-            while num_processed_frames < merged_video.shape[0]:
-                row = merged_video.iloc[num_processed_frames]
-                # Get the frame
-                vid_frame, lpts = get_frame(
-                    video, int(row["pts"]), lpts, vid_frame
+            futures = [
+                executor.submit(
+                    _render_overlay_segment,
+                    str(video_path),
+                    str(segment_path),
+                    seek_pts,
+                    row_pts[first_row:end_row],
+                    row_xy[first_row:end_row],
+                    threads,
                 )
-                if vid_frame is None:
-                    break
-                img_original = vid_frame.to_ndarray(format="rgb24")
-
-                # Prepare the frame
-                frame = cv2.cvtColor(img_original, cv2.COLOR_RGB2BGR)
-                frame = np.asarray(frame, dtype=np.float32)
-                frame = frame[:, :, :]
-                xy = row[["gaze x [px]", "gaze y [px]"]].to_numpy(dtype=np.int32)
-
-                # make a aoi_circle on the gaze
-                if not np.isnan(xy).any():
-                    cv2.circle(frame, xy, 20, (0, 0, 255), 10)
-
-                # Finally get the frame ready.
-                out_ = cv2.normalize(
-                    frame, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U
+                for segment_path, (seek_pts, first_row, end_row) in zip(
+                    segment_paths, segments
                 )
-                # Convert to av frame
-                cv2.cvtColor(out_, cv2.COLOR_BGR2RGB, out_)
-                np.expand_dims(out_, axis=2)
-                out_frame = av.VideoFrame.from_ndarray(out_, format="rgb24")
+            ]
+            for future in as_completed(futures):
+                num_written, _ = future.result()
+                progress_bar.advance(video_task, num_written)
+            results = [future.result() for future in futures]
+
+        # Like the serial path, stop at the first frame that could not be decoded
+        complete, first_indices = [], []
+        for segment_path, segment, (num_written, ended_early) in zip(
+            segment_paths, segments, results
+        ):
+            if num_written:
+                complete.append(segment_path)
+                first_indices.append(segment[1])
+            if ended_early:
+                break
+        _concat_segments(complete, first_indices, output_file)
+    finally:
+        for segment_path in segment_paths:
+            segment_path.unlink(missing_ok=True)
+
+    logging.info(
+        "[white bold on #0d122a]◎ Gaze overlay video has been created! ⚡️[/]",
+        extra={"markup": True},
+    )
+
+
+def create_gaze_overlay_frames(
+    merged_video,
+    video_path,
+    world_timestamps_df,
+    output_file=None,
+    encode_params=None,
+    stats=None,
+    signatures=None,
+    frames=None,
+):
+    """
+    Draws the gaze overlay and JPEG-encodes every frame in a single pass over
+    the scene video, instead of writing the overlay video and decoding it
+    again with encode_video_as_base64.
+    :param output_file: if given, the overlay video is also written there.
+    :param encode_params: resolution, format and quality, see encode_frame_base64
+    :param stats: optional FrameEncodingStats collecting the encoded sizes
+    :param signatures: optional FrameSignatures to add the frames to
+    :param frames: list-like to append the encoded frames to, see
+        encode_video_as_base64
+    :return: the base64 encoded frames and their metadata, as returned by
+        encode_video_as_base64. Timestamps are taken from the scene video.
+    """
+    with av.open(video_path) as video:
+        start_time = video.streams.video[0].start_time or 0
+
+    base64_frames = [] if frames is None else frames
+    pts, ts = [], []
+    out_container = av.open(output_file, "w") if output_file else None
+    out_video = None
+    try:
+        for vid_frame, out_, xy in iter_gaze_overlay_frames(
+            merged_video, video_path, world_timestamps_df
+        ):
+            if signatures is not None:
+                signatures.add(len(pts), out_, xy)
+            base64_frames.append(encode_frame_base64(out_, encode_params, stats))
+
+            pts.append(vid_frame.pts)
+            ts.append(int((vid_frame.pts - start_time) * vid_frame.time_base * 1e9))
+
+            if out_container is not None:
+                if out_video is None:
+                    out_video = _add_overlay_stream(
+                        out_container, vid_frame.width, vid_frame.height
+                    )
+                out_frame = av.VideoFrame.from_ndarray(out_, format="bgr24")
                 for packet in out_video.encode(out_frame):
                     out_container.mux(packet)
-                progress_bar.advance(video_task)
-                num_processed_frames += 1
-            progress_bar.stop_task(video_task)
+        if out_video is not None:
             for packet in out_video.encode(None):
                 out_container.mux(packet)
-
+    finally:
+        if out_container is not None:
             out_container.close()
 
-        logging.info(
-            "[white bold on #0d122a]◎ Gaze overlay video has been created! ⚡️[/]",
-            extra={"markup": True},
+    ts = np.array(ts, dtype=np.uint64)
+    frame_metadata = pd.DataFrame({
+        "pts": np.array(pts, dtype=int),
+        "timestamp [ns]": ts,
+        "timestamp [s]": ts / 1e9,
+    })
+    logging.info(f"Encoded {len(pts)} overlay frames")
+    return base64_frames, frame_metadata
+
+
+def _video_clock(video_path):
+    with av.open(str(video_path)) as video:
+        stream = video.streams.video[0]
+        return stream.start_time or 0, float(stream.time_base)
+
+
+def frame_metadata_for_pts(video_path, pts):
+    """
+    The pts and timestamps of the given frames of a video, in the layout of
+    encode_video_as_base64. Timestamps count from the start of the video.
+    """
+    start_time, time_base = _video_clock(video_path)
+    pts = np.asarray(pts, dtype=np.int64)
+    ts = ((pts - start_time) * time_base * 1e9).astype(np.uint64)
+    return pd.DataFrame(
+        {
+            "pts": pts.astype(int),
+            "timestamp [ns]": ts,
+            "timestamp [s]": ts / 1e9,
+        }
+    )
+
+
+def time_window_mask(video_path, pts, start_time_seconds=None, end_time_seconds=None):
+    """
+    Which of the given frames of a video lie in the time window, with the
+    bounds and clock that FrameProcessor.is_within_time_range uses: whole
+    seconds from the start of the video, both inclusive. None leaves a bound
+    open.
+    """
+    start_time, time_base = _video_clock(video_path)
+    seconds = (np.asarray(pts, dtype=np.int64) - start_time) * time_base
+    mask = np.ones(len(seconds), dtype=bool)
+    if start_time_seconds is not None:
+        mask &= seconds >= int(start_time_seconds)
+    if end_time_seconds is not None:
+        mask &= seconds <= int(end_time_seconds)
+    return mask
+
+
+class LazyFrameSource:
+    """
+    Drop-in replacement for the list returned by encode_video_as_base64 that
+    only decodes and encodes the frames that are actually indexed.
+
+    A requested frame is found by seeking to the closest keyframe at or
+    before its pts and decoding forward from there, unless the decoder is
+    already positioned before it with no keyframe in between. The encoded
+    frames are kept in a small LRU cache.
+
+    Decoding a frame takes long enough to stall an event loop, coroutines
+    read frames with `await frames.get(index)`, which decodes on a worker
+    thread of the source. The container is not thread-safe, so frames are
+    decoded one at a time whichever thread asks for them.
+    """
+
+    def __init__(
+        self,
+        video_path,
+        pts=None,
+        gaze_xy=None,
+        cache_size=64,
+        encode_params=None,
+        stats=None,
+    ):
+        """
+        :param pts: pts of the frames to expose, in order. Defaults to every
+            frame of the video.
+        :param gaze_xy: optional (len(pts), 2) array of gaze positions in
+            pixels. If given, the gaze circle is drawn on each frame.
+        :param cache_size: number of encoded frames kept in memory.
+        :param encode_params: resolution, format and quality, see
+            encode_frame_base64
+        :param stats: optional FrameEncodingStats collecting the encoded sizes
+        """
+        self.video_path = video_path
+        self.container = av.open(str(video_path))
+        self.stream = self.container.streams.video[0]
+        self.stream.thread_type = "AUTO"
+        self.time_base = self.stream.time_base
+        self.start_time = self.stream.start_time or 0
+
+        packet_pts, keyframe_pts = [], []
+        with av.open(str(video_path)) as scan_container:
+            for packet in scan_container.demux(video=0):
+                if packet.pts is None:
+                    continue
+                packet_pts.append(packet.pts)
+                if packet.is_keyframe:
+                    keyframe_pts.append(packet.pts)
+        self.keyframe_pts = sorted(keyframe_pts)
+        self.pts = np.asarray(
+            sorted(packet_pts) if pts is None else pts, dtype=np.int64
+        )
+        self.gaze_xy = None if gaze_xy is None else np.asarray(gaze_xy, np.float64)
+
+        self.cache_size = cache_size
+        self.encode_params = encode_params
+        self.stats = stats
+        # Filled in as frames are encoded
+        self.signatures = FrameSignatures(len(self.pts))
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._decode_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="frame-decoder"
+        )
+        self._decoder = None
+        self._last_frame = None
+        self.num_seeks = 0
+        self.num_decoded = 0
+
+    def __len__(self):
+        return len(self.pts)
+
+    def _index(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return index
+
+    def _cached(self, index):
+        with self._cache_lock:
+            encoded = self._cache.get(index)
+            if encoded is not None:
+                self._cache.move_to_end(index)
+            return encoded
+
+    def __getitem__(self, index):
+        index = self._index(index)
+        encoded = self._cached(index)
+        if encoded is not None:
+            return encoded
+
+        with self._decode_lock:
+            # Another thread may have encoded it meanwhile
+            encoded = self._cached(index)
+            if encoded is not None:
+                return encoded
+            vid_frame = self._decode(int(self.pts[index]))
+            xy = None
+            if self.gaze_xy is not None:
+                xy = self.gaze_xy[index]
+                img = render_gaze_overlay(vid_frame, xy)
+            else:
+                img = vid_frame.to_ndarray(format="bgr24")
+            self.signatures.add(index, img, xy)
+            encoded = encode_frame_base64(img, self.encode_params, self.stats)
+
+        with self._cache_lock:
+            self._cache[index] = encoded
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return encoded
+
+    async def get(self, index):
+        """The encoded frame at index, decoded on the worker thread if it is
+        not cached, so that the event loop goes on meanwhile."""
+        index = self._index(index)
+        encoded = self._cached(index)
+        if encoded is not None:
+            return encoded
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.__getitem__, index)
+
+    def _decode(self, pts):
+        last = self._last_frame
+        if last is not None and last.pts == pts:
+            return last
+        keyframe = self.keyframe_pts[
+            max(bisect.bisect_right(self.keyframe_pts, pts) - 1, 0)
+        ]
+        if self._decoder is None or last is None or not keyframe <= last.pts < pts:
+            self.container.seek(pts, stream=self.stream, backward=True)
+            self._decoder = self.container.decode(self.stream)
+            self._last_frame = None
+            self.num_seeks += 1
+
+        for vid_frame in self._decoder:
+            self.num_decoded += 1
+            self._last_frame = vid_frame
+            if vid_frame.pts is not None and vid_frame.pts >= pts:
+                if vid_frame.pts != pts:
+                    logging.warning(
+                        f"Frame {pts} not found in video, used {vid_frame.pts}"
+                    )
+                return vid_frame
+        if self._last_frame is None:
+            raise IndexError(f"Frame {pts} could not be decoded")
+        # The video ended before the frame, use the last one available
+        self._decoder = None
+        return self._last_frame
+
+    def frame_metadata(self):
+        """The pts and timestamps of the frames, like encode_video_as_base64."""
+        return frame_metadata_for_pts(self.video_path, self.pts)
+
+    def close(self):
+        self._executor.shutdown()
+        with self._decode_lock:
+            self._cache.clear()
+            self.container.close()
+
+
+def _set_done(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class StreamingFrames:
+    """
+    Drop-in replacement for the list returned by encode_video_as_base64 whose
+    frames are still being encoded on a worker thread, so that the frames at
+    the start can be queried while the rest of the video is encoded.
+
+    Coroutines wait for a frame with `await frames.wait_for(index)`. Indexing
+    a frame that is not encoded yet blocks until it is. If the video ends
+    before num_frames frames, the missing ones are the last frame available,
+    like in LazyFrameSource. If the encoding fails, waiting, indexing and
+    closing raise its error.
+    """
+
+    def __init__(self, num_frames, produce):
+        """
+        :param num_frames: number of frames the producer is expected to encode.
+        :param produce: called on the worker thread with this object, appends
+            the encoded frames to it in order, e.g. through the frames
+            argument of encode_video_as_base64.
+        """
+        self.num_frames = num_frames
+        self._frames = []
+        self._condition = threading.Condition()
+        self._waiters = []
+        self._done = False
+        self.error = None
+        self._thread = threading.Thread(
+            target=self._run, args=(produce,), name="frame-encoder", daemon=True
         )
-        cv2.destroyAllWindows()
+        self._thread.start()
+
+    def _run(self, produce):
+        try:
+            produce(self)
+        except Exception as e:
+            logging.error(f"Encoding the frames failed: {e}", exc_info=True)
+            self.error = e
+        finally:
+            with self._condition:
+                self._done = True
+                self._wake(self.num_frames)
+            if self.error is None and len(self._frames) < self.num_frames:
+                logging.warning(
+                    f"Only {len(self._frames)} of {self.num_frames} frames could "
+                    "be encoded, using the last one for the rest"
+                )
+
+    def _wake(self, num_available):
+        # Called with the condition held
+        self._condition.notify_all()
+        waiting = []
+        for index, future in self._waiters:
+            if index < num_available:
+                future.get_loop().call_soon_threadsafe(_set_done, future)
+            else:
+                waiting.append((index, future))
+        self._waiters = waiting
+
+    def append(self, frame):
+        with self._condition:
+            self._frames.append(frame)
+            self._wake(len(self._frames))
+
+    def __len__(self):
+        return self.num_frames
+
+    def encoded(self):
+        """The frames encoded so far."""
+        with self._condition:
+            return list(self._frames)
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    async def wait_for(self, index):
+        """Waits until frame index is encoded or the encoding has ended."""
+        with self._condition:
+            if index < len(self._frames) or self._done:
+                self._raise_error()
+                return
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.append((index, future))
+        await future
+        self._raise_error()
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        with self._condition:
+            while index >= len(self._frames) and not self._done:
+                self._condition.wait()
+            self._raise_error()
+            if index < len(self._frames):
+                return self._frames[index]
+            if not self._frames:
+                raise IndexError(f"Frame {index} could not be encoded")
+            return self._frames[-1]
+
+    def close(self):
+        """Waits for the encoding to finish. Blocks, call it off the event
+        loop while other coroutines run."""
+        self._thread.join()
+        self._raise_error()
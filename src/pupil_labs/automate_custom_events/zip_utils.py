@@ -0,0 +1,248 @@
+import fnmatch
+import logging
+import os
+import struct
+import zlib
+from pathlib import Path, PurePosixPath
+from typing import Iterable, List, Optional, Sequence, Union
+from zipfile import BadZipFile
+
+LOCAL_FILE_HEADER = b"PK\x03\x04"
+DATA_DESCRIPTOR = b"PK\x07\x08"
+CENTRAL_DIRECTORY_SIGNATURES = (b"PK\x01\x02", b"PK\x05\x06", b"PK\x06\x06")
+
+STORED = 0
+DEFLATED = 8
+
+# Bytes read from the source per step when the member size is not known up front
+READ_SIZE = 1024 * 1024
+
+
+class _ChunkReader:
+    """Byte reader on top of an iterable of chunks, with push-back support."""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+
+    def _fill(self, n: int) -> bool:
+        while len(self._buffer) < n:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                return False
+        return True
+
+    def read(self, n: int) -> bytes:
+        """Reads exactly n bytes, failing if the archive ends before."""
+        if not self._fill(n):
+            raise BadZipFile("Unexpected end of archive")
+        data = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return data
+
+    def read_some(self, max_n: int = READ_SIZE) -> bytes:
+        """Reads up to max_n bytes; returns b"" only at the end of the archive."""
+        self._fill(1)
+        data = bytes(self._buffer[:max_n])
+        del self._buffer[:max_n]
+        return data
+
+    def unread(self, data: bytes) -> None:
+        self._buffer[:0] = data
+
+
+def _flattened_name(name: str) -> Optional[PurePosixPath]:
+    """
+    Drops the top-level folder of a member name, mirroring the layout that
+    unpacking the export and moving every file one level up used to produce.
+    """
+    parts = PurePosixPath(name).parts
+    if any(part in ("..", "/") for part in parts):
+        raise BadZipFile(f"Unsafe member name in archive: {name}")
+    if len(parts) > 1:
+        parts = parts[1:]
+    return PurePosixPath(*parts) if parts else None
+
+
+def _parse_zip64_sizes(extra: bytes, csize: int, usize: int):
+    zip64 = False
+    while len(extra) >= 4:
+        header_id, length = struct.unpack("<HH", extra[:4])
+        data = extra[4 : 4 + length]
+        if header_id == 0x0001:
+            zip64 = True
+            if usize == 0xFFFFFFFF and len(data) >= 8:
+                usize = struct.unpack("<Q", data[:8])[0]
+                data = data[8:]
+            if csize == 0xFFFFFFFF and len(data) >= 8:
+                csize = struct.unpack("<Q", data[:8])[0]
+        extra = extra[4 + length :]
+    return csize, usize, zip64
+
+
+def _copy_known_size(reader, size, decompressor, sink):
+    remaining = size
+    while remaining:
+        data = reader.read_some(min(remaining, READ_SIZE))
+        if not data:
+            raise BadZipFile("Unexpected end of archive")
+        remaining -= len(data)
+        sink(decompressor.decompress(data) if decompressor else data)
+    if decompressor:
+        sink(decompressor.flush())
+
+
+def _copy_deflated_until_eof(reader, sink):
+    decompressor = zlib.decompressobj(-15)
+    while not decompressor.eof:
+        data = reader.read_some()
+        if not data:
+            raise BadZipFile("Unexpected end of archive")
+        sink(decompressor.decompress(data))
+    reader.unread(decompressor.unused_data)
+
+
+def _copy_stored_until_descriptor(reader, size_len, sink):
+    """
+    A stored member of unknown size ends where a data descriptor whose CRC and
+    size match the bytes seen so far begins.
+    """
+    window = 8 + 2 * size_len
+    size_fmt = "<Q" if size_len == 8 else "<I"
+    pending = bytearray()
+    crc, total = 0, 0
+    while True:
+        data = reader.read_some()
+        if not data:
+            raise BadZipFile("Unexpected end of archive")
+        pending += data
+        pos = pending.find(DATA_DESCRIPTOR)
+        while pos != -1 and pos + window <= len(pending):
+            expected_crc = struct.unpack("<I", pending[pos + 4 : pos + 8])[0]
+            expected_size = struct.unpack(
+                size_fmt, pending[pos + 8 : pos + 8 + size_len]
+            )[0]
+            if (
+                total + pos == expected_size
+                and zlib.crc32(pending[:pos], crc) == expected_crc
+            ):
+                sink(bytes(pending[:pos]))
+                reader.unread(bytes(pending[pos:]))
+                return
+            pos = pending.find(DATA_DESCRIPTOR, pos + 1)
+        # Keep any bytes that may still turn out to be a descriptor.
+        flush = len(pending) - window + 1 if pos == -1 else pos
+        if flush > 0:
+            crc = zlib.crc32(pending[:flush], crc)
+            total += flush
+            sink(bytes(pending[:flush]))
+            del pending[:flush]
+
+
+def extract_zip_stream(
+    chunks: Iterable[bytes],
+    rec_path: Union[str, Path],
+    members: Optional[Sequence[str]] = None,
+) -> List[Path]:
+    """
+    Extracts a zip archive in a single pass while its bytes arrive, writing
+    every member straight into rec_path without its top-level folder.
+    :param chunks: the archive contents, e.g. an HTTP response body.
+    :param rec_path: the output folder.
+    :param members: glob patterns of the (flattened) member names to extract,
+        e.g. ("*.mp4", "gaze.csv"). Other members are skipped. None extracts all.
+    :return: the paths of the extracted files.
+    """
+    rec_path = Path(rec_path)
+    rec_path.mkdir(parents=True, exist_ok=True)
+    reader = _ChunkReader(chunks)
+    extracted = []
+
+    while True:
+        # Fails on a truncated archive, every archive ends in a central directory
+        signature = reader.read(4)
+        if signature in CENTRAL_DIRECTORY_SIGNATURES:
+            break
+        if signature != LOCAL_FILE_HEADER:
+            raise BadZipFile(f"Unexpected signature {signature!r} in archive")
+
+        (
+            _,
+            flags,
+            method,
+            _,
+            _,
+            crc,
+            csize,
+            usize,
+            name_len,
+            extra_len,
+        ) = struct.unpack("<HHHHHIIIHH", reader.read(26))
+        name = reader.read(name_len).decode("utf-8" if flags & 0x800 else "cp437")
+        csize, usize, zip64 = _parse_zip64_sizes(reader.read(extra_len), csize, usize)
+        has_descriptor = bool(flags & 0x08)
+
+        if flags & 0x01:
+            raise BadZipFile(f"Encrypted member {name} is not supported")
+        if method not in (STORED, DEFLATED):
+            raise BadZipFile(f"Compression method {method} of {name} is not supported")
+
+        relative_name = _flattened_name(name)
+        wanted = (
+            relative_name is not None
+            and not name.endswith("/")
+            and (
+                members is None
+                or any(fnmatch.fnmatch(str(relative_name), p) for p in members)
+            )
+        )
+
+        out_path = rec_path / relative_name if wanted and relative_name else None
+        tmp_path = None
+        fd = None
+        if out_path is not None:
+            out_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = out_path.with_name(out_path.name + ".part")
+            fd = tmp_path.open("wb")
+
+        actual_crc = 0
+
+        def sink(data: bytes) -> None:
+            nonlocal actual_crc
+            if fd is not None and data:
+                actual_crc = zlib.crc32(data, actual_crc)
+                fd.write(data)
+
+        try:
+            if not has_descriptor or csize:
+                _copy_known_size(
+                    reader,
+                    csize,
+                    zlib.decompressobj(-15) if method == DEFLATED else None,
+                    sink,
+                )
+            elif method == DEFLATED:
+                _copy_deflated_until_eof(reader, sink)
+            else:
+                _copy_stored_until_descriptor(reader, 8 if zip64 else 4, sink)
+        finally:
+            if fd is not None:
+                fd.close()
+
+        if has_descriptor:
+            descriptor = reader.read(4)
+            if descriptor == DATA_DESCRIPTOR:
+                descriptor = reader.read(4)
+            crc = struct.unpack("<I", descriptor)[0]
+            reader.read(16 if zip64 else 8)
+
+        if out_path is not None and tmp_path is not None:
+            if actual_crc != crc:
+                tmp_path.unlink()
+                raise BadZipFile(f"Bad CRC-32 for member {name}")
+            os.replace(tmp_path, out_path)
+            extracted.append(out_path)
+            logging.debug(f"Extracted {out_path.name}")
+
+    return extracted
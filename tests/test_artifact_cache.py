@@ -0,0 +1,77 @@
+import json
+import os
+
+from pupil_labs.automate_custom_events.artifact_cache import (
+    MANIFEST_NAME,
+    ArtifactCache,
+    EncodedFrameFile,
+    evict_recordings,
+    save_encoded_frames,
+)
+
+
+def test_stage_invalidated_by_params_and_inputs(tmp_path):
+    rec_path = tmp_path / "rec"
+    rec_path.mkdir()
+    gaze = rec_path / "gaze.csv"
+    gaze.write_text("a,b\n1,2\n")
+    output = rec_path / "merged.csv"
+    output.write_text("merged")
+
+    cache = ArtifactCache(rec_path, "rec")
+    key = cache.key("gaze_merge", {"radius": 20}, inputs=[gaze])
+    assert not cache.is_valid("gaze_merge", key)
+    cache.store("gaze_merge", key, [output])
+
+    cache = ArtifactCache(rec_path, "rec")
+    assert cache.is_valid("gaze_merge", cache.key("gaze_merge", {"radius": 20}, [gaze]))
+    assert not cache.is_valid(
+        "gaze_merge", cache.key("gaze_merge", {"radius": 5}, [gaze])
+    )
+
+    gaze.write_text("a,b\n1,3\n")
+    assert not cache.is_valid(
+        "gaze_merge", cache.key("gaze_merge", {"radius": 20}, [gaze])
+    )
+
+    gaze.write_text("a,b\n1,2\n")
+    output.write_text("truncated")
+    assert not cache.is_valid("gaze_merge", key)
+
+
+def test_encoded_frames_roundtrip(tmp_path):
+    frames = ["aGVsbG8=", "", "d29ybGQ="]
+    save_encoded_frames(tmp_path, frames)
+    encoded = EncodedFrameFile(tmp_path)
+    assert len(encoded) == 3
+    assert [encoded[i] for i in range(3)] == frames
+    assert encoded[-1] == frames[-1]
+    encoded.close()
+
+
+def test_evict_least_recently_used(tmp_path):
+    for i, name in enumerate(["old", "current", "new"]):
+        rec_path = tmp_path / name
+        rec_path.mkdir()
+        (rec_path / "scene.mp4").write_bytes(b"0" * 1000)
+        (rec_path / "response_cache.sqlite").write_bytes(b"0" * 100)
+        (rec_path / "custom_events.csv").write_bytes(b"0" * 5000)
+        manifest = {
+            "last_used": i,
+            "stages": {"download": {"key": "k", "outputs": {"scene.mp4": 1000}}},
+        }
+        (rec_path / MANIFEST_NAME).write_text(json.dumps(manifest))
+    os.mkdir(tmp_path / "not_a_recording")
+
+    # Only the 1100 bytes of artifacts per recording count
+    evicted = evict_recordings(tmp_path, 2500, keep=["current"])
+    assert [p.name for p in evicted] == ["old"]
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "current",
+        "new",
+        "not_a_recording",
+        "old",
+    ]
+    # The results of the evicted recording are kept
+    assert [p.name for p in (tmp_path / "old").iterdir()] == ["custom_events.csv"]
+    assert len(list((tmp_path / "new").iterdir())) == 4
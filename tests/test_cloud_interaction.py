@@ -0,0 +1,172 @@
+import asyncio
+import io
+import re
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from aiohttp import web
+
+from pupil_labs.automate_custom_events import cloud_interaction
+from pupil_labs.automate_custom_events.run_metrics import RunMetrics
+
+WORKSPACE_ID = "0a1b2c3d-workspace"
+RECORDING_ID = "4e5f6a7b-recording"
+
+
+def make_export_zip():
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zf:
+        folder = f"2024-01-01_00-00-00-{RECORDING_ID[:8]}"
+        zf.writestr(f"{folder}/gaze.csv", "timestamp [ns],gaze x [px],gaze y [px]\n")
+        zf.writestr(f"{folder}/world_timestamps.csv", "timestamp [ns]\n")
+        zf.writestr(f"{folder}/scene.mp4", bytes(range(256)) * 4096)
+        zf.writestr(f"{folder}/imu.csv", "timestamp [ns]\n" * 1000)
+    return buffer.getvalue()
+
+
+class RawDataExportHandler(BaseHTTPRequestHandler):
+    """Stand-in for workspaces/{id}/recordings:raw-data-export."""
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.headers.get("Range"))
+        body = server.body
+        start, end = 0, len(body) - 1
+        range_header = self.headers.get("Range")
+        if range_header and server.support_ranges:
+            m = re.match(r"bytes=(\d+)-(\d*)", range_header)
+            start = int(m.group(1))
+            end = int(m.group(2)) if m.group(2) else end
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(body)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        payload = body[start : end + 1]
+        if server.fail_after is not None and len(payload) > server.fail_after:
+            # Simulate a dropped connection halfway through the transfer.
+            self.wfile.write(payload[: server.fail_after])
+            server.fail_after = None
+            self.close_connection = True
+            return
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def cloud_server(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RawDataExportHandler)
+    server.body = make_export_zip()
+    server.support_ranges = True
+    server.fail_after = None
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(
+        cloud_interaction, "API_URL", f"http://127.0.0.1:{server.server_port}"
+    )
+    monkeypatch.setattr(cloud_interaction.time, "sleep", lambda s: None)
+    yield server
+    server.shutdown()
+
+
+def test_download_resumes_after_dropped_connection(cloud_server, tmp_path):
+    cloud_server.fail_after = 100_000
+    save_path = tmp_path / "export.zip"
+    status = cloud_interaction.download_url(
+        "export", save_path, "token", chunk_size=4096
+    )
+    assert status == 206
+    assert save_path.read_bytes() == cloud_server.body
+    assert cloud_server.requests[-1].startswith("bytes=")
+
+
+def test_download_restarts_without_range_support(cloud_server, tmp_path):
+    cloud_server.fail_after = 100_000
+    cloud_server.support_ranges = False
+    save_path = tmp_path / "export.zip"
+    status = cloud_interaction.download_url("export", save_path, "token")
+    assert status == 200
+    assert save_path.read_bytes() == cloud_server.body
+
+
+def test_download_parallel_ranges(cloud_server, tmp_path):
+    save_path = tmp_path / "export.zip"
+    cloud_interaction.download_url("export", save_path, "token", num_connections=4)
+    assert save_path.read_bytes() == cloud_server.body
+    assert len(cloud_server.requests) == 5
+
+
+@pytest.mark.parametrize("stream_extract", [True, False])
+def test_download_recording_flattens_export(cloud_server, tmp_path, stream_extract):
+    cloud_server.fail_after = 300_000
+    cloud_interaction.download_recording(
+        RECORDING_ID,
+        WORKSPACE_ID,
+        tmp_path,
+        "token",
+        chunk_size=65536,
+        stream_extract=stream_extract,
+        members=cloud_interaction.PIPELINE_MEMBERS,
+    )
+    rec_path = tmp_path / RECORDING_ID
+    assert sorted(p.name for p in rec_path.iterdir()) == [
+        "gaze.csv",
+        "scene.mp4",
+        "world_timestamps.csv",
+    ]
+    assert (rec_path / "scene.mp4").read_bytes() == bytes(range(256)) * 4096
+    assert not (tmp_path / f"{RECORDING_ID}.zip").exists()
+
+
+def test_event_publisher_retries_and_coalesces(monkeypatch):
+    received = []
+    failures = {"remaining": 2}
+
+    async def post_event(request):
+        if failures["remaining"]:
+            failures["remaining"] -= 1
+            return web.Response(status=503)
+        received.append(await request.json())
+        return web.json_response({})
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_post(
+            "/workspaces/{workspace}/recordings/{recording}/events", post_event
+        )
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        monkeypatch.setattr(cloud_interaction, "API_URL", f"http://127.0.0.1:{port}")
+
+        async with cloud_interaction.EventPublisher(
+            WORKSPACE_ID, RECORDING_ID, "token", max_concurrency=2, metrics=metrics
+        ) as publisher:
+            assert publisher.publish("looking_at_mirror", 1.5)
+            assert not publisher.publish("looking_at_mirror", 1.5)
+            assert publisher.publish("turning_left", 3)
+        await runner.cleanup()
+        return publisher
+
+    metrics = RunMetrics()
+    real_sleep = asyncio.sleep
+    monkeypatch.setattr(cloud_interaction.asyncio, "sleep", lambda s: real_sleep(0))
+    publisher = asyncio.run(scenario())
+
+    assert sorted(e["name"] for e in received) == ["looking_at_mirror", "turning_left"]
+    assert len(publisher.sent) == 2
+    assert publisher.failed == []
+    report = metrics.report()
+    assert report["counters"]["cloud_posts"] == {"status=200": 2, "status=503": 2}
+    assert report["counters"]["cloud_post_retries"] == 2
+    assert report["counters"]["cloud_events"] == {"outcome=sent": 2}
+    assert report["stages"]["event_post"]["calls"] == 2
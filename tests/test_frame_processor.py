@@ -0,0 +1,760 @@
+import asyncio
+import base64
+import json
+import random
+
+import aiohttp
+import cv2
+import numpy as np
+import pandas as pd
+import pytest
+from aiohttp import web
+
+from pupil_labs.automate_custom_events import frame_processor
+from pupil_labs.automate_custom_events.batch_api import BatchClient
+from pupil_labs.automate_custom_events.frame_processor import FrameProcessor
+from pupil_labs.automate_custom_events.prefilter import FrameScorer, Prefilter
+from pupil_labs.automate_custom_events.rate_limiter import (
+    RateLimiter,
+    shared_rate_limiter,
+)
+from pupil_labs.automate_custom_events.response_cache import (
+    ResponseCache,
+    request_key,
+)
+from pupil_labs.automate_custom_events.video_utils import FrameSignatures
+
+NUM_FRAMES = 120
+CODES = "reading_book; looking_phone"
+
+
+class RecordingPublisher:
+    def __init__(self):
+        self.events = []
+
+    def publish(self, keyword, ts):
+        self.events.append((keyword, ts))
+        return True
+
+
+def make_processor(
+    max_concurrency,
+    frames_per_request=1,
+    num_frames=NUM_FRAMES,
+    first_frame=0,
+    **kwargs,
+):
+    # The frames from first_frame on, like those of a time window
+    numbers = range(first_frame, first_frame + num_frames)
+    metadata = pd.DataFrame(
+        {
+            "frame": numbers,
+            "frame_id": numbers,
+            "timestamp [s]": [i / 10 for i in numbers],
+        }
+    )
+    processor = FrameProcessor(
+        [f"frame{i}" for i in numbers],
+        metadata,
+        "openai-key",
+        "cloud-token",
+        "recording",
+        "workspace",
+        "reading a book; looking at the phone",
+        CODES,
+        20,
+        0,
+        num_frames,
+        rate_limiter=RateLimiter(max_concurrency),
+        frames_per_request=frames_per_request,
+        **kwargs,
+    )
+    processor.event_publisher = RecordingPublisher()
+    return processor
+
+
+def run_search(max_concurrency):
+    processor = make_processor(max_concurrency)
+    rng = random.Random(0)
+    delays = [rng.uniform(0, 0.002) for _ in range(NUM_FRAMES)]
+    in_flight = {"now": 0, "peak": 0}
+
+    async def query_frames(indices, session):
+        async with processor.rate_limiter.slot():
+            in_flight["now"] += 1
+            in_flight["peak"] = max(in_flight["peak"], in_flight["now"])
+            await asyncio.sleep(delays[indices[0]])
+            in_flight["now"] -= 1
+        frame_detections = {}
+        for index in indices:
+            if 30 <= index < 50:
+                code = "reading_book"
+            elif index >= 90:
+                code = "looking_phone"
+            else:
+                continue
+            frame_detections[index] = [
+                {"frame_id": index, "timestamp [s]": index / 10, "code": code}
+            ]
+        return frame_detections
+
+    async def scenario():
+        processor.query_frames = query_frames
+        return await processor.process_batches(None, processor.batch_size)
+
+    results = asyncio.run(scenario())
+    return results, processor.event_publisher.events, in_flight["peak"]
+
+
+def test_concurrent_search_matches_sequential():
+    sequential, sequential_events, sequential_peak = run_search(1)
+    concurrent, concurrent_events, concurrent_peak = run_search(4)
+
+    assert sequential_peak == 1
+    assert 1 < concurrent_peak <= 4
+    assert concurrent == sequential
+    assert concurrent_events == sequential_events
+    assert [event[0] for event in concurrent_events] == [
+        "reading_book",
+        "looking_phone",
+    ]
+
+
+async def serve_openai(monkeypatch, chat_completions):
+    """Starts a stand-in for the chat completions endpoint."""
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    monkeypatch.setattr(
+        frame_processor, "OPENAI_URL", f"http://127.0.0.1:{port}/v1/chat/completions"
+    )
+    return runner
+
+
+def test_query_frame_follows_rate_limits_and_reports_failures(monkeypatch):
+    statuses = [429, 429, 200, 400]
+    seen = []
+
+    async def chat_completions(request):
+        status = statuses[len(seen)]
+        seen.append(status)
+        if status == 429:
+            return web.json_response({}, status=429, headers={"retry-after-ms": "10"})
+        if status != 200:
+            return web.json_response({}, status=status)
+        content = "Frame 5: Timestamp - 0.5, Code - reading_book"
+        return web.json_response(
+            {"choices": [{"message": {"content": content}}]},
+            headers={
+                "x-ratelimit-remaining-requests": "99",
+                "x-ratelimit-reset-requests": "600ms",
+            },
+        )
+
+    async def scenario(processor):
+        runner = await serve_openai(monkeypatch, chat_completions)
+        async with aiohttp.ClientSession() as session:
+            hit = await processor.query_frame(5, session)
+            miss = await processor.query_frame(6, session)
+        await runner.cleanup()
+        return hit, miss
+
+    processor = make_processor(4)
+    hit, miss = asyncio.run(scenario(processor))
+
+    assert hit == [{"frame_id": 5, "timestamp [s]": 0.5, "code": "reading_book"}]
+    assert miss is None
+    assert seen == statuses
+    limiter = processor.rate_limiter
+    assert limiter.num_rate_limited == 2
+    assert limiter.limit == 2
+    assert limiter.remaining_requests == 98
+    assert processor.failed_frames == [
+        {"frame_id": 6, "timestamp [s]": 0.6, "reason": "HTTP 400"}
+    ]
+    report = processor.metrics.report()
+    assert report["counters"]["openai_requests"] == {
+        "status=200": 1,
+        "status=400": 1,
+        "status=429": 2,
+    }
+    assert report["counters"]["openai_retries"] == 2
+    assert report["counters"]["failed_frames"] == 1
+    assert report["histograms"]["openai_request_latency_seconds"]["count"] == 1
+
+
+def test_query_frame_retries_timeouts(monkeypatch):
+    seen = []
+
+    async def chat_completions(request):
+        seen.append(request)
+        if len(seen) == 1:
+            await asyncio.sleep(1)
+        content = "Frame 5: Timestamp - 0.5, Code - reading_book"
+        return web.json_response({"choices": [{"message": {"content": content}}]})
+
+    async def scenario(processor):
+        runner = await serve_openai(monkeypatch, chat_completions)
+        timeout = aiohttp.ClientTimeout(total=0.2)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            hit = await processor.query_frame(5, session)
+        await runner.cleanup()
+        return hit
+
+    processor = make_processor(4)
+    hit = asyncio.run(scenario(processor))
+
+    assert hit == [{"frame_id": 5, "timestamp [s]": 0.5, "code": "reading_book"}]
+    assert len(seen) == 2
+    report = processor.metrics.report()
+    assert report["counters"]["openai_requests"] == {
+        "status=200": 1,
+        "status=TimeoutError": 1,
+    }
+
+
+def test_request_latency_leaves_out_the_limiter_wait(monkeypatch):
+    async def chat_completions(request):
+        await asyncio.sleep(0.1)
+        return web.json_response({"choices": [{"message": {"content": ""}}]})
+
+    async def scenario(processor):
+        runner = await serve_openai(monkeypatch, chat_completions)
+        async with aiohttp.ClientSession() as session:
+            await asyncio.gather(
+                *(processor.query_frame(index, session) for index in range(3))
+            )
+        await runner.cleanup()
+
+    processor = make_processor(1)
+    asyncio.run(scenario(processor))
+
+    latency = processor.metrics.report()["histograms"][
+        "openai_request_latency_seconds"
+    ]
+    assert latency["count"] == 3
+    # One at a time, the last request waited for two others in the limiter
+    assert latency["max"] < 0.18
+
+
+def test_rate_limiter_counts_slots_per_event_loop():
+    limiter = RateLimiter(1)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(limiter.acquire())
+
+        async def other_run():
+            async with limiter.slot():
+                assert limiter.in_flight == 2
+
+        asyncio.run(other_run())
+        assert limiter.in_flight == 1
+        with pytest.raises(asyncio.TimeoutError):
+            loop.run_until_complete(asyncio.wait_for(limiter.acquire(), 0.05))
+    finally:
+        loop.close()
+
+
+def test_shared_rate_limiter_keeps_the_lowest_concurrency():
+    limiter = shared_rate_limiter("key-of-this-test", 8)
+    assert shared_rate_limiter("key-of-this-test", 4) is limiter
+    assert shared_rate_limiter("key-of-this-test", 16) is limiter
+    assert limiter.max_concurrency == 4
+    assert limiter.limit == 4
+
+
+def test_multi_frame_request_routes_detections(monkeypatch):
+    requests = []
+
+    async def chat_completions(request):
+        body = await request.json()
+        requests.append(body)
+        rows = json.loads(body["messages"][2]["content"].split(": ", 1)[1])
+        # Answer out of order and refer to the last frame by timestamp only
+        content = "\n".join(
+            [
+                f"Frame {rows[1]['frame']}: Timestamp - "
+                f"{rows[1]['timestamp [s]']}, Code - looking_phone",
+                f"Frame 999: Timestamp - {rows[2]['timestamp [s]']}, "
+                "Code - reading_book",
+                "Frame 998: Timestamp - 99.9, Code - reading_book",
+            ]
+        )
+        return web.json_response({"choices": [{"message": {"content": content}}]})
+
+    async def scenario(processor):
+        runner = await serve_openai(monkeypatch, chat_completions)
+        async with aiohttp.ClientSession() as session:
+            frame_detections = await processor.query_frames([3, 4, 5], session)
+        await runner.cleanup()
+        return frame_detections
+
+    processor = make_processor(4, frames_per_request=3)
+    frame_detections = asyncio.run(scenario(processor))
+
+    assert len(requests) == 1
+    assert len(requests[0]["messages"][3]["content"]) == 3
+    assert sorted(frame_detections) == [4, 5]
+    assert frame_detections[4][0]["code"] == "looking_phone"
+    assert frame_detections[5][0]["code"] == "reading_book"
+
+
+def test_window_frames_keep_their_numbers_in_the_video():
+    whole = make_processor(4, frames_per_request=2)
+    window = make_processor(
+        4, frames_per_request=2, num_frames=NUM_FRAMES - 50, first_frame=50
+    )
+
+    # The same frames make the same request whatever the window starts at
+    _, _, whole_params = whole.build_request([60, 61])
+    _, _, window_params = window.build_request([10, 11])
+    rows = json.loads(window_params["messages"][2]["content"].split(": ", 1)[1])
+    assert [row["frame"] for row in rows] == [60, 61]
+    assert request_key(window_params) == request_key(whole_params)
+
+    frame_detections = window.parse_response(
+        [10, 11], {}, "Frame 61: Timestamp - 9.9, Code - reading_book"
+    )
+    assert frame_detections == {
+        11: [{"frame_id": 61, "timestamp [s]": 9.9, "code": "reading_book"}]
+    }
+    window.report_failure([12], "HTTP 400")
+    assert window.failed_frames[0]["frame_id"] == 62
+    events = window.publish_occurrences(
+        {10: frozenset({"reading_book"}), 11: frozenset()}
+    )
+    assert [event["frame_id"] for event in events] == [60, 60]
+
+
+@pytest.mark.parametrize("frames_per_request", [2, 4])
+def test_probe_indices_cover_short_ranges(frames_per_request):
+    processor = make_processor(1, frames_per_request)
+    probes = processor.probe_indices(10, 30)
+    assert len(probes) == frames_per_request
+    assert 10 <= probes[0] and probes[-1] < 30
+    assert processor.probe_indices(10, 12) == [10, 11]
+
+
+def test_repeated_query_is_answered_from_cache(monkeypatch, tmp_path):
+    requests = []
+
+    async def chat_completions(request):
+        requests.append(await request.json())
+        content = "Frame 7: Timestamp - 0.7, Code - reading_book"
+        return web.json_response({"choices": [{"message": {"content": content}}]})
+
+    async def scenario(processor):
+        runner = await serve_openai(monkeypatch, chat_completions)
+        async with aiohttp.ClientSession() as session:
+            first = await processor.query_frame(7, session)
+            second = await processor.query_frame(7, session)
+        await runner.cleanup()
+        return first, second
+
+    processor = make_processor(4)
+    processor.response_cache = ResponseCache(tmp_path / "responses.sqlite")
+    first, second = asyncio.run(scenario(processor))
+
+    assert first == second
+    assert len(requests) == 1
+    assert (processor.response_cache.hits, processor.response_cache.misses) == (1, 1)
+
+
+def test_requests_share_prefix_and_cached_tokens_are_counted(monkeypatch):
+    requests = []
+
+    async def chat_completions(request):
+        requests.append(await request.json())
+        cached = 1024 if len(requests) > 1 else 0
+        return web.json_response(
+            {
+                "choices": [{"message": {"content": "No activity."}}],
+                "usage": {
+                    "prompt_tokens": 1500,
+                    "completion_tokens": 5,
+                    "prompt_tokens_details": {"cached_tokens": cached},
+                },
+            }
+        )
+
+    async def scenario(processor):
+        runner = await serve_openai(monkeypatch, chat_completions)
+        async with aiohttp.ClientSession() as session:
+            await processor.query_frames([1, 2], session)
+            await processor.query_frames([8, 9], session)
+        await runner.cleanup()
+
+    processor = make_processor(4, frames_per_request=2)
+    asyncio.run(scenario(processor))
+
+    first, second = (r["messages"] for r in requests)
+    assert first[:2] == second[:2]
+    assert first[2:] != second[2:]
+    report = processor.usage_stats.report()
+    assert report["requests"] == 2
+    assert report["prompt_tokens"] == 3000
+    assert report["cached_tokens"] == 1024
+    assert report["saved_usd_estimate"] > 0
+    assert report["mean_latency_cached_s"] is not None
+
+
+def test_near_duplicate_frames_reuse_detections():
+    processor = make_processor(4)
+    signatures = FrameSignatures()
+    rng = np.random.default_rng(1)
+    scenes = [rng.integers(0, 255, (60, 80, 3), dtype=np.uint8) for _ in range(2)]
+    for index in range(NUM_FRAMES):
+        signatures.add(index, scenes[index >= 60], (40, 30))
+    processor.frame_signatures = signatures
+    queried = []
+
+    async def query_frames(indices, session):
+        reused = processor.reuse_duplicates(indices)
+        frame_detections = {
+            index: detections for index, detections in reused.items() if detections
+        }
+        for index in indices:
+            if index in reused:
+                continue
+            queried.append(index)
+            detection = {"frame_id": index, "timestamp [s]": index / 10}
+            code = "looking_phone" if index >= 60 else None
+            processor.frame_results[index] = (
+                [{**detection, "code": code}] if code else []
+            )
+            if code:
+                frame_detections[index] = processor.frame_results[index]
+        return frame_detections
+
+    processor.query_frames = query_frames
+    results = asyncio.run(processor.process_batches(None, processor.batch_size))
+
+    assert queried == [10, 70]
+    assert processor.num_duplicates_skipped > 0
+    assert [r["code"] for r in results] == ["looking_phone"]
+    assert results[0]["frame_id"] >= 60
+
+
+@pytest.mark.parametrize("frames_per_request", [1, 3])
+def test_coarse_to_fine_search_finds_every_occurrence(frames_per_request):
+    occurrences = {
+        "reading_book": [(100, 180), (400, 431)],
+        "looking_phone": [(150, 260)],
+    }
+    processor = make_processor(
+        8,
+        frames_per_request,
+        num_frames=600,
+        search_strategy="coarse_to_fine",
+        search_params={"stride": 40, "tolerance": 1},
+    )
+    queried = []
+
+    async def query_frames(indices, session):
+        queried.extend(indices)
+        return {
+            index: [
+                {"frame_id": index, "timestamp [s]": index / 10, "code": code}
+                for code, spans in occurrences.items()
+                if any(start <= index <= end for start, end in spans)
+            ]
+            for index in indices
+        }
+
+    processor.query_frames = query_frames
+    results = asyncio.run(processor.coarse_to_fine_search(None))
+
+    assert [(r["frame_id"], r["event"]) for r in results] == [
+        (100, "reading_book_start"),
+        (150, "looking_phone_start"),
+        (180, "reading_book_end"),
+        (260, "looking_phone_end"),
+        (400, "reading_book_start"),
+        (431, "reading_book_end"),
+    ]
+    assert [e[0] for e in processor.event_publisher.events] == [
+        r["event"] for r in results
+    ]
+    assert len(set(queried)) < 600 / 5
+
+
+class BatchStandIn:
+    """Stand-in for the files and batches endpoints of the Batch API."""
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.files = {}
+        self.batches = {}
+        self.num_requests = []
+
+    async def upload(self, request):
+        form = await request.post()
+        assert form["purpose"] == "batch"
+        file_id = f"file-{len(self.files)}"
+        self.files[file_id] = form["file"].file.read().decode()
+        return web.json_response({"id": file_id})
+
+    async def create(self, request):
+        body = await request.json()
+        lines = self.files[body["input_file_id"]].splitlines()
+        self.num_requests.append(len(lines))
+        output = []
+        for line in lines:
+            line = json.loads(line)
+            rows = json.loads(line["body"]["messages"][2]["content"].split(": ", 1)[1])
+            content = self.answer(rows)
+            if content is None:
+                response = {"status_code": 500, "body": {"error": {"code": "boom"}}}
+            else:
+                response = {
+                    "status_code": 200,
+                    "body": {
+                        "choices": [{"message": {"content": content}}],
+                        "usage": {"prompt_tokens": 1000, "completion_tokens": 10},
+                    },
+                }
+            output.append(
+                json.dumps(
+                    {
+                        "custom_id": line["custom_id"],
+                        "response": response,
+                        "error": None,
+                    }
+                )
+            )
+        output_id = f"file-{len(self.files)}"
+        self.files[output_id] = "\n".join(output)
+        batch_id = f"batch-{len(self.batches)}"
+        self.batches[batch_id] = {
+            "id": batch_id,
+            "status": "in_progress",
+            "output_file_id": output_id,
+        }
+        return web.json_response(self.batches[batch_id])
+
+    async def retrieve(self, request):
+        batch = self.batches[request.match_info["batch_id"]]
+        response = web.json_response(dict(batch))
+        batch["status"] = "completed"
+        return response
+
+    async def content(self, request):
+        return web.Response(text=self.files[request.match_info["file_id"]])
+
+    async def serve(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/files", self.upload)
+        app.router.add_post("/v1/batches", self.create)
+        app.router.add_get("/v1/batches/{batch_id}", self.retrieve)
+        app.router.add_get("/v1/files/{file_id}/content", self.content)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return runner, f"http://127.0.0.1:{port}/v1"
+
+
+def scripted_answer(rows):
+    lines = []
+    for row in rows:
+        if row["frame"] == 13:
+            return None
+        if 30 <= row["frame"] < 50 or 300 <= row["frame"] <= 420:
+            code = "reading_book"
+        elif row["frame"] >= 90:
+            code = "looking_phone"
+        else:
+            continue
+        lines.append(
+            f"Frame {row['frame']}: Timestamp - {row['timestamp [s]']}, Code - {code}"
+        )
+    return "\n".join(lines) or "No activity detected."
+
+
+def run_live(processor):
+    async def query_frames(indices, session):
+        rows = [json.loads(processor.frame_row_json(i)) for i in indices]
+        content = scripted_answer(rows)
+        if content is None:
+            processor.report_failure(indices, "HTTP 500")
+            return None
+        return processor.parse_response(indices, {}, content)
+
+    processor.query_frames = query_frames
+    if processor.search_strategy == "coarse_to_fine":
+        return asyncio.run(processor.coarse_to_fine_search(None))
+    return asyncio.run(processor.process_batches(None, processor.batch_size))
+
+
+def run_batch(processor, tmp_path):
+    stand_in = BatchStandIn(scripted_answer)
+
+    async def scenario():
+        runner, url = await stand_in.serve()
+        processor.batch_client = BatchClient(
+            "openai-key", work_dir=tmp_path, api_url=url, poll_interval=0.01
+        )
+        async with aiohttp.ClientSession() as session:
+            if processor.search_strategy == "coarse_to_fine":
+                results = await processor.batch_coarse_to_fine_search(session)
+            else:
+                results = await processor.batch_binary_search(
+                    session, processor.batch_size
+                )
+        await runner.cleanup()
+        return results
+
+    return asyncio.run(scenario()), stand_in
+
+
+@pytest.mark.parametrize(
+    "search_strategy,frames_per_request",
+    [("binary", 1), ("binary", 3), ("coarse_to_fine", 2)],
+)
+def test_batch_backend_matches_live_search(
+    tmp_path, search_strategy, frames_per_request
+):
+    kwargs = {
+        "frames_per_request": frames_per_request,
+        "num_frames": 600 if search_strategy == "coarse_to_fine" else NUM_FRAMES,
+        "search_strategy": search_strategy,
+        "search_params": {"stride": 40},
+    }
+    live = make_processor(4, **kwargs)
+    live_results = run_live(live)
+    batch = make_processor(4, backend="batch", **kwargs)
+    batch_results, stand_in = run_batch(batch, tmp_path)
+
+    assert batch_results == live_results
+    assert batch.event_publisher.events == live.event_publisher.events
+    assert batch.frame_results == live.frame_results
+    assert len(stand_in.num_requests) > 1
+    assert sorted(f["frame_id"] for f in batch.failed_frames) == sorted(
+        f["frame_id"] for f in live.failed_frames
+    )
+    assert len(list(tmp_path.glob("batch_input_*.jsonl"))) == len(stand_in.num_requests)
+
+
+def test_batch_backend_reports_failed_requests(tmp_path):
+    processor = make_processor(4, backend="batch")
+    stand_in = BatchStandIn(scripted_answer)
+
+    async def scenario():
+        runner, url = await stand_in.serve()
+        processor.batch_client = BatchClient(
+            "openai-key", api_url=url, poll_interval=0.01
+        )
+        async with aiohttp.ClientSession() as session:
+            responses = await processor.query_groups_batch(session, [[12], [13], [35]])
+        await runner.cleanup()
+        return responses
+
+    responses = asyncio.run(scenario())
+
+    assert responses[0] == {}
+    assert responses[1] is None
+    assert responses[2][35][0]["code"] == "reading_book"
+    assert processor.failed_frames == [
+        {
+            "frame_id": 13,
+            "timestamp [s]": 1.3,
+            "reason": "batch request failed: boom",
+        }
+    ]
+    assert stand_in.num_requests == [3]
+
+
+class BrightnessScorer(FrameScorer):
+    """Rates bright frames as likely to show an activity."""
+
+    def __init__(self):
+        self.calls = []
+
+    def score(self, images, activities):
+        self.calls.append(len(images))
+        return np.array([img.mean() / 1000 for img in images])
+
+
+def test_prefilter_skips_unlikely_frames(monkeypatch):
+    def is_positive(frame):
+        return 30 <= frame < 50 or frame >= 90
+
+    frames = [
+        base64.b64encode(
+            cv2.imencode(".jpg", np.full((8, 8, 3), 200 if is_positive(i) else 50))[1]
+        ).decode()
+        for i in range(NUM_FRAMES)
+    ]
+    queried = []
+
+    async def chat_completions(request):
+        body = await request.json()
+        rows = json.loads(body["messages"][2]["content"].split(": ", 1)[1])
+        queried.extend(row["frame"] for row in rows)
+        content = "\n".join(
+            f"Frame {row['frame']}: Timestamp - {row['timestamp [s]']}, "
+            f"Code - {'reading_book' if row['frame'] < 50 else 'looking_phone'}"
+            for row in rows
+            if is_positive(row["frame"])
+        )
+        return web.json_response({"choices": [{"message": {"content": content}}]})
+
+    def search(prefilter):
+        processor = make_processor(4, prefilter=prefilter)
+        processor.base64_frames = frames
+
+        async def scenario():
+            runner = await serve_openai(monkeypatch, chat_completions)
+            async with aiohttp.ClientSession() as session:
+                results = await processor.process_batches(session, 20)
+            await runner.cleanup()
+            return results
+
+        queried.clear()
+        return asyncio.run(scenario()), list(queried), processor
+
+    baseline, baseline_queried, _ = search(None)
+    scorer = BrightnessScorer()
+    prefilter = Prefilter(scorer, {"threshold": 0.1, "audit_every": 4})
+    results, prefiltered_queried, processor = search(prefilter)
+
+    assert results == baseline
+    assert len(prefiltered_queried) < len(baseline_queried)
+    report = processor.metrics.report()["prefilter"]
+    assert report["frames_skipped"] > 0
+    assert report["frames_audited"] > 0
+    assert report["positives_audited"] == 0
+    assert report["recall_estimate"] == 1.0
+    assert report["call_reduction"] == report["frames_skipped"] / (
+        report["frames_skipped"] + report["frames_audited"] + report["frames_escalated"]
+    )
+    # Only the frames that were not audited were kept from the remote model
+    skipped = {i for i, d in prefilter.decisions.items() if d == "skipped"}
+    assert not skipped & set(prefiltered_queried)
+
+
+def test_prefilter_does_not_score_near_duplicates():
+    rng = np.random.default_rng(2)
+    scenes = [rng.integers(0, 255, (60, 80, 3), dtype=np.uint8) for _ in range(2)]
+    signatures = FrameSignatures()
+    for index in range(10):
+        signatures.add(index, scenes[index >= 5], (40, 30))
+    scorer = BrightnessScorer()
+    processor = make_processor(
+        4, prefilter=Prefilter(scorer), frame_signatures=signatures
+    )
+    processor.base64_frames = [
+        base64.b64encode(cv2.imencode(".jpg", scenes[index >= 5])[1]).decode()
+        for index in range(10)
+    ]
+    processor.frame_results[0] = []
+
+    asyncio.run(processor.score_frames(list(range(10))))
+
+    assert scorer.calls == [5]
+    assert sorted(processor.prefilter.scores) == [5, 6, 7, 8, 9]
@@ -0,0 +1,114 @@
+import asyncio
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+from pupil_labs.automate_custom_events import headless
+from pupil_labs.automate_custom_events.headless import BatchRunner, parse_args
+
+
+class FakeCache:
+    def __init__(self, rec_id):
+        self.recording_id = rec_id
+
+
+def test_stages_of_different_recordings_overlap(monkeypatch, tmp_path):
+    spans = {}
+    lock = threading.Lock()
+
+    def span(stage, rec_id, started):
+        with lock:
+            spans[stage, rec_id] = (started, time.perf_counter())
+
+    def fetch_recording(rec_id, worksp_id, cloud_api_key, download_path, metrics):
+        started = time.perf_counter()
+        time.sleep(0.05)
+        span("download", rec_id, started)
+        return FakeCache(rec_id)
+
+    def prepare_frames(cache, start, end, metrics):
+        started = time.perf_counter()
+        if cache.recording_id == "broken":
+            raise RuntimeError("no scene video")
+        time.sleep(0.05)
+        span("prepare", cache.recording_id, started)
+        return [], pd.DataFrame(), None, None
+
+    async def detect_events(cache, *args, **kwargs):
+        started = time.perf_counter()
+        await asyncio.sleep(0.3)
+        span("query", cache.recording_id, started)
+        return pd.DataFrame({"code": ["a", "b"]})
+
+    monkeypatch.setattr(headless, "fetch_recording", fetch_recording)
+    monkeypatch.setattr(headless, "prepare_frames", prepare_frames)
+    monkeypatch.setattr(headless, "detect_events", detect_events)
+
+    runner = BatchRunner(
+        "openai-key",
+        "cloud-token",
+        tmp_path,
+        "reading a book",
+        "reading_book",
+        20,
+        stage_workers={"download": 1, "prepare": 1, "query": 2},
+    )
+    recordings = [("ws", "rec1"), ("ws", "broken"), ("ws", "rec2"), ("ws", "rec3")]
+    summary = asyncio.run(runner.run(recordings))
+
+    assert list(summary["recording_id"]) == ["rec1", "broken", "rec2", "rec3"]
+    assert list(summary["status"][[0, 2, 3]]) == ["ok"] * 3
+    assert summary["status"][1].startswith("failed: RuntimeError")
+    assert list(summary["events"][[0, 2, 3]]) == [2, 2, 2]
+    # rec3 is rendered while the queries of the earlier recordings still run
+    assert spans["prepare", "rec3"][0] < spans["query", "rec1"][1]
+    assert spans["query", "rec1"][1] > spans["query", "rec2"][0]
+
+
+def test_parse_args_reads_manifest(tmp_path):
+    manifest = tmp_path / "recordings.txt"
+    manifest.write_text(
+        "# recordings of the study\n"
+        "rec2\n"
+        "\n"
+        "https://cloud.pupil-labs.com/workspaces/ab12/recordings?id=0c3d&x=1\n"
+    )
+    args = parse_args(
+        [
+            "rec1",
+            "--manifest",
+            str(manifest),
+            "--workspace",
+            "ws",
+            "--description",
+            "reading a book",
+            "--codes",
+            "reading_book",
+            "--openai-api-key",
+            "key",
+            "--cloud-api-key",
+            "token",
+            "--query-workers",
+            "3",
+        ]
+    )
+    assert args.recordings == [("ws", "rec1"), ("ws", "rec2"), ("ab12", "0c3d")]
+    assert args.query_workers == 3
+    assert args.end is None
+
+    with pytest.raises(SystemExit):
+        parse_args(
+            [
+                "rec1",
+                "--description",
+                "a",
+                "--codes",
+                "a_b",
+                "--openai-api-key",
+                "k",
+                "--cloud-api-key",
+                "t",
+            ]
+        )
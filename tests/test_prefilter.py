@@ -0,0 +1,60 @@
+import base64
+
+import cv2
+import numpy as np
+import pytest
+
+from pupil_labs.automate_custom_events.prefilter import (
+    FrameScorer,
+    Prefilter,
+    decode_frame,
+)
+
+
+class ValueScorer(FrameScorer):
+    def score(self, images, activities):
+        assert activities == ["reading a book"]
+        return np.array([img[0, 0, 0] / 100 for img in images])
+
+
+def encode(value):
+    img = np.full((4, 4, 3), value, np.uint8)
+    return base64.b64encode(cv2.imencode(".png", img)[1]).decode()
+
+
+def test_prefilter_estimates_recall_from_audited_frames(tmp_path):
+    # Frames 0-9 score 0.5 and are escalated, frames 10-29 score 0.1
+    values = [50] * 10 + [10] * 20
+    prefilter = Prefilter(ValueScorer(), {"threshold": 0.3, "audit_every": 5})
+    prefilter.activities = ["reading a book"]
+    indices = list(range(len(values)))
+    prefilter.score_frames(indices, [encode(value) for value in values])
+    assert decode_frame(encode(10))[0, 0, 0] == 10
+
+    skipped = prefilter.skip(indices)
+    sent = [index for index in indices if index not in skipped]
+    # Deciding again keeps the first decision
+    assert prefilter.skip(indices) == skipped
+    assert len(skipped) == 16
+    assert sent == list(range(10)) + [14, 19, 24, 29]
+
+    # The remote model finds activities in 8 escalated and 2 audited frames
+    prefilter.record(sent, {index: ["code"] for index in [*range(8), 14, 24]})
+    report = prefilter.report()
+
+    assert report["frames_escalated"] == 10
+    assert report["frames_audited"] == 4
+    assert report["call_reduction"] == 16 / 30
+    # Half of the 20 frames below the threshold are estimated to be positive
+    assert report["recall_estimate"] == 8 / (8 + 10)
+    table = prefilter.scores_table()
+    assert list(table["decision"][:11]) == ["escalated"] * 10 + ["skipped"]
+    assert table["detected"].isna().sum() == 16
+
+
+def test_frame_scorers_implement_score():
+    class NoScorer(FrameScorer):
+        pass
+
+    with pytest.raises(TypeError):
+        NoScorer()
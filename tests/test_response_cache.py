@@ -0,0 +1,35 @@
+from pupil_labs.automate_custom_events.response_cache import (
+    ResponseCache,
+    request_key,
+)
+
+
+def test_request_key_covers_prompt_and_model():
+    params = {"model": "gpt-4o", "messages": [{"content": "a"}], "max_tokens": 300}
+    assert request_key(params) == request_key(dict(reversed(params.items())))
+    assert request_key(params) != request_key({**params, "max_tokens": 200})
+    assert request_key(params) != request_key({**params, "model": "gpt-4o-mini"})
+
+
+def test_lru_eviction_and_counters(tmp_path):
+    cache = ResponseCache(tmp_path / "responses.sqlite", max_bytes=25)
+    cache.put("a", "x" * 10)
+    cache.put("b", "y" * 10)
+    assert cache.get("a") == "x" * 10
+    cache.put("c", "z" * 10)
+
+    assert cache.get("b") is None
+    assert cache.get("c") == "z" * 10
+    assert (cache.hits, cache.misses) == (2, 1)
+    cache.close()
+
+    reopened = ResponseCache(tmp_path / "responses.sqlite", max_bytes=25)
+    assert reopened.get("a") == "x" * 10
+    reopened.close()
+
+
+def test_disabled_cache_bypasses_storage(tmp_path):
+    cache = ResponseCache(tmp_path / "responses.sqlite", enabled=False)
+    cache.put("a", "x")
+    assert cache.get("a") is None
+    assert not (tmp_path / "responses.sqlite").exists()
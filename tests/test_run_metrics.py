@@ -0,0 +1,68 @@
+import json
+import threading
+
+from pupil_labs.automate_custom_events.frame_processor import TokenUsageStats
+from pupil_labs.automate_custom_events.run_metrics import (
+    PROMETHEUS_NAME,
+    RUN_METRICS_NAME,
+    RunMetrics,
+)
+
+
+def test_run_metrics_report_and_prometheus_text(tmp_path):
+    metrics = RunMetrics("rec1")
+    with metrics.stage("query"):
+        pass
+
+    def encode():
+        for _ in range(100):
+            metrics.add_stage("encode", 0.01, 0.005)
+
+    threads = [threading.Thread(target=encode) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    metrics.count("openai_requests", status=200)
+    metrics.count("openai_requests", 2, status=429)
+    metrics.count("openai_retries", 2)
+    for latency in (0.3, 0.7, 1.5):
+        metrics.observe("openai_request_latency_seconds", latency)
+    usage = TokenUsageStats()
+    usage.add({"prompt_tokens": 1000, "completion_tokens": 20})
+    metrics.add_report("tokens", usage)
+
+    path = metrics.write(tmp_path, prometheus=True)
+
+    assert path == tmp_path / RUN_METRICS_NAME
+    report = json.loads(path.read_text())
+    # Stages are in pipeline order
+    assert list(report["stages"]) == ["encode", "query"]
+    assert report["stages"]["encode"]["calls"] == 400
+    assert abs(report["stages"]["encode"]["cpu_s"] - 2.0) < 1e-9
+    assert report["counters"] == {
+        "openai_requests": {"status=200": 1, "status=429": 2},
+        "openai_retries": 2,
+    }
+    latency = report["histograms"]["openai_request_latency_seconds"]
+    assert latency["count"] == 3
+    assert latency["p50"] == 0.7
+    assert latency["buckets"]["0.5"] == 1
+    assert latency["buckets"]["+Inf"] == 3
+    assert report["tokens"]["prompt_tokens"] == 1000
+
+    text = (tmp_path / PROMETHEUS_NAME).read_text()
+    lines = text.splitlines()
+    assert (
+        'pl_custom_events_openai_requests_total{recording_id="rec1",status="429"} 2'
+        in lines
+    )
+    assert (
+        "pl_custom_events_openai_request_latency_seconds_bucket"
+        '{recording_id="rec1",le="+Inf"} 3' in lines
+    )
+    assert (
+        'pl_custom_events_stage_wall_seconds{recording_id="rec1",stage="encode"} '
+        in text
+    )
+    assert 'pl_custom_events_tokens_prompt_tokens{recording_id="rec1"} 1000' in lines
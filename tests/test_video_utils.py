@@ -0,0 +1,247 @@
+import asyncio
+import base64
+import random
+import threading
+from fractions import Fraction
+
+import av
+import cv2
+import numpy as np
+import pandas as pd
+import pytest
+
+from pupil_labs.automate_custom_events.video_utils import (
+    FrameEncodingStats,
+    FrameSignatures,
+    LazyFrameSource,
+    StreamingFrames,
+    create_gaze_overlay_frames,
+    create_gaze_overlay_video,
+    encode_frame_base64,
+    encode_video_as_base64,
+    time_window_mask,
+)
+
+
+@pytest.fixture(scope="module")
+def scene_video(tmp_path_factory):
+    path = tmp_path_factory.mktemp("rec") / "scene.mp4"
+    with av.open(str(path), "w") as container:
+        stream = container.add_stream("libx264", rate=30, options={"g": "12"})
+        stream.width, stream.height = 160, 120
+        stream.pix_fmt = "yuv420p"
+        stream.codec_context.time_base = Fraction(1, 30)
+        for i in range(60):
+            img = np.full((120, 160, 3), (i * 4) % 255, np.uint8)
+            img[:, (i * 2) % 160] = 255
+            frame = av.VideoFrame.from_ndarray(img, format="rgb24")
+            frame.pts = i
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+    return path
+
+
+def decode_jpeg(encoded):
+    buffer = np.frombuffer(base64.b64decode(encoded), np.uint8)
+    return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+
+
+def test_lazy_frame_source_matches_eager_encoding(scene_video):
+    eager_frames, eager_metadata = encode_video_as_base64(scene_video)
+    lazy_frames = LazyFrameSource(scene_video, cache_size=4)
+    assert len(lazy_frames) == len(eager_frames)
+    assert lazy_frames.frame_metadata().equals(eager_metadata)
+
+    indices = list(range(len(lazy_frames)))
+    random.Random(0).shuffle(indices)
+    for index in indices[:20] + [0, 1, 2, len(lazy_frames) - 1]:
+        assert np.array_equal(
+            decode_jpeg(lazy_frames[index]), decode_jpeg(eager_frames[index])
+        )
+    assert len(lazy_frames._cache) == 4
+    assert lazy_frames.num_decoded < 20 * 12
+    lazy_frames.close()
+
+
+def test_lazy_frame_source_decodes_forward_without_seeking(scene_video):
+    lazy_frames = LazyFrameSource(scene_video)
+    for index in range(0, 12, 3):
+        lazy_frames[index]
+    assert lazy_frames.num_seeks == 1
+    lazy_frames.close()
+
+
+def test_lazy_frame_source_decodes_off_the_event_loop(scene_video):
+    eager_frames, _ = encode_video_as_base64(scene_video)
+    lazy_frames = LazyFrameSource(scene_video, cache_size=4)
+    decoded_on = set()
+    decode = lazy_frames._decode
+
+    def record_thread(pts):
+        decoded_on.add(threading.current_thread().name)
+        return decode(pts)
+
+    lazy_frames._decode = record_thread
+
+    async def scenario():
+        return [await lazy_frames.get(index) for index in (5, 0, 5)]
+
+    frames = asyncio.run(scenario())
+    lazy_frames.close()
+    assert frames == [eager_frames[5], eager_frames[0], eager_frames[5]]
+    assert decoded_on and all(
+        name.startswith("frame-decoder") for name in decoded_on
+    )
+
+
+@pytest.mark.parametrize("fmt", [".jpg", ".webp", ".png"])
+def test_encode_frame_base64_resizes_to_short_side(fmt):
+    img = np.random.default_rng(0).integers(0, 255, (1200, 1600, 3), np.uint8)
+    stats = FrameEncodingStats(baseline_every=1)
+    encoded = encode_frame_base64(
+        img, {"format": fmt, "short_side": 600, "quality": 80}, stats
+    )
+    assert decode_jpeg(encoded).shape == (600, 800, 3)
+    report = stats.report()
+    assert report["frames"] == 1
+    assert report["total_bytes"] == len(base64.b64decode(encoded))
+
+
+def test_encode_frame_base64_keeps_small_frames():
+    img = np.zeros((120, 160, 3), np.uint8)
+    assert decode_jpeg(encode_frame_base64(img)).shape == (120, 160, 3)
+
+
+def merged_gaze(video_path):
+    with av.open(str(video_path)) as container:
+        pts = sorted(p.pts for p in container.demux(video=0) if p.pts is not None)
+    ts = pd.Series(np.arange(len(pts), dtype=np.uint64) * 33_333_333)
+    merged = pd.DataFrame(
+        {
+            "pts": pts,
+            "timestamp [ns]": ts,
+            "gaze x [px]": np.linspace(0, 160, len(pts)),
+            "gaze y [px]": 60.0,
+        }
+    )
+    return merged, ts
+
+
+def test_parallel_overlay_matches_serial_timing(scene_video, tmp_path):
+    merged, ts = merged_gaze(scene_video)
+
+    def read_timing(path):
+        with av.open(str(path)) as container:
+            stream = container.streams.video[0]
+            return stream.time_base, [frame.pts for frame in container.decode(stream)]
+
+    serial, parallel = tmp_path / "serial.mp4", tmp_path / "parallel.mp4"
+    create_gaze_overlay_video(merged, scene_video, ts, serial)
+    create_gaze_overlay_video(merged, scene_video, ts, parallel, num_workers=2)
+    assert read_timing(parallel) == read_timing(serial)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["parallel.mp4", "serial.mp4"]
+
+
+def test_frame_signatures_find_near_duplicates(tmp_path):
+    rng = np.random.default_rng(0)
+    scene = rng.integers(0, 255, (120, 160, 3), dtype=np.uint8)
+    noisy = np.clip(scene.astype(int) + rng.integers(-3, 4, scene.shape), 0, 255)
+    other = rng.integers(0, 255, (120, 160, 3), dtype=np.uint8)
+
+    signatures = FrameSignatures()
+    signatures.add(0, scene, (50, 50))
+    signatures.add(1, other, (50, 50))
+    signatures.add(2, noisy.astype(np.uint8), (55, 52))
+    signatures.add(3, scene, (140, 100))
+
+    params = {"max_hash_distance": 4, "max_gaze_distance": 30}
+    assert signatures.find_duplicate(2, [1, 0], **params) == 0
+    assert signatures.find_duplicate(3, [0, 1], **params) is None
+    assert signatures.find_duplicate(1, [0], **params) is None
+
+    signatures.save(tmp_path / "signatures.npz")
+    loaded = FrameSignatures.load(tmp_path / "signatures.npz")
+    assert len(loaded) == 4
+    assert loaded.find_duplicate(2, [1, 0], **params) == 0
+
+
+def test_encoded_signatures_keep_gaze(tmp_path):
+    path = tmp_path / "static.mp4"
+    with av.open(str(path), "w") as container:
+        stream = container.add_stream("libx264", rate=30)
+        stream.width, stream.height = 160, 120
+        stream.pix_fmt = "yuv420p"
+        img = np.random.default_rng(0).integers(0, 255, (120, 160, 3), np.uint8)
+        for i in range(3):
+            frame = av.VideoFrame.from_ndarray(img, format="rgb24")
+            frame.pts = i
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+
+    signatures = FrameSignatures(3)
+    gaze_xy = np.array([[20.0, 20.0], [140.0, 100.0], [22.0, 21.0]])
+    encode_video_as_base64(path, signatures=signatures, gaze_xy=gaze_xy)
+
+    params = {"max_hash_distance": 4, "max_gaze_distance": 30}
+    assert signatures.find_duplicate(1, [0], **params) is None
+    assert signatures.find_duplicate(2, [0], **params) == 0
+
+
+def test_time_window_only_renders_window_frames(scene_video):
+    merged, ts = merged_gaze(scene_video)
+    assert time_window_mask(scene_video, merged["pts"], 1, 1).sum() == 1
+
+    window = merged[time_window_mask(scene_video, merged["pts"], 1, None)]
+    frames, metadata = create_gaze_overlay_frames(window, scene_video, ts)
+    all_frames, all_metadata = create_gaze_overlay_frames(merged, scene_video, ts)
+
+    assert len(frames) >= len(all_frames) - 30
+    assert metadata["timestamp [s]"].iloc[0] == 1.0
+    for index in range(len(all_frames) - 30):
+        assert metadata.iloc[index].equals(all_metadata.iloc[index + 30])
+        assert frames[index] == all_frames[index + 30]
+
+
+def test_streaming_frames_are_available_while_encoding(scene_video):
+    merged, ts = merged_gaze(scene_video)
+    eager, _ = create_gaze_overlay_frames(merged, scene_video, ts)
+    gate = threading.Event()
+
+    def produce(frames):
+        frames.append(eager[0])
+        gate.wait()
+        create_gaze_overlay_frames(merged, scene_video, ts, frames=frames)
+
+    async def scenario(frames):
+        await frames.wait_for(0)
+        first = frames[0]
+        waiting = asyncio.ensure_future(frames.wait_for(len(eager) - 1))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        gate.set()
+        await waiting
+        return first
+
+    frames = StreamingFrames(len(eager) + 2, produce)
+    assert asyncio.run(scenario(frames)) == eager[0]
+    frames.close()
+    # The first frame was appended twice, the video ends one frame short
+    assert frames.encoded()[1:] == eager
+    assert frames[len(frames) - 1] == eager[-1]
+
+
+def test_streaming_frames_raise_encoding_errors():
+    def produce(frames):
+        raise ValueError("broken video")
+
+    frames = StreamingFrames(3, produce)
+    with pytest.raises(ValueError, match="broken video"):
+        asyncio.run(frames.wait_for(2))
+    with pytest.raises(ValueError):
+        frames[0]
+    with pytest.raises(ValueError):
+        frames.close()
@@ -0,0 +1,84 @@
+import io
+import zipfile
+
+import pytest
+
+from pupil_labs.automate_custom_events.zip_utils import extract_zip_stream
+
+
+class UnseekableBuffer(io.RawIOBase):
+    """Makes zipfile write data descriptors, like an archive generated on the fly."""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.data += b
+        return len(b)
+
+
+def make_zip(compression, streamed):
+    members = {
+        "export/scene.mp4": bytes(range(256)) * 2000 + b"PK\x07\x08" * 10,
+        "export/gaze.csv": b"timestamp [ns],gaze x [px],gaze y [px]\n" * 500,
+        "export/sub/": b"",
+        "export/info.json": b"{}",
+    }
+    buffer = UnseekableBuffer() if streamed else io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=compression) as zf:
+        for name, data in members.items():
+            if name.endswith("/"):
+                zf.writestr(name, b"")
+                continue
+            with zf.open(name, "w") as fd:
+                fd.write(data)
+    data = buffer.data if streamed else buffer.getvalue()
+    return bytes(data), members
+
+
+def chunked(data, size=1000):
+    return (data[i : i + size] for i in range(0, len(data), size))
+
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+@pytest.mark.parametrize("streamed", [True, False])
+def test_extract_zip_stream_flattens(tmp_path, compression, streamed):
+    data, members = make_zip(compression, streamed)
+    extracted = extract_zip_stream(chunked(data), tmp_path)
+    assert sorted(p.name for p in extracted) == ["gaze.csv", "info.json", "scene.mp4"]
+    for name, content in members.items():
+        if not name.endswith("/"):
+            assert (tmp_path / name.split("/", 1)[1]).read_bytes() == content
+
+
+@pytest.mark.parametrize("size", [1, 7, 13])
+@pytest.mark.parametrize("streamed", [True, False])
+def test_extract_zip_stream_small_chunks(tmp_path, size, streamed):
+    # Chunk boundaries that split the signatures and headers of the members
+    data, members = make_zip(zipfile.ZIP_DEFLATED, streamed)
+    extracted = extract_zip_stream(chunked(data, size), tmp_path)
+    assert sorted(p.name for p in extracted) == ["gaze.csv", "info.json", "scene.mp4"]
+
+
+def test_extract_zip_stream_detects_truncation(tmp_path):
+    data, _ = make_zip(zipfile.ZIP_STORED, False)
+    end = data.index(b"PK\x01\x02")
+    with pytest.raises(zipfile.BadZipFile):
+        extract_zip_stream(chunked(data[:end]), tmp_path)
+
+
+def test_extract_zip_stream_selects_members(tmp_path):
+    data, members = make_zip(zipfile.ZIP_DEFLATED, True)
+    extract_zip_stream(chunked(data), tmp_path, members=("*.mp4", "gaze.csv"))
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["gaze.csv", "scene.mp4"]
+
+
+def test_extract_zip_stream_detects_corruption(tmp_path):
+    data, _ = make_zip(zipfile.ZIP_STORED, False)
+    corrupted = bytearray(data)
+    corrupted[200] ^= 0xFF
+    with pytest.raises(zipfile.BadZipFile):
+        extract_zip_stream(chunked(bytes(corrupted)), tmp_path)